@@ -12,6 +12,14 @@ def config_parser():
     parser.add_argument('--model_type', default="nerf", type=str,
                         help='choose model type for model [smpl_nerf, nerf, append_to_nerf, smpl, warp, vertex_sphere, smpl_estimator, original_nerf, dynamic]')
     parser.add_argument("--dataset_dir", type=str, default='data', help='directory with specific dataset structure')
+    parser.add_argument("--use_ray_store", type=int, default=0,
+                        help='memory-map the rays from a ray store next to transforms.json (packed on first use, see datasets/ray_store.py)')
+    parser.add_argument("--compact_rays", type=int, default=0,
+                        help='only keep camera transforms and images and rebuild the rays from pixel indices (model types nerf, smpl_nerf, append_to_nerf and append_smpl_params)')
+    parser.add_argument("--batch_loader", type=int, default=0,
+                        help='build whole ray batches by vectorised indexing and coarse sample them on the device instead of using a DataLoader (ray datasets only)')
+    parser.add_argument("--coarse_sampling_in_pipeline", type=int, default=0,
+                        help='with batch_loader: only load the rays and let the pipeline coarse sample them on the training device')
     parser.add_argument("--number_validation_images", type=int, default=1,
                         help='number of images to take from the validation images directory and use to render validation images')
 
@@ -47,6 +55,8 @@ def config_parser():
     parser.add_argument("--warp_radius", type=float, default=0.01, help='radius around smpl vertices where the vertex can impact the warp of a sample. Used with model_type=dynamic')
     parser.add_argument("--warp_temperature", type=float, default=10000,
                         help='temperature parameter that is multiplied with input of modified softmax for calculating the attention scores that tell us according to which vertex of the smpl we warp. Used with model_type=dynamic')
+    parser.add_argument("--warp_number_neighbours", type=int, default=32,
+                        help='number of closest smpl vertices within warp_radius that are used for the attention weighted warp of a sample (KD-tree search per pose). 0 computes the attentions densely over all vertices. Used with model_type=dynamic and image_wise_dynamic')
     parser.add_argument("--load_coarse_model", type=str, default=None,
                         help='For testing if the smpl parameters can be optimized with a pretrained nerf model. Used by the image wise solver')
 
@@ -64,10 +74,24 @@ def config_parser():
                         action="append")
     parser.add_argument("--early_validation", type=int, default=0,
                         help='run extra validation loop every log_iterations')
+    parser.add_argument("--profile", type=int, default=0,
+                        help='time the sections of every training step and write the times, rays/sec, samples/sec and peak memory to tensorboard every log_iterations')
+    parser.add_argument("--profile_trace_start", type=int, default=10,
+                        help='training step after which the torch.profiler trace starts. Used with profile')
+    parser.add_argument("--profile_trace_steps", type=int, default=0,
+                        help='number of training steps recorded with torch.profiler into the run directory, 0 records no trace. Used with profile')
     parser.add_argument("--num_epochs", type=int, default=100, help='number of epochs to run')
     parser.add_argument("--near", type=float, default=1, help='near ray bound for coarse sampling')
     parser.add_argument("--far", type=float, default=4, help='far ray bound for coarse sampling')
     parser.add_argument("--number_coarse_samples", type=int, default=64, help='number of coarse samples per ray')
+    parser.add_argument("--occupancy_grid", type=int, default=0,
+                        help='If this is on: the coarse samples are only placed in the cells of a voxel grid that are occupied by the smpl meshes of the dataset and rays that miss the grid are not rendered. Used with model_type nerf and smpl_nerf, needs batch_loader')
+    parser.add_argument("--occupancy_grid_resolution", type=int, default=64,
+                        help='number of cells along the longest side of the occupancy grid')
+    parser.add_argument("--occupancy_grid_margin", type=float, default=0.05,
+                        help='dilation of the occupied space around the smpl vertices for the occupancy grid')
+    parser.add_argument("--perturb_per_bin", type=int, default=0,
+                        help='draw an independent random offset for every coarse sample bin instead of one per ray')
     parser.add_argument("--number_fine_samples", type=int, default=128, help='number of fine samples per ray')
     parser.add_argument("--human_pose_encoding", type=int, default=0,
                         help='whether or not to encode the human pose')
@@ -93,7 +117,29 @@ def config_parser():
     parser.add_argument("--siren", type=str, default=0,
                         help='Use Siren as RenderRayNet')
     parser.add_argument("--load_run", type=str, default=None,
-                        help='Load latest models from given run')
+                        help='Load latest models from given run, resumes training from its latest checkpoint '
+                             '(models, optimizer, epoch and rng state) if it has one')
+    parser.add_argument("--checkpoint_keep", type=int, default=3,
+                        help='number of checkpoints that are kept in the run directory, 0 keeps all')
+    parser.add_argument("--checkpoint_async", type=int, default=1,
+                        help='write checkpoints in a background thread')
+    parser.add_argument("--distributed", type=int, default=0,
+                        help='data parallel training over the ranks started by torchrun with the gloo backend, '
+                             'e.g. torchrun --standalone --nproc_per_node=4 train.py --distributed=1 ...')
+    parser.add_argument("--distributed_timeout", type=int, default=120,
+                        help='minutes a rank waits in a collective of the process group, the ranks other than 0 '
+                             'wait in the gradient all_reduce while rank 0 validates')
+    parser.add_argument("--num_threads", type=int, default=0,
+                        help='intra-op threads of torch, 0 uses the cores of the core set of the run')
+    parser.add_argument("--num_interop_threads", type=int, default=0,
+                        help='inter-op threads of torch, 0 uses one per 16 cores of the core set (1 to 4)')
+    parser.add_argument("--colocated_runs", type=int, default=0,
+                        help='number of runs that share the cores of this node, 0 uses the local ranks of '
+                             'a distributed run (1 otherwise)')
+    parser.add_argument("--run_slot", type=int, default=-1,
+                        help='index of this run among the colocated runs, -1 uses the local rank')
+    parser.add_argument("--cpu_affinity", type=int, default=1,
+                        help='pin the run to its core set when several runs share the node')
     parser.add_argument("--use_directional_input", type=int, default=1,
                         help='use directional input in the model; for ablation studies')
 
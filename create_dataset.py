@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
+import multiprocessing
 import numpy as np
 import os
-from render import get_smpl_mesh, render_scene, save_render, get_human_poses, get_warp
+# PyOpenGL picks its platform when pyrender is imported. Rendering a dataset without a display uses
+# OSMesa (CPU), set PYOPENGL_PLATFORM=egl to use EGL instead. Only done when this file is run, the
+# modules importing create_dataset or render (training, inference) keep the default platform.
+if __name__ == '__main__' and 'PYOPENGL_PLATFORM' not in os.environ and not os.environ.get('DISPLAY'):
+    os.environ['PYOPENGL_PLATFORM'] = 'osmesa'
+import pyrender
+from render import get_smpl_mesh, RenderSession, save_render, get_human_poses, get_warp, get_smpl_model, \
+    get_texture, get_uv_map, smpl_mesh_from_model
 from utils import disjoint_indices
 from camera import get_sphere_poses, get_pose_matrix, get_circle_poses, get_circle_on_sphere_poses
 import json
@@ -61,11 +69,94 @@ def config_parser():
                         type=float, help="Theta of center of circle on sphere radius")
     parser.add_argument('--circle_on_sphere_radius', default=10,
                         type=float, help="Circle on sphere radius")
+    parser.add_argument('--num_workers', default=0, type=int,
+                        help='Number of processes that render the frames of a split in parallel (0: render serially)')
     return parser
 
 
+class FrameRenderer():
+    """
+    Renders and saves the frames of one split. Every worker process keeps one
+    instance, so the SMPL model, texture, uv-map, the canonical mesh and the
+    render session are only loaded and created once per process instead of
+    once per frame. Every frame is written to its own files, so frames can be
+    rendered in any order.
+    """
+
+    def __init__(self, directory: str, dataset_type: str, height: int, width: int, camera_angle_x: float,
+                 far: float, smpl_path: str, texture_path: str,
+                 uv_map_path: str = "textures/smpl_uv_map.npy"):
+        self.directory = directory
+        self.dataset_type = dataset_type
+        self.height = height
+        self.width = width
+        self.camera_angle_x = camera_angle_x
+        self.far = far
+        self.model = get_smpl_model(smpl_path)
+        self.texture = get_texture(texture_path)
+        self.uv = get_uv_map(uv_map_path)
+        self.session = RenderSession()
+        if dataset_type == "nerf":
+            self.mesh_canonical = get_smpl_mesh()
+        elif dataset_type == "smpl":
+            self.trimesh_canonical = smpl_mesh_from_model(self.model, self.texture, self.uv, return_pyrender=False)
+
+    def __call__(self, frame):
+        """
+        Render and save one frame.
+
+        Parameters
+        ----------
+        frame : tuple
+            (image_name, camera_pose, human_pose, warp_name, depth_name).
+
+        Returns
+        -------
+        image_name : str
+            File name of the saved image.
+        """
+        image_name, camera_pose, human_pose, warp_name, depth_name = frame
+        if self.dataset_type == "nerf":
+            img = self.session.render(self.mesh_canonical, camera_pose, get_pose_matrix(), camera_pose,
+                                      self.height, self.width, self.camera_angle_x)
+        elif self.dataset_type == "pix2pix":
+            mesh_goal = smpl_mesh_from_model(self.model, self.texture, self.uv, body_pose=human_pose)
+            rgb, depth = self.session.render(mesh_goal, camera_pose, get_pose_matrix(), camera_pose,
+                                             self.height, self.width, self.camera_angle_x, return_depth=True)
+            depth = (depth / self.far * 255).astype(np.uint8)
+            img = np.concatenate([rgb, gray2rgb(depth)], 1)
+        elif self.dataset_type == "smpl_nerf":
+            mesh_goal = smpl_mesh_from_model(self.model, self.texture, self.uv, body_pose=human_pose)
+            img = self.session.render(mesh_goal, camera_pose, get_pose_matrix(), camera_pose,
+                                      self.height, self.width, self.camera_angle_x)
+        elif self.dataset_type == "smpl":
+            trimesh_goal = smpl_mesh_from_model(self.model, self.texture, self.uv, body_pose=human_pose,
+                                                return_pyrender=False)
+            mesh_goal = pyrender.Mesh.from_trimesh(trimesh_goal)
+            img, depth = self.session.render(mesh_goal, camera_pose, get_pose_matrix(), camera_pose,
+                                             self.height, self.width, self.camera_angle_x, return_depth=True)
+            warp, depth1 = get_warp(self.trimesh_canonical, trimesh_goal, np.array(camera_pose),
+                                    self.height, self.width, self.camera_angle_x)
+            np.save(os.path.join(self.directory, warp_name), warp)
+            np.save(os.path.join(self.directory, depth_name), depth)
+        save_render(img, os.path.join(self.directory, image_name))
+        return image_name
+
+
+frame_renderer = None  # FrameRenderer of a worker process
+
+
+def init_frame_worker(*frame_renderer_args):
+    global frame_renderer
+    frame_renderer = FrameRenderer(*frame_renderer_args)
+
+
+def render_frame_in_worker(frame):
+    return frame_renderer(frame)
+
+
 def save_split(save_dir, camera_transforms, indices, split,
-               height, width, camera_angle_x, far, dataset_type, human_poses=None, texture=1):
+               height, width, camera_angle_x, far, dataset_type, human_poses=None, texture=1, num_workers=0):
     mesh_canonical, betas, expression = get_smpl_mesh(return_betas_exps=True)
     if dataset_type not in ["nerf", "pix2pix", "smpl_nerf", "smpl"]:
         raise Exception("This dataset type is unknown")
@@ -103,30 +194,21 @@ def save_split(save_dir, camera_transforms, indices, split,
     elif dataset_type == "nerf":
         dict = {'camera_angle_x': camera_angle_x,
                 'image_transform_map': image_transform_map}
-    for i, (image_name, camera_pose) in tqdm(enumerate(image_transform_map.items())):
-        if dataset_type == "nerf":
-            img = render_scene(mesh_canonical, camera_pose, get_pose_matrix(), camera_pose,
-                               height, width, camera_angle_x)
-        elif dataset_type == "pix2pix":
-            mesh_goal = get_smpl_mesh(body_pose=human_poses[i],smpl_file_name=smpl_path, texture_file_name=texture_path)
-            rgb, depth = render_scene(mesh_goal, camera_pose, get_pose_matrix(), camera_pose,
-                                      height, width, camera_angle_x, return_depth=True)
-            depth = (depth / far * 255).astype(np.uint8)
-            img = np.concatenate([rgb, gray2rgb(depth)], 1)
-        elif dataset_type == "smpl_nerf":
-            mesh_goal = get_smpl_mesh(body_pose=human_poses[i],smpl_file_name=smpl_path, texture_file_name=texture_path)
-            img = render_scene(mesh_goal, camera_pose, get_pose_matrix(), camera_pose,
-                               height, width, camera_angle_x)
-        elif dataset_type == "smpl":
-            mesh_goal = get_smpl_mesh(body_pose=human_poses[i],smpl_file_name=smpl_path, texture_file_name=texture_path)
-            trimesh_goal = get_smpl_mesh(body_pose=human_poses[i], return_pyrender=False,smpl_file_name=smpl_path, texture_file_name=texture_path)
-            trimesh_canonical = get_smpl_mesh(return_pyrender=False,smpl_file_name=smpl_path, texture_file_name=texture_path)
-            img, depth = render_scene(mesh_goal, camera_pose, get_pose_matrix(), camera_pose,
-                                      height, width, camera_angle_x, return_depth=True)
-            warp, depth1 = get_warp(trimesh_canonical, trimesh_goal, np.array(camera_pose), height, width, camera_angle_x)
-            np.save(os.path.join(directory, warp_names[i]), warp)
-            np.save(os.path.join(directory, depth_names[i]), depth)
-        save_render(img, os.path.join(directory, image_name))
+    frames = [(image_name, camera_pose, human_poses[i] if dataset_type != "nerf" else None,
+               warp_names[i], depth_names[i])
+              for i, (image_name, camera_pose) in enumerate(image_transform_map.items())]
+    frame_renderer_args = (directory, dataset_type, height, width, camera_angle_x, far, smpl_path, texture_path)
+    if num_workers > 0:
+        # spawn instead of fork so that every worker creates its own GL context
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(num_workers, initializer=init_frame_worker, initargs=frame_renderer_args) as pool:
+            for _ in tqdm(pool.imap_unordered(render_frame_in_worker, frames), total=len(frames)):
+                pass
+    else:
+        renderer = FrameRenderer(*frame_renderer_args)
+        for frame in tqdm(frames):
+            renderer(frame)
+        renderer.session.delete()
 
     print("Saved {} images under: {}".format(split, directory))
     json_file_name = os.path.join(directory, 'transforms.json')
@@ -224,14 +306,14 @@ def create_dataset():
     train_indices, val_indices = sorted(train_indices), sorted(val_indices)
     save_split(args.save_dir, camera_transforms, train_indices, "train",
                args.resolution, args.resolution, camera_angle_x, far,
-               args.dataset_type, human_poses, args.texture)
+               args.dataset_type, human_poses, args.texture, args.num_workers)
     save_split(args.save_dir, camera_transforms, val_indices, "val",
                args.resolution, args.resolution, camera_angle_x, far,
-               args.dataset_type, human_poses, args.texture)
+               args.dataset_type, human_poses, args.texture, args.num_workers)
     if args.smpl_sequence_file is not None or args.frames_per_view != 1:
         save_split(args.save_dir, camera_transforms_test, np.arange(dataset_size), "test",
                args.resolution, args.resolution, camera_angle_x, far,
-               args.dataset_type, human_poses, args.texture)
+               args.dataset_type, human_poses, args.texture, args.num_workers)
     args.train_index = train_indices
     args.val_index = val_indices
 
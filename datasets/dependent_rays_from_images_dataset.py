@@ -6,7 +6,8 @@ import cv2
 import numpy as np
 from torch.utils.data import Dataset
 
-from utils import get_rays, get_dependent_rays_indices
+from util.ray_mesh_bvh import BVHIntersector
+from utils import get_rays, get_dependent_rays_indices_batch
 
 
 class DependentRaysFromImagesDataset(Dataset):
@@ -43,6 +44,7 @@ class DependentRaysFromImagesDataset(Dataset):
         image_paths = sorted(glob.glob(os.path.join(image_directory, '*.png')))
         if not len(image_paths) == len(image_transform_map):
             raise ValueError('Number of images in image_directory is not the same as number of transforms')
+        intersector = BVHIntersector(canonical)  # built once for the rays of all images
         for image_path in image_paths:
             camera_transform = image_transform_map[os.path.basename(image_path)]
             human_pose = image_pose_map[os.path.basename(image_path)]
@@ -54,12 +56,13 @@ class DependentRaysFromImagesDataset(Dataset):
             # should we append a list of the different h, w of all images? right now referencing only the last h, w
             self.focal = .5 * self.w / np.tan(.5 * camera_angle_x)
             rays_translation, rays_direction = get_rays(self.h, self.w, self.focal, camera_transform)
-            for i in range(self.w):
-                for j in range(self.h):
-                    index_list = get_dependent_rays_indices(rays_translation[i][j], rays_direction[i][j], canonical,
-                                                            goal, camera_transform, self.h, self.w, self.focal)
-                    self.dependencies_index.append(index_list)
-                    self.dependencies_hw.append((i, j))
+            # all rays of the image in the order i in range(self.w), j in range(self.h)
+            index_lists = get_dependent_rays_indices_batch(rays_translation[:self.w, :self.h].reshape(-1, 3),
+                                                           rays_direction[:self.w, :self.h].reshape(-1, 3),
+                                                           canonical, goal, camera_transform, self.h, self.w,
+                                                           self.focal, intersector)
+            self.dependencies_index.extend(index_lists)
+            self.dependencies_hw.extend((i, j) for i in range(self.w) for j in range(self.h))
 
             trans_dir_rgb_stack = np.stack([rays_translation, rays_direction, image], -2)
             trans_dir_rgb_list = trans_dir_rgb_stack.reshape((-1, 3, 3))
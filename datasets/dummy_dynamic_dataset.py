@@ -7,6 +7,8 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset
 
+from datasets.ray_arrays import RayArrays
+from datasets.ray_batch_loader import gather_rays
 from utils import get_rays
 
 
@@ -30,9 +32,8 @@ class DummyDynamicDataset(Dataset):
         """
         super().__init__()
         self.transform = transform
-        self.rays = []  # list of arrays with ray translation, ray direction and rgb
-        self.image_indices = []
-        self.goal_poses = []  # list of corresponding human poses
+        self.rays = RayArrays()  # ray translation, ray direction and rgb
+        self.goal_poses = []  # goal pose of every image
         print('Start initializing all rays of all images')
         with open(transforms_file, 'r') as transforms_file:
             transforms_dict = json.load(transforms_file)
@@ -44,7 +45,7 @@ class DummyDynamicDataset(Dataset):
         image_paths = sorted(glob.glob(os.path.join(image_directory, '*.png')))
         if not len(image_paths) == len(self.image_transform_map):
             raise ValueError('Number of images in image_directory is not the same as number of transforms')
-        for i, image_path in enumerate(image_paths):
+        for image_path in image_paths:
             camera_transform = np.array(self.image_transform_map[os.path.basename(image_path)])
             human_pose = np.array(image_pose_map[os.path.basename(image_path)])
 
@@ -55,14 +56,11 @@ class DummyDynamicDataset(Dataset):
             self.focal = .5 * self.w / np.tan(.5 * camera_angle_x)
             rays_translation, rays_direction = get_rays(self.h, self.w, self.focal, camera_transform)
 
-            trans_dir_rgb_stack = np.stack([rays_translation, rays_direction, image], -2)
-            trans_dir_rgb_list = trans_dir_rgb_stack.reshape((-1, 3, 3))
-            self.image_indices.append(torch.ones(trans_dir_rgb_list.shape[0]).long() * i)
-            self.goal_poses.append(np.repeat(human_pose[np.newaxis, :], trans_dir_rgb_list.shape[0], axis=0))
-            self.rays.append(trans_dir_rgb_list)
-        self.rays = np.concatenate(self.rays)
-        self.image_indices = torch.cat(self.image_indices)
-        self.goal_poses = torch.from_numpy(np.concatenate(self.goal_poses)).float()
+            self.goal_poses.append(human_pose)
+            self.rays.append(rays_translation, rays_direction, image)
+        self.rays.concatenate()
+        self.image_indices = torch.from_numpy(self.rays.image_indices)  # index of the image (and goal pose) of every ray
+        self.goal_poses = torch.from_numpy(np.array(self.goal_poses)).float()  # [number_images, 69]
         print('Finish initializing rays')
 
     def __getitem__(self, index: int):
@@ -90,7 +88,30 @@ class DummyDynamicDataset(Dataset):
         ray_samples, samples_translations, samples_directions, z_vals, rgb = self.transform(
             (rays_translation, rays_direction, rgb))
 
-        return ray_samples, samples_translations, samples_directions, z_vals, self.image_indices[index], rgb
+        return ray_samples, samples_translations, samples_directions, z_vals, self.image_indices[index].long(), rgb
+
+    def get_batch(self, indices: torch.Tensor):
+        """
+        Vectorised version of __getitem__ without coarse sampling, used by RayBatchLoader.
+
+        Parameters
+        ----------
+        indices : torch.Tensor ([batch_size])
+            Indices of rays.
+
+        Returns
+        -------
+        rays_translation : torch.Tensor ([batch_size, 3])
+            Translation of rays.
+        rays_direction : torch.Tensor ([batch_size, 3])
+            Direction of rays.
+        image_indices : torch.Tensor ([batch_size])
+            Index of the image of every ray.
+        rgb : torch.Tensor ([batch_size, 3])
+            RGB values corresponding to rays.
+        """
+        rays_translation, rays_direction, rgb = gather_rays(self.rays, indices)
+        return [rays_translation, rays_direction, self.image_indices[indices].long(), rgb]
 
     def __len__(self) -> int:
         return len(self.rays)
@@ -7,12 +7,12 @@ import numpy as np
 import torch
 from torch.distributions import MixtureSameFamily
 from torch.utils.data import Dataset
-from trimesh.ray.ray_triangle import RayMeshIntersector
 import torch.distributions as D
 
 from models.dummy_image_wise_estimator import DummyImageWiseEstimator
 from render import get_smpl_mesh
-from utils import get_rays
+from util.ray_mesh_bvh import BVHIntersector
+from utils import get_rays, intersection_z_vals
 
 
 class ImageWiseDataset(Dataset):
@@ -105,41 +105,10 @@ class ImageWiseDataset(Dataset):
         # the parameters in the smpl estimator that we use to obtain the intersections will be optimized by the image wise solver
         false_pose, _ = self.smpl_estimator(1)
         goal_mesh = get_smpl_mesh(body_pose=false_pose.cpu(), return_pyrender=False)
-        intersector = RayMeshIntersector(goal_mesh)
-        z_vals_image = []
-        for ray_index in range(len(rays_translation)):
-            intersections = intersector.intersects_location([rays_translation[ray_index]],
-                                                            [rays_direction[ray_index]])
-            canonical_intersections_points = torch.from_numpy(intersections[0])  # (N_intersects, 3)
-            if self.args.number_coarse_samples == 1:
-                if len(canonical_intersections_points) == 0:
-                    z_vals = torch.DoubleTensor([self.args.far])  # [1]
-                else:
-                    distances_camera = torch.norm(canonical_intersections_points - rays_translation[ray_index],
-                                                  dim=1)
-                    z_vals = torch.tensor([torch.min(distances_camera)])  # [1]
-            elif self.args.coarse_samples_from_intersect == 1:
-                if len(canonical_intersections_points) == 0:
-                    z_vals = z_vals_simple
-                else:
-                    distances_camera = torch.norm(canonical_intersections_points - rays_translation[ray_index],
-                                                  dim=1)
-                    mean = torch.min(distances_camera)
-                    gauss = D.Normal(mean,
-                                     torch.ones_like(mean) * self.args.std_dev_coarse_sample_prior)
-                    z_vals, _ = torch.sort(gauss.sample((self.args.number_coarse_samples,)))
-            elif len(canonical_intersections_points) == 0 or self.args.coarse_samples_from_prior != 1:
-                z_vals = z_vals_simple
-            else:
-                mix = D.Categorical(torch.ones(len(canonical_intersections_points), ))
-                means = torch.norm(canonical_intersections_points - rays_translation[ray_index], dim=-1)
-                comp = D.Normal(means, torch.ones_like(means) * self.args.std_dev_coarse_sample_prior)
-                gmm = MixtureSameFamily(mix, comp)
-                z_vals = gmm.sample((self.args.number_coarse_samples,))
-            z_vals_image.append(z_vals)
-        z_vals_image = torch.stack(z_vals_image)  # [h*w, number_coarse_samples]
-        if self.args.number_coarse_samples == 1:
-            z_vals_image = z_vals_image.view(-1, 1)
+        intersector = BVHIntersector(goal_mesh)
+        z_vals_image = intersection_z_vals(intersector, rays_translation, rays_direction, z_vals_simple,
+                                           self.args)  # [h*w, number_coarse_samples]
+        z_vals = z_vals_image[-1]
         rays_translation = torch.from_numpy(rays_translation)
         rays_direction = torch.from_numpy(rays_direction)
         rays_samples = rays_translation[:, None, :] + rays_direction[:, None, :] * z_vals_image[:, :,
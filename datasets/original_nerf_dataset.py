@@ -4,8 +4,11 @@ import json
 
 import cv2
 import numpy as np
+import torch
 from torch.utils.data import Dataset
 
+from datasets.ray_arrays import RayArrays
+from datasets.ray_batch_loader import gather_rays
 from utils import get_rays
 
 
@@ -29,7 +32,7 @@ class OriginalNerfDataset(Dataset):
         """
         super().__init__()
         self.transform = transform
-        self.rays = []  # list of arrays with ray translation, ray direction and rgb
+        self.rays = RayArrays()  # ray translation, ray direction and rgb
         print('Start initializing all rays of all images')
         with open(transforms_file, 'r') as transforms_file:
             transforms_dict = json.load(transforms_file)
@@ -42,12 +45,8 @@ class OriginalNerfDataset(Dataset):
             self.focal = .5 * self.w / np.tan(.5 * camera_angle_x)
             rays_translation, rays_direction = get_rays(self.h, self.w, self.focal,
                                                         camera_transform)
-            trans_dir_rgb_stack = np.stack([rays_translation, rays_direction, image], -2)
-            trans_dir_rgb_list = trans_dir_rgb_stack.reshape((-1, 3, 3))
-            self.rays.append(trans_dir_rgb_list)
-            
-        if self.rays:
-            self.rays = np.concatenate(self.rays)
+            self.rays.append(rays_translation, rays_direction, image)
+        self.rays.concatenate()
         print('Finish initializing rays')
 
     def __getitem__(self, index: int):
@@ -76,5 +75,25 @@ class OriginalNerfDataset(Dataset):
 
         return ray_samples, samples_translations, samples_directions, z_vals, rgb
 
+    def get_batch(self, indices: torch.Tensor):
+        """
+        Vectorised version of __getitem__ without coarse sampling, used by RayBatchLoader.
+
+        Parameters
+        ----------
+        indices : torch.Tensor ([batch_size])
+            Indices of rays.
+
+        Returns
+        -------
+        rays_translation : torch.Tensor ([batch_size, 3])
+            Translation of rays.
+        rays_direction : torch.Tensor ([batch_size, 3])
+            Direction of rays.
+        rgb : torch.Tensor ([batch_size, 3])
+            RGB values (uint8) corresponding to rays.
+        """
+        return list(gather_rays(self.rays, indices))
+
     def __len__(self) -> int:
         return len(self.rays)
@@ -0,0 +1,70 @@
+import numpy as np
+
+
+class RayArrays():
+    """
+    In-memory structure of arrays of all rays of a dataset with the same
+    layout as a RayStore: one float32 origin per image, float32 directions,
+    uint8 rgb values and the int32 index of the image of every ray. Compared to
+    a float64 [number_rays, 3, 3] stack of translation, direction and rgb this
+    needs 19 instead of 72 bytes per ray. The rgb values are only normalized
+    once a batch is on its device (see normalize_rgb).
+
+    Rays are added image by image with append and become indexable after concatenate.
+    """
+
+    def __init__(self) -> None:
+        self.origins = []  # [number_images, 3]
+        self.directions = []  # [number_rays, 3]
+        self.rgb = []  # [number_rays, 3]
+        self.image_indices = []  # [number_rays]
+
+    def append(self, rays_translation: np.array, rays_direction: np.array, image: np.array):
+        """
+        Adds the rays of one image.
+
+        Parameters
+        ----------
+        rays_translation : np.array (H, W, 3)
+            Translation of rays as returned by get_rays (the camera origin for every ray).
+        rays_direction : np.array (H, W, 3)
+            Direction of rays.
+        image : np.array (H, W, 3)
+            Image as read by cv2 (uint8).
+        """
+        image_index = len(self.origins)
+        self.origins.append(np.asarray(rays_translation, dtype=np.float32).reshape(-1, 3)[0])
+        self.directions.append(np.asarray(rays_direction, dtype=np.float32).reshape(-1, 3))
+        self.rgb.append(np.asarray(image, dtype=np.uint8).reshape(-1, 3))
+        self.image_indices.append(np.full(len(self.directions[-1]), image_index, dtype=np.int32))
+
+    def concatenate(self):
+        """
+        Concatenates the appended images into single arrays.
+        """
+        self.origins = np.array(self.origins, dtype=np.float32).reshape(-1, 3)
+        self.directions = np.concatenate(self.directions) if self.directions else np.zeros((0, 3), np.float32)
+        self.rgb = np.concatenate(self.rgb) if self.rgb else np.zeros((0, 3), np.uint8)
+        self.image_indices = np.concatenate(self.image_indices) if self.image_indices else np.zeros(0, np.int32)
+        return self
+
+    def __getitem__(self, index):
+        """
+        Parameters
+        ----------
+        index : int or np.array
+            Index or indices of rays.
+
+        Returns
+        -------
+        ray_translation : np.array (3, ) or (N, 3)
+            Translation of rays (float32).
+        ray_direction : np.array (3, ) or (N, 3)
+            Direction of rays (float32).
+        rgb : np.array (3, ) or (N, 3)
+            RGB values (uint8) corresponding to rays.
+        """
+        return self.origins[self.image_indices[index]], self.directions[index], self.rgb[index]
+
+    def __len__(self) -> int:
+        return len(self.image_indices)
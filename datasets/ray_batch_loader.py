@@ -0,0 +1,131 @@
+import numpy as np
+import torch
+
+from datasets.ray_arrays import RayArrays
+from datasets.ray_store import RayStore
+from datasets.transforms import CoarseSampling
+
+
+def gather_rays(rays, indices: torch.Tensor):
+    """
+    Gather the rays with the given indices from the per-ray storage of a
+    dataset with one vectorised indexing operation.
+
+    Parameters
+    ----------
+    rays : RayArrays, RayStore or np.array ([number_rays, 3, 3])
+        Ray translation, ray direction and rgb of every ray.
+    indices : torch.Tensor ([batch_size])
+        Indices of rays.
+
+    Returns
+    -------
+    rays_translation : torch.Tensor ([batch_size, 3])
+        Translation of rays.
+    rays_direction : torch.Tensor ([batch_size, 3])
+        Direction of rays.
+    rgb : torch.Tensor ([batch_size, 3])
+        RGB values, uint8 for RayArrays and RayStore (see normalize_rgb), else normalized to [0, 1].
+    """
+    indices = indices.cpu().numpy()
+    if isinstance(rays, (RayArrays, RayStore)):
+        rays_translation, rays_direction, rgb = rays[indices]
+        rgb = torch.from_numpy(np.asarray(rgb, dtype=np.uint8))
+    else:
+        rays_translation, rays_direction, rgb = rays[indices].transpose((1, 0, 2))
+        rgb = torch.from_numpy(np.asarray(rgb, dtype=np.float32) / 255.)
+    return torch.from_numpy(np.asarray(rays_translation, dtype=np.float32)), \
+           torch.from_numpy(np.asarray(rays_direction, dtype=np.float32)), rgb
+
+
+def normalize_rgb(rgb: torch.Tensor) -> torch.Tensor:
+    """
+    Normalizes uint8 rgb values of a batch to [0, 1] on their device, float rgb values are returned unchanged.
+    """
+    if rgb.dtype == torch.uint8:
+        return rgb.float() / 255.
+    return rgb
+
+
+class RayBatchLoader():
+    """
+    Replacement for a DataLoader over a ray dataset that returns one whole
+    randomly permuted ray batch per step. The dataset needs to implement
+    get_batch(indices) returning [rays_translation, rays_direction, *extras, rgb]
+    so a batch is produced by vectorised tensor indexing instead of batch_size
+    calls of __getitem__ and a collate. The batches have the same layout as the
+    ones of a DataLoader over the dataset:
+    [ray_samples, rays_translation, rays_direction, z_vals, *extras, rgb].
+    Without coarse_sampling the plain rays [rays_translation, rays_direction, *extras, rgb]
+    are returned and the pipeline samples them itself.
+
+    With world_size > 1 every rank only iterates over its shard of the rays.
+    All ranks permute with the same seed per epoch (see set_epoch), so the
+    shards are disjoint, and all shards have the same number of batches.
+    """
+
+    def __init__(self, dataset, batch_size: int, coarse_sampling: CoarseSampling = None, shuffle: bool = True,
+                 device=None, rank: int = 0, world_size: int = 1, seed: int = 0) -> None:
+        """
+        Parameters
+        ----------
+        dataset :
+            Ray dataset implementing get_batch.
+        batch_size : int
+            Number of rays per batch.
+        coarse_sampling : CoarseSampling, optional
+            Coarse sampling that is applied to the whole batch. The default is None (no sampling).
+        shuffle : bool, optional
+            Randomly permute the rays every epoch. The default is True.
+        device : torch.device, optional
+            Device the batches are moved to. The default is cpu.
+        rank : int, optional
+            Rank of this process in a distributed run. The default is 0.
+        world_size : int, optional
+            Number of ranks the rays are sharded across. The default is 1 (no sharding).
+        seed : int, optional
+            Seed of the permutation that is shared by the ranks. The default is 0.
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.coarse_sampling = coarse_sampling
+        self.shuffle = shuffle
+        self.device = torch.device('cpu') if device is None else device
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        """
+        Epoch of the shared permutation of a sharded loader.
+        """
+        self.epoch = epoch
+
+    def number_rays(self) -> int:
+        # the rays that do not fill a shard are dropped, so that all ranks take the same number of steps
+        return len(self.dataset) // self.world_size
+
+    def __len__(self) -> int:
+        return (self.number_rays() + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle and self.world_size > 1:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=generator)
+        elif self.shuffle:
+            indices = torch.randperm(len(self.dataset))
+        else:
+            indices = torch.arange(len(self.dataset))
+        if self.world_size > 1:
+            indices = indices[:self.number_rays() * self.world_size][self.rank::self.world_size]
+        for start in range(0, len(indices), self.batch_size):
+            batch = [element.to(self.device) for element in
+                     self.dataset.get_batch(indices[start:start + self.batch_size])]
+            # rgb is copied as uint8 and normalized on the device
+            batch[-1] = normalize_rgb(batch[-1])
+            if self.coarse_sampling is None:
+                yield batch
+            else:
+                yield self.coarse_sampling.sample_data(batch)
@@ -0,0 +1,161 @@
+import glob
+import os
+import json
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from utils import get_rays_batch
+from render import get_smpl_vertices
+
+
+class RayIndexDataset(Dataset):
+    """
+    Compact dataset of rays from a directory of images and an images camera
+    transforms mapping file. Instead of materialising translation and direction
+    of every pixel it only keeps the camera transforms ([number_images, 4, 4])
+    and the uint8 images. Rays are rebuilt from (image index, pixel index) with
+    get_rays_batch, either one per __getitem__ or a whole batch with rays().
+    """
+
+    def __init__(self, image_directory: str, transforms_file: str,
+                 transform, return_human_pose: bool = False, device=None) -> None:
+        """
+        Parameters
+        ----------
+        image_directory : str
+            Path to images.
+        transforms_file : str
+            File path to file containing transformation mappings.
+        transform :
+            List of callable transforms for preprocessing.
+        return_human_pose : bool, optional
+            If True, __getitem__ returns the human pose of the ray like
+            SmplNerfDataset, else it returns the same as RaysFromImagesDataset.
+            The default is False.
+        device : torch.device, optional
+            Device on which camera transforms and images are kept. The default is cpu.
+        """
+        super().__init__()
+        self.transform = transform
+        self.return_human_pose = return_human_pose
+        self.device = torch.device('cpu') if device is None else device
+        print('Start loading all images')
+        with open(transforms_file, 'r') as file:
+            transforms_dict = json.load(file)
+        camera_angle_x = transforms_dict['camera_angle_x']
+        self.image_transform_map = transforms_dict.get('image_transform_map')
+        image_pose_map = transforms_dict.get('image_pose_map')
+        self.image_pose_map = image_pose_map
+        image_paths = sorted(glob.glob(os.path.join(image_directory, '*.png')))
+        if not len(image_paths) == len(self.image_transform_map):
+            raise ValueError('Number of images in image_directory is not the same as number of transforms')
+        camera_transforms = []
+        images = []
+        human_poses = []
+        for image_path in image_paths:
+            camera_transforms.append(self.image_transform_map[os.path.basename(image_path)])
+            images.append(cv2.imread(image_path))
+            if image_pose_map is not None:
+                human_poses.append(image_pose_map[os.path.basename(image_path)])
+        self.h, self.w = images[0].shape[:2]
+        self.focal = .5 * self.w / np.tan(.5 * camera_angle_x)
+        self.camera_transforms = torch.tensor(camera_transforms, dtype=torch.float32,
+                                              device=self.device)  # [number_images, 4, 4]
+        self.images = torch.from_numpy(np.stack(images)).to(self.device)  # [number_images, h, w, 3] uint8
+        self.human_poses = torch.tensor(human_poses, dtype=torch.float32,
+                                        device=self.device) if human_poses else None  # [number_images, 69]
+        if 'betas' in transforms_dict:
+            self.expression = [transforms_dict['expression']]
+            self.betas = [transforms_dict['betas']]
+            self.canonical_smpl = get_smpl_vertices(self.betas, self.expression)
+        print('Finish loading images')
+
+    def rays(self, indices: torch.Tensor):
+        """
+        Vectorised ray generation for a batch of ray indices on self.device.
+
+        Parameters
+        ----------
+        indices : torch.Tensor ([batch_size])
+            Indices of rays.
+
+        Returns
+        -------
+        rays_translation : torch.Tensor ([batch_size, 3])
+            Translation of rays.
+        rays_direction : torch.Tensor ([batch_size, 3])
+            Direction of rays.
+        rgb : torch.Tensor ([batch_size, 3])
+            uint8 RGB value corresponding to ray.
+        image_indices : torch.Tensor ([batch_size])
+            Index of the image of every ray.
+        """
+        indices = indices.to(self.device)
+        image_indices = torch.div(indices, self.h * self.w, rounding_mode='floor')
+        pixel_indices = indices % (self.h * self.w)
+        rays_translation, rays_direction = get_rays_batch(self.h, self.w, self.focal, self.camera_transforms,
+                                                          image_indices, pixel_indices)
+        rgb = self.images.view(len(self.images), -1, 3)[image_indices, pixel_indices]
+        return rays_translation, rays_direction, rgb, image_indices
+
+    def __getitem__(self, index: int):
+        """
+        Parameters
+        ----------
+        index : int
+            Index of ray.
+
+        Returns
+        -------
+        ray_samples : torch.Tensor ([number_coarse_samples, 3])
+            Coarse samples along the ray between near and far bound.
+        samples_translations : torch.Tensor ([3])
+            Translation of samples.
+        samples_directions : torch.Tensor ([3])
+            Direction of samples.
+        z_vals : torch.Tensor ([number_coarse_samples])
+            Depth of coarse samples along ray.
+        human_pose : torch.Tensor ([69])
+            Goal pose (only if return_human_pose).
+        rgb : torch.Tensor ([3])
+            RGB value corresponding to ray.
+        """
+        rays_translation, rays_direction, rgb, image_indices = self.rays(torch.tensor([index]))
+        ray_samples, samples_translations, samples_directions, z_vals, rgb = self.transform(
+            (rays_translation[0].cpu().numpy(), rays_direction[0].cpu().numpy(), rgb[0].cpu().numpy()))
+        if self.return_human_pose:
+            return ray_samples, samples_translations, samples_directions, z_vals, \
+                   self.human_poses[image_indices[0]].cpu(), rgb
+        return ray_samples, samples_translations, samples_directions, z_vals, rgb
+
+    def get_batch(self, indices: torch.Tensor):
+        """
+        Vectorised version of __getitem__ without coarse sampling, used by RayBatchLoader.
+
+        Parameters
+        ----------
+        indices : torch.Tensor ([batch_size])
+            Indices of rays.
+
+        Returns
+        -------
+        rays_translation : torch.Tensor ([batch_size, 3])
+            Translation of rays.
+        rays_direction : torch.Tensor ([batch_size, 3])
+            Direction of rays.
+        human_poses : torch.Tensor ([batch_size, 69])
+            Goal poses (only if return_human_pose).
+        rgb : torch.Tensor ([batch_size, 3])
+            RGB values corresponding to rays.
+        """
+        rays_translation, rays_direction, rgb, image_indices = self.rays(indices)
+        rgb = rgb.float() / 255.
+        if self.return_human_pose:
+            return [rays_translation, rays_direction, self.human_poses[image_indices], rgb]
+        return [rays_translation, rays_direction, rgb]
+
+    def __len__(self) -> int:
+        return len(self.images) * self.h * self.w
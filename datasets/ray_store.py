@@ -0,0 +1,265 @@
+import glob
+import os
+import json
+import shutil
+from contextlib import contextmanager
+
+import configargparse
+import cv2
+import numpy as np
+
+from utils import get_rays
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks (e.g. on Windows), concurrent packers are not serialized
+    fcntl = None
+
+RAY_STORE_VERSION = 1
+RAY_STORE_DIRECTORY = 'ray_store'
+RAY_STORE_HEADER = 'header.json'
+
+
+@contextmanager
+def store_lock(store_directory: str):
+    """
+    Exclusive lock of a store between processes (e.g. the ranks of a
+    distributed run), held while a store is checked and installed. The lock
+    file next to the store is never removed, so all processes lock the same file.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(store_directory)), exist_ok=True)
+    with open(store_directory + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class RayStore():
+    """
+    Memory-mapped, on-disk store of all rays of an image directory.
+
+    The store is packed once next to the transforms file and afterwards opened
+    with np.memmap, so opening it does not decode any image or compute any ray
+    and the page cache is shared between runs and processes. It contains the
+    ray translations and directions (float32), the rgb values (uint8) and for
+    every ray the index of the image (and therefore of the human pose) it
+    belongs to.
+    """
+
+    def __init__(self, store_directory: str) -> None:
+        """
+        Parameters
+        ----------
+        store_directory : str
+            Directory of a store created with RayStore.pack.
+        """
+        with open(os.path.join(store_directory, RAY_STORE_HEADER), 'r') as header_file:
+            self.header = json.load(header_file)
+        if self.header['version'] != RAY_STORE_VERSION:
+            raise ValueError('Ray store in ' + store_directory + ' has version ' + str(self.header['version']) +
+                             ' but version ' + str(RAY_STORE_VERSION) + ' is required. Please repack it.')
+        self.h = self.header['h']
+        self.w = self.header['w']
+        self.focal = self.header['focal']
+        self.image_names = self.header['image_names']
+        self.translations = np.load(os.path.join(store_directory, 'translations.npy'), mmap_mode='r')  # [N, 3]
+        self.directions = np.load(os.path.join(store_directory, 'directions.npy'), mmap_mode='r')  # [N, 3]
+        self.rgb = np.load(os.path.join(store_directory, 'rgb.npy'), mmap_mode='r')  # [N, 3]
+        self.pose_indices = np.load(os.path.join(store_directory, 'pose_indices.npy'), mmap_mode='r')  # [N]
+        poses_file = os.path.join(store_directory, 'poses.npy')
+        self.poses = np.load(poses_file) if os.path.exists(poses_file) else None  # [number_images, 69]
+
+    def __getitem__(self, index: int):
+        """
+        Returns
+        -------
+        ray_translation : np.array (3, )
+            Translation of ray.
+        ray_direction : np.array (3, )
+            Direction of ray.
+        rgb : np.array (3, )
+            RGB value (uint8) corresponding to ray.
+        """
+        return self.translations[index], self.directions[index], self.rgb[index]
+
+    def __len__(self) -> int:
+        return len(self.pose_indices)
+
+    def human_pose(self, index: int) -> np.array:
+        """
+        Returns the human pose (69, ) of the image the ray with the given index belongs to.
+        """
+        return self.poses[self.pose_indices[index]]
+
+    @staticmethod
+    def default_directory(transforms_file: str) -> str:
+        return os.path.join(os.path.dirname(os.path.abspath(transforms_file)), RAY_STORE_DIRECTORY)
+
+    @staticmethod
+    def source_signature(image_directory: str, transforms_file: str) -> dict:
+        """
+        Cheap signature of the data a store was packed from, used to detect stale stores.
+        """
+        image_paths = sorted(glob.glob(os.path.join(image_directory, '*.png')))
+        transforms_stat = os.stat(transforms_file)
+        return {'transforms_mtime': transforms_stat.st_mtime,
+                'transforms_size': transforms_stat.st_size,
+                'image_names': [os.path.basename(image_path) for image_path in image_paths]}
+
+    @staticmethod
+    def is_current(store_directory: str, image_directory: str, transforms_file: str) -> bool:
+        header_path = os.path.join(store_directory, RAY_STORE_HEADER)
+        if not os.path.exists(header_path):
+            return False
+        with open(header_path, 'r') as header_file:
+            header = json.load(header_file)
+        return header.get('version') == RAY_STORE_VERSION and \
+               header.get('source') == RayStore.source_signature(image_directory, transforms_file)
+
+    @classmethod
+    def open(cls, image_directory: str, transforms_file: str, store_directory: str = None):
+        """
+        Open the store next to transforms_file and pack it first if it does not exist or is outdated.
+        Concurrent processes wait for the one that packs the store.
+        """
+        if store_directory is None:
+            store_directory = cls.default_directory(transforms_file)
+        if not cls.is_current(store_directory, image_directory, transforms_file):
+            with store_lock(store_directory):
+                # another process may have packed the store while this one waited for the lock
+                if not cls.is_current(store_directory, image_directory, transforms_file):
+                    temporary_directory = cls.write(image_directory, transforms_file, store_directory)
+                    cls.install(temporary_directory, store_directory, image_directory, transforms_file)
+        return cls(store_directory)
+
+    @staticmethod
+    def pack(image_directory: str, transforms_file: str, store_directory: str = None) -> str:
+        """
+        Decode all images, compute their rays and write them image by image into
+        memory-mapped arrays. The store is written to a temporary directory and
+        moved into place once it is complete.
+
+        Parameters
+        ----------
+        image_directory : str
+            Path to images.
+        transforms_file : str
+            File path to file containing transformation mappings.
+        store_directory : str, optional
+            Target directory. The default is a directory 'ray_store' next to transforms_file.
+
+        Returns
+        -------
+        store_directory : str
+            Directory of the packed store.
+        """
+        if store_directory is None:
+            store_directory = RayStore.default_directory(transforms_file)
+        temporary_directory = RayStore.write(image_directory, transforms_file, store_directory)
+        with store_lock(store_directory):
+            RayStore.install(temporary_directory, store_directory, image_directory, transforms_file)
+        return store_directory
+
+    @staticmethod
+    def write(image_directory: str, transforms_file: str, store_directory: str) -> str:
+        """
+        Packs the store into a temporary directory next to store_directory and returns it.
+        """
+        print('Start packing rays into ', store_directory)
+        with open(transforms_file, 'r') as file:
+            transforms_dict = json.load(file)
+        camera_angle_x = transforms_dict['camera_angle_x']
+        image_transform_map = transforms_dict.get('image_transform_map')
+        image_pose_map = transforms_dict.get('image_pose_map')
+        image_paths = sorted(glob.glob(os.path.join(image_directory, '*.png')))
+        if not len(image_paths) == len(image_transform_map):
+            raise ValueError('Number of images in image_directory is not the same as number of transforms')
+        h, w = cv2.imread(image_paths[0]).shape[:2]
+        focal = .5 * w / np.tan(.5 * camera_angle_x)
+        number_rays = len(image_paths) * h * w
+
+        temporary_directory = store_directory + '.tmp-' + str(os.getpid())
+        if os.path.exists(temporary_directory):
+            shutil.rmtree(temporary_directory)
+        os.makedirs(temporary_directory)
+        open_memmap = np.lib.format.open_memmap
+        translations = open_memmap(os.path.join(temporary_directory, 'translations.npy'), mode='w+',
+                                   dtype=np.float32, shape=(number_rays, 3))
+        directions = open_memmap(os.path.join(temporary_directory, 'directions.npy'), mode='w+',
+                                 dtype=np.float32, shape=(number_rays, 3))
+        rgb = open_memmap(os.path.join(temporary_directory, 'rgb.npy'), mode='w+',
+                          dtype=np.uint8, shape=(number_rays, 3))
+        pose_indices = open_memmap(os.path.join(temporary_directory, 'pose_indices.npy'), mode='w+',
+                                   dtype=np.int32, shape=(number_rays,))
+        poses = []
+        for i, image_path in enumerate(image_paths):
+            image_name = os.path.basename(image_path)
+            camera_transform = np.array(image_transform_map[image_name])
+            image = cv2.imread(image_path)
+            if image.shape[:2] != (h, w):
+                raise ValueError('All images of a ray store need to have the same size')
+            rays_translation, rays_direction = get_rays(h, w, focal, camera_transform)
+            image_slice = slice(i * h * w, (i + 1) * h * w)
+            translations[image_slice] = rays_translation.reshape(-1, 3)
+            directions[image_slice] = rays_direction.reshape(-1, 3)
+            rgb[image_slice] = image.reshape(-1, 3)
+            pose_indices[image_slice] = i
+            if image_pose_map is not None:
+                poses.append(image_pose_map[image_name])
+        for array in [translations, directions, rgb, pose_indices]:
+            array.flush()
+        del translations, directions, rgb, pose_indices
+        if image_pose_map is not None:
+            np.save(os.path.join(temporary_directory, 'poses.npy'), np.array(poses, dtype=np.float32))
+
+        header = {'version': RAY_STORE_VERSION,
+                  'number_rays': number_rays,
+                  'number_images': len(image_paths),
+                  'h': h,
+                  'w': w,
+                  'focal': focal,
+                  'camera_angle_x': camera_angle_x,
+                  'image_names': [os.path.basename(image_path) for image_path in image_paths],
+                  'source': RayStore.source_signature(image_directory, transforms_file)}
+        with open(os.path.join(temporary_directory, RAY_STORE_HEADER), 'w') as header_file:
+            json.dump(header, header_file)
+        print('Finish packing ', number_rays, ' rays')
+        return temporary_directory
+
+    @staticmethod
+    def install(temporary_directory: str, store_directory: str, image_directory: str, transforms_file: str):
+        """
+        Moves a packed temporary directory into place, has to be called with the store_lock held.
+        If another process already installed a current store, it is kept and the
+        temporary directory is discarded, so a store is never deleted while it is read.
+        """
+        if RayStore.is_current(store_directory, image_directory, transforms_file):
+            shutil.rmtree(temporary_directory)
+            return
+        if os.path.exists(store_directory):
+            shutil.rmtree(store_directory)
+        os.replace(temporary_directory, store_directory)
+
+
+def config_parser():
+    """
+    Configuration parser for packing ray stores.
+
+    """
+    parser = configargparse.ArgumentParser()
+    parser.add_argument('--dataset_dir', default='data', type=str, help='directory with specific dataset structure')
+    parser.add_argument('--splits', action='append', default=[], help='splits to pack (default: train and val)')
+    return parser
+
+
+if __name__ == '__main__':
+    args = config_parser().parse_args()
+    for split in args.splits or ['train', 'val']:
+        split_dir = os.path.join(args.dataset_dir, split)
+        RayStore.pack(split_dir, os.path.join(split_dir, 'transforms.json'))
@@ -4,8 +4,12 @@ import json
 
 import cv2
 import numpy as np
+import torch
 from torch.utils.data import Dataset
 
+from datasets.ray_store import RayStore
+from datasets.ray_arrays import RayArrays
+from datasets.ray_batch_loader import gather_rays
 from utils import get_rays
 
 
@@ -16,7 +20,7 @@ class RaysFromImagesDataset(Dataset):
     """
 
     def __init__(self, image_directory: str, transforms_file: str,
-                 transform) -> None:
+                 transform, use_ray_store: bool = False) -> None:
         """
         Parameters
         ----------
@@ -26,15 +30,22 @@ class RaysFromImagesDataset(Dataset):
             File path to file containing transformation mappings.
         transform :
             List of callable transforms for preprocessing.
+        use_ray_store : bool, optional
+            If True, the rays are memory-mapped from the RayStore next to the
+            transforms file (packed on first use). The default is False.
         """
         super().__init__()
         self.transform = transform
-        self.rays = []  # list of arrays with ray translation, ray direction and rgb
-        print('Start initializing all rays of all images')
-        with open(transforms_file, 'r') as transforms_file:
-            transforms_dict = json.load(transforms_file)
+        self.rays = RayArrays()  # ray translation, ray direction and rgb
+        with open(transforms_file, 'r') as file:
+            transforms_dict = json.load(file)
         camera_angle_x = transforms_dict['camera_angle_x']
         self.image_transform_map = transforms_dict.get('image_transform_map')
+        if use_ray_store:
+            self.rays = RayStore.open(image_directory, transforms_file)
+            self.h, self.w, self.focal = self.rays.h, self.rays.w, self.rays.focal
+            return
+        print('Start initializing all rays of all images')
         image_paths = sorted(glob.glob(os.path.join(image_directory, '*.png')))
         if not len(image_paths) == len(self.image_transform_map):
             raise ValueError('Number of images in image_directory is not the same as number of transforms')
@@ -45,11 +56,8 @@ class RaysFromImagesDataset(Dataset):
             self.focal = .5 * self.w / np.tan(.5 * camera_angle_x)
             rays_translation, rays_direction = get_rays(self.h, self.w, self.focal,
                                                         camera_transform)
-            trans_dir_rgb_stack = np.stack([rays_translation, rays_direction, image], -2)
-            trans_dir_rgb_list = trans_dir_rgb_stack.reshape((-1, 3, 3))
-            self.rays.append(trans_dir_rgb_list)
-        if self.rays:
-            self.rays = np.concatenate(self.rays)
+            self.rays.append(rays_translation, rays_direction, image)
+        self.rays.concatenate()
         print('Finish initializing rays')
 
     def __getitem__(self, index: int):
@@ -78,5 +86,25 @@ class RaysFromImagesDataset(Dataset):
 
         return ray_samples, samples_translations, samples_directions, z_vals, rgb
 
+    def get_batch(self, indices: torch.Tensor):
+        """
+        Vectorised version of __getitem__ without coarse sampling, used by RayBatchLoader.
+
+        Parameters
+        ----------
+        indices : torch.Tensor ([batch_size])
+            Indices of rays.
+
+        Returns
+        -------
+        rays_translation : torch.Tensor ([batch_size, 3])
+            Translation of rays.
+        rays_direction : torch.Tensor ([batch_size, 3])
+            Direction of rays.
+        rgb : torch.Tensor ([batch_size, 3])
+            RGB values (uint8) corresponding to rays.
+        """
+        return list(gather_rays(self.rays, indices))
+
     def __len__(self) -> int:
         return len(self.rays)
@@ -8,6 +8,7 @@ import torch
 from torch.distributions import MultivariateNormal
 from torch.utils.data import Dataset
 
+from datasets.ray_arrays import RayArrays
 from utils import get_rays
 import smplx
 from render import get_smpl_vertices
@@ -35,8 +36,8 @@ class SmplDataset(Dataset):
         super().__init__()
         self.args = args
         self.transform = transform
-        self.rays = []  # list of arrays with ray translation, ray direction and rgb
-        self.human_poses = []  # list of corresponding human poses
+        self.rays = RayArrays()  # ray translation, ray direction and rgb
+        self.human_poses = []  # human pose of every image
         self.depth = []
         self.warp = []
 
@@ -68,16 +69,15 @@ class SmplDataset(Dataset):
             self.focal = .5 * self.w / np.tan(.5 * camera_angle_x)
             rays_translation, rays_direction = get_rays(self.h, self.w, self.focal, camera_transform)
 
-            trans_dir_rgb_stack = np.stack([rays_translation, rays_direction, image], -2)  # [h x w x 3 x 3]
-            trans_dir_rgb_list = trans_dir_rgb_stack.reshape((-1, 3, 3))
-            self.human_poses.append(np.repeat(human_pose[np.newaxis, :], trans_dir_rgb_list.shape[0], axis=0))
-            self.rays.append(trans_dir_rgb_list)
+            self.human_poses.append(human_pose)
+            self.rays.append(rays_translation, rays_direction, image)
 
-            self.depth.append(depth.reshape((trans_dir_rgb_list.shape[0], 1)))
-            self.warp.append(warp.reshape((trans_dir_rgb_list.shape[0], 3)))
+            self.depth.append(depth.reshape((self.h * self.w, 1)).astype(np.float32))
+            self.warp.append(warp.reshape((self.h * self.w, 3)).astype(np.float32))
 
-        self.rays = np.concatenate(self.rays)
-        self.human_poses = np.concatenate(self.human_poses)
+        self.rays.concatenate()
+        self.human_poses = np.array(self.human_poses, dtype=np.float32)  # [number_images, 69]
+        self.image_indices = self.rays.image_indices  # index of the image (and human pose) of every ray
         self.warp = np.concatenate(self.warp)
         self.depth = np.concatenate(self.depth)
         self.canonical_smpl = get_smpl_vertices(self.betas, self.expression)
@@ -121,7 +121,7 @@ class SmplDataset(Dataset):
         sample_translation, sample_direction, rgb = self.transform((ray_translation, ray_direction, rgb))
         return torch.Tensor(ray_sample).float(), torch.Tensor(sample_translation).float(), torch.Tensor(
             sample_direction).float(),torch.Tensor(
-            self.human_poses[index]).float(), torch.Tensor(
+            self.human_poses[self.image_indices[index]]).float(), torch.Tensor(
             self.warp[index]).float(), torch.Tensor(rgb).float()
 
     def __len__(self) -> int:
@@ -8,6 +8,9 @@ import torch
 from torch.distributions import MultivariateNormal
 from torch.utils.data import Dataset
 
+from datasets.ray_arrays import RayArrays
+from datasets.ray_batch_loader import gather_rays
+from datasets.ray_store import RayStore
 from utils import get_rays
 import smplx
 from render import get_smpl_vertices
@@ -21,7 +24,7 @@ class SmplNerfDataset(Dataset):
     """
 
     def __init__(self, image_directory: str, transforms_file: str,
-                 transform) -> None:
+                 transform, use_ray_store: bool = False) -> None:
         """
         Parameters
         ----------
@@ -31,19 +34,32 @@ class SmplNerfDataset(Dataset):
             File path to file containing transformation mappings.
         transform :
             List of callable transforms for preprocessing.
+        use_ray_store : bool, optional
+            If True, the rays and poses are memory-mapped from the RayStore next
+            to the transforms file (packed on first use). The default is False.
         """
         super().__init__()
         self.transform = transform
-        self.rays = []  # list of arrays with ray translation, ray direction and rgb
-        self.human_poses = []  # list of corresponding human poses
-        print('Start initializing all rays of all images')
-        with open(transforms_file, 'r') as transforms_file:
-            transforms_dict = json.load(transforms_file)
+        self.rays = RayArrays()  # ray translation, ray direction and rgb
+        self.human_poses = []  # human pose of every image
+        self.ray_store = None
+        with open(transforms_file, 'r') as file:
+            transforms_dict = json.load(file)
         camera_angle_x = transforms_dict['camera_angle_x']
         self.image_transform_map = transforms_dict.get('image_transform_map')
         image_pose_map = transforms_dict.get('image_pose_map')
+        self.image_pose_map = image_pose_map
         self.expression = [transforms_dict['expression']]
         self.betas = [transforms_dict['betas']]
+        self.canonical_smpl = get_smpl_vertices(self.betas, self.expression)
+        if use_ray_store:
+            self.ray_store = RayStore.open(image_directory, transforms_file)
+            self.rays = self.ray_store
+            self.human_poses = self.ray_store.poses
+            self.image_indices = self.ray_store.pose_indices
+            self.h, self.w, self.focal = self.ray_store.h, self.ray_store.w, self.ray_store.focal
+            return
+        print('Start initializing all rays of all images')
         image_paths = sorted(glob.glob(os.path.join(image_directory, '*.png')))
         if not len(image_paths) == len(self.image_transform_map):
             raise ValueError('Number of images in image_directory is not the same as number of transforms')
@@ -58,13 +74,11 @@ class SmplNerfDataset(Dataset):
             self.focal = .5 * self.w / np.tan(.5 * camera_angle_x)
             rays_translation, rays_direction = get_rays(self.h, self.w, self.focal, camera_transform)
 
-            trans_dir_rgb_stack = np.stack([rays_translation, rays_direction, image], -2)
-            trans_dir_rgb_list = trans_dir_rgb_stack.reshape((-1, 3, 3))
-            self.human_poses.append(np.repeat(human_pose[np.newaxis, :], trans_dir_rgb_list.shape[0], axis=0))
-            self.rays.append(trans_dir_rgb_list)
-        self.rays = np.concatenate(self.rays)
-        self.human_poses = np.concatenate(self.human_poses)
-        self.canonical_smpl = get_smpl_vertices(self.betas, self.expression)
+            self.human_poses.append(human_pose)
+            self.rays.append(rays_translation, rays_direction, image)
+        self.rays.concatenate()
+        self.human_poses = np.array(self.human_poses, dtype=np.float32)  # [number_images, 69]
+        self.image_indices = self.rays.image_indices  # index of the image (and human pose) of every ray
         print('Finish initializing rays')
 
     def __getitem__(self, index: int):
@@ -97,8 +111,33 @@ class SmplNerfDataset(Dataset):
         ray_samples, samples_translations, samples_directions, z_vals, rgb = self.transform(
             (rays_translation, rays_direction, rgb))
 
+        human_pose = self.human_poses[self.image_indices[index]]
         return ray_samples, samples_translations, samples_directions, z_vals, torch.Tensor(
-            self.human_poses[index]).float(), rgb
+            human_pose).float(), rgb
+
+    def get_batch(self, indices: torch.Tensor):
+        """
+        Vectorised version of __getitem__ without coarse sampling, used by RayBatchLoader.
+
+        Parameters
+        ----------
+        indices : torch.Tensor ([batch_size])
+            Indices of rays.
+
+        Returns
+        -------
+        rays_translation : torch.Tensor ([batch_size, 3])
+            Translation of rays.
+        rays_direction : torch.Tensor ([batch_size, 3])
+            Direction of rays.
+        human_poses : torch.Tensor ([batch_size, 69])
+            Goal poses.
+        rgb : torch.Tensor ([batch_size, 3])
+            RGB values corresponding to rays.
+        """
+        rays_translation, rays_direction, rgb = gather_rays(self.rays, indices)
+        human_poses = self.human_poses[self.image_indices[indices.numpy()]]
+        return [rays_translation, rays_direction, torch.from_numpy(human_poses), rgb]
 
     def __len__(self) -> int:
         return len(self.rays)
@@ -40,7 +40,7 @@ class CoarseSampling():
     Coarse sampling along a ray
     """
 
-    def __init__(self, near: int, far: int, number_samples: int = 64):
+    def __init__(self, near: int, far: int, number_samples: int = 64, perturb_per_bin: bool = False):
         """
         Parameters
         ----------
@@ -50,10 +50,30 @@ class CoarseSampling():
             Far bound for coarse sampling.
         number_samples : int, optional
             Number of coarse samples along the ray. The default is 64.
+        perturb_per_bin : bool, optional
+            Draw an independent random offset for every bin instead of one
+            offset shared by all bins of a ray. The default is False.
         """
         self.near = near
         self.far = far
         self.number_samples = number_samples
+        self.perturb_per_bin = perturb_per_bin
+        # the bins along the ray are the same for every ray, so they are only computed once
+        t_vals = np.linspace(0., 1., self.number_samples)
+        z_vals = 1. / (1. / self.near * (1. - t_vals) + 1. / self.far * (t_vals))
+        mids = .5 * (z_vals[1:] + z_vals[:-1])
+        self.upper = np.concatenate([mids, z_vals[-1:]], -1)
+        self.lower = np.concatenate([z_vals[:1], mids], -1)
+        self.bins_on_device = {}
+
+    def bins(self, device):
+        """
+        Lower and upper bounds of the bins as float32 torch.Tensor ([number_samples]) on the given device.
+        """
+        if device not in self.bins_on_device:
+            self.bins_on_device[device] = (torch.tensor(self.lower, dtype=torch.float32, device=device),
+                                           torch.tensor(self.upper, dtype=torch.float32, device=device))
+        return self.bins_on_device[device]
 
     def __call__(self, ray):
         """
@@ -78,17 +98,52 @@ class CoarseSampling():
             RGB values corresponding to ray.
         """
         ray_translation, ray_direction, rgb = ray
-        # get bins along the ray
-        t_vals = np.linspace(0., 1., self.number_samples)
-        z_vals = 1. / (1. / self.near * (1. - t_vals) + 1. / self.far * (t_vals))
-        mids = .5 * (z_vals[1:] + z_vals[:-1])
-        upper = np.concatenate([mids, z_vals[-1:]], -1)
-        lower = np.concatenate([z_vals[:1], mids], -1)
         # get coarse samples in each bin of the ray
-        z_vals = lower + (upper - lower) * np.random.rand()
+        if self.perturb_per_bin:
+            z_vals = self.lower + (self.upper - self.lower) * np.random.rand(self.number_samples)
+        else:
+            z_vals = self.lower + (self.upper - self.lower) * np.random.rand()
         ray_samples = ray_translation[None, :] + ray_direction[None, :] * z_vals[:, None]  # [N_samples, 3]
         return ray_samples, ray_translation, ray_direction, z_vals, rgb
 
+    def sample_batch(self, rays_translation: torch.Tensor, rays_direction: torch.Tensor):
+        """
+        Performs coarse sampling on a whole batch of rays in torch on the device of the rays
+
+        Parameters
+        ----------
+        rays_translation : torch.Tensor ([batch_size, 3])
+            Translation of rays.
+        rays_direction : torch.Tensor ([batch_size, 3])
+            Direction of rays.
+
+        Returns
+        -------
+        ray_samples : torch.Tensor ([batch_size, number_samples, 3])
+            Coarse samples along the rays between near and far bound.
+        z_vals : torch.Tensor ([batch_size, number_samples])
+            Depth of coarse samples along rays.
+        """
+        lower, upper = self.bins(rays_translation.device)
+        if self.perturb_per_bin:
+            jitter = torch.rand(len(rays_translation), self.number_samples, device=rays_translation.device)
+        else:
+            jitter = torch.rand(len(rays_translation), 1, device=rays_translation.device)
+        z_vals = lower + (upper - lower) * jitter
+        ray_samples = rays_translation[:, None, :] + rays_direction[:, None, :] * z_vals[..., None]
+        return ray_samples, z_vals
+
+    def sample_data(self, data):
+        """
+        Coarse samples a batch of plain rays [rays_translation, rays_direction, *extras, rgb]
+        and returns it in the layout of the ray datasets
+        [ray_samples, rays_translation, rays_direction, z_vals, *extras, rgb].
+        """
+        rays_translation, rays_direction = data[0], data[1]
+        ray_samples, z_vals = self.sample_batch(rays_translation, rays_direction)
+        return [ray_samples, rays_translation, rays_direction, z_vals] + list(data[2:])
+
+
 class NormalizeRGBImage():
     """
     Normalize RGB image to [0, 1]
@@ -8,11 +8,12 @@ import numpy as np
 import torch
 from torch.distributions import MultivariateNormal, MixtureSameFamily
 from torch.utils.data import Dataset
-from trimesh.ray.ray_triangle import RayMeshIntersector
 
-from utils import get_rays
+from datasets.ray_arrays import RayArrays
+from util.ray_mesh_bvh import BVHIntersector
+from utils import get_rays, intersection_z_vals
 import smplx
-from render import get_smpl_vertices, get_smpl_mesh
+from render import get_smpl_vertices, get_smpl_vertices_batch, get_smpl_mesh
 import torch.distributions as D
 from tqdm import tqdm
 
@@ -58,17 +59,19 @@ class VertexSphereDataset(Dataset):
         # get coarse samples in each bin of the ray
         z_vals_simple = torch.from_numpy(lower + (upper - lower) * np.random.rand())
 
-        self.rays_samples = []  # list of arrays with ray translation, ray direction and rgb
-        self.rays = []
+        self.rays_samples = []
+        self.rays = RayArrays()  # ray translation, ray direction and rgb
         self.all_warps = []
         self.all_z_vals = []
+        # pose the goal smpls of all images in one batch
+        goal_smpls = get_smpl_vertices_batch([image_pose_map[os.path.basename(image_path)]
+                                              for image_path in image_paths], self.betas, self.expression)
         for i, image_path in enumerate(tqdm(image_paths, desc='Images', leave=False)):
             camera_transform = np.array(image_transform_map[os.path.basename(image_path)])
             goal_pose = torch.tensor(image_pose_map[os.path.basename(image_path)])
 
             image = cv2.imread(image_path)
             self.h, self.w = image.shape[:2]
-            image = (torch.tensor(image).double() / 255.).view(-1, 3)
 
             # should we append a list of the different h, w of all images? right now referencing only the last h, w
             self.focal = .5 * self.w / np.tan(.5 * camera_angle_x)
@@ -77,49 +80,15 @@ class VertexSphereDataset(Dataset):
                                                                                 3)  # copy because array not writable
             rays_direction = torch.from_numpy(rays_direction).view(-1, 3)
             rays_direction = rays_direction / np.linalg.norm(rays_direction, axis=-1, keepdims=True)
-            translation_direction_rgb_stack = torch.stack(
-                [rays_translation, rays_direction, image], -2)
 
             # either get z_vals (and therefore coarse samples) or get z_vals from gaussian mixture if ray intersects with goal_smpl
             goal_mesh = get_smpl_mesh(body_pose=goal_pose[None, :], return_pyrender=False)
-            intersector = RayMeshIntersector(goal_mesh)
-            z_vals_image = []
-            for ray_index in range(len(rays_translation)):
-                intersections = intersector.intersects_location([rays_translation.numpy()[ray_index]],
-                                                                [rays_direction.numpy()[ray_index]])
-                canonical_intersections_points = torch.from_numpy(intersections[0])  # (N_intersects, 3)
-                if args.number_coarse_samples == 1:
-                    if len(canonical_intersections_points) == 0:
-                        z_vals = torch.DoubleTensor([args.far])[0]  # [1]
-                    else:
-                        distances_camera = torch.norm(canonical_intersections_points - rays_translation[ray_index],
-                                                      dim=1)
-                        z_vals = torch.min(distances_camera)  # [1]
-                elif args.coarse_samples_from_intersect == 1:
-                    if len(canonical_intersections_points) == 0:
-                        z_vals = z_vals_simple
-                    else:
-                        distances_camera = torch.norm(canonical_intersections_points - rays_translation[ray_index],
-                                                      dim=1)
-                        mean = torch.min(distances_camera)
-                        gauss = D.Normal(mean,
-                                         torch.ones_like(mean) * args.std_dev_coarse_sample_prior)
-                        z_vals, _ = torch.sort(gauss.sample((args.number_coarse_samples,)))
-                elif len(canonical_intersections_points) == 0 or args.coarse_samples_from_prior != 1:
-                    z_vals = z_vals_simple
-                else:
-                    mix = D.Categorical(torch.ones(len(canonical_intersections_points), ))
-                    means = torch.norm(canonical_intersections_points - rays_translation[ray_index], dim=-1)
-                    comp = D.Normal(means, torch.ones_like(means) * args.std_dev_coarse_sample_prior)
-                    gmm = MixtureSameFamily(mix, comp)
-                    z_vals = gmm.sample((args.number_coarse_samples,))
-                z_vals_image.append(z_vals)
-            z_vals_image = torch.stack(z_vals_image)  # [h*w, number_coarse_samples]
-            if args.number_coarse_samples == 1:
-                z_vals_image = z_vals_image.view(-1, 1)
+            intersector = BVHIntersector(goal_mesh)
+            z_vals_image = intersection_z_vals(intersector, rays_translation.numpy(), rays_direction.numpy(),
+                                               z_vals_simple, args)  # [h*w, number_coarse_samples]
             rays_samples = rays_translation[:, None, :] + rays_direction[:, None, :] * z_vals_image[:, :,
                                                                                        None]  # [h*w, number_coarse_samples, 3]
-            goal_smpl = torch.from_numpy(get_smpl_vertices(self.betas, self.expression, body_pose=goal_pose[None, :]))
+            goal_smpl = torch.from_numpy(goal_smpls[i])
             warps_of_image = []
 
             rays_samples = rays_samples.to(device)
@@ -160,14 +129,15 @@ class VertexSphereDataset(Dataset):
             warps_of_image = torch.stack(warps_of_image, -2).cpu()  # [h*w, number_samples, 3]
             rays_samples = rays_samples.cpu()
 
-            self.all_z_vals.append(z_vals_image)
-            self.rays_samples.append(rays_samples)
-            self.all_warps.append(warps_of_image)
-            self.rays.append(translation_direction_rgb_stack)
+            # stored as float32 instead of float64
+            self.all_z_vals.append(z_vals_image.float())
+            self.rays_samples.append(rays_samples.float())
+            self.all_warps.append(warps_of_image.float())
+            self.rays.append(rays_translation.numpy(), rays_direction.numpy(), image)
         self.all_z_vals = torch.cat(self.all_z_vals)
         self.rays_samples = torch.cat(self.rays_samples)
         self.all_warps = torch.cat(self.all_warps)
-        self.rays = torch.cat(self.rays)
+        self.rays.concatenate()
 
         print('Finish initializing rays')
 
@@ -197,9 +167,8 @@ class VertexSphereDataset(Dataset):
 
         ray_translation, ray_direction, rgb = self.rays[index]
 
-        return self.rays_samples[
-                   index].float(), ray_translation.float(), ray_direction.float(), self.all_z_vals[index].float(), \
-               self.all_warps[index].float(), rgb.float()
+        return self.rays_samples[index], torch.from_numpy(ray_translation), torch.from_numpy(ray_direction), \
+               self.all_z_vals[index], self.all_warps[index], torch.from_numpy(rgb).float() / 255.
 
     def __len__(self) -> int:
         return len(self.rays)
@@ -25,11 +25,15 @@ from models.vertex_sphere_pipeline import VertexSpherePipeline
 from datasets.smpl_nerf_dataset import SmplNerfDataset
 from datasets.rays_from_images_dataset import RaysFromImagesDataset
 from datasets.single_sample_dataset import SmplDataset
+from datasets.ray_batch_loader import normalize_rgb
 from datasets.transforms import CoarseSampling, ToTensor, NormalizeRGB
 
-from utils import PositionalEncoder
+from utils import PositionalEncoder, MemoisedPositionalEncoder
 import create_dataset
 
+from util.cpu_threads import configure_threads
+from util.occupancy_grid import occupancy_grid_from_dataset
+from util.render_image import render_image
 from util.scores import print_scores
 
 def inference_gif(run_dir, model_type, args, train_data, val_data, position_encoder, direction_encoder, model_coarse, model_fine, model_dependent):
@@ -82,13 +86,19 @@ def inference_gif(run_dir, model_type, args, train_data, val_data, position_enco
         pipeline = VertexSpherePipeline(model_coarse, model_fine, args, position_encoder, direction_encoder)
 
 
-    for i, data in enumerate(data_loader):
-        for j, element in enumerate(data):
-            data[j] = element.to(device)
-        rgb_truth = data[-1]
-        out = pipeline(data)
-        rgb_fine = out[1]
-        rgb_images.append(rgb_fine.detach().cpu().numpy())
+    if isinstance(pipeline, NerfPipeline):
+        for split_data in [train_data, val_data]:
+            renders, _ = render_dataset(pipeline, split_data, getattr(args, 'inf_chunk', None),
+                                        getattr(args, 'inf_transmittance_threshold', None) or None)
+            rgb_images.append(renders.reshape(-1, 3).numpy())
+    else:
+        for i, data in enumerate(data_loader):
+            for j, element in enumerate(data):
+                data[j] = element.to(device)
+            rgb_truth = data[-1]
+            out = pipeline(data)
+            rgb_fine = out[1]
+            rgb_images.append(rgb_fine.detach().cpu().numpy())
 
     # sort according to names in train, val directories
     split_indices = args_create_data.train_index + args_create_data.val_index
@@ -142,7 +152,7 @@ def setup_pipeline_dataloader(args_training, device):
                                                'transforms.json'), transform)
         data_loader = torch.utils.data.DataLoader(dataset, batch_size=args_training.batchsize, shuffle=False,
                                                   num_workers=0)
-        human_pose_encoder = PositionalEncoder(args_training.number_frequencies_pose, args_training.use_identity_pose)
+        human_pose_encoder = MemoisedPositionalEncoder(args_training.number_frequencies_pose, args_training.use_identity_pose)
         positions_dim = position_encoder.output_dim if args_training.human_pose_encoding else 1
         human_pose_dim = human_pose_encoder.output_dim if args_training.human_pose_encoding else 1
         model_warp_field = WarpFieldNet(args_training.netdepth_warp, args_training.netwidth_warp, positions_dim * 3,
@@ -152,7 +162,7 @@ def setup_pipeline_dataloader(args_training, device):
         pipeline = SmplNerfPipeline(model_coarse, model_fine, model_warp_field,
                                     args_training, position_encoder, direction_encoder, human_pose_encoder)
     elif args_training.inf_model_type == "append_to_nerf":
-        human_pose_encoder = PositionalEncoder(args_training.number_frequencies_pose, args_training.use_identity_pose)
+        human_pose_encoder = MemoisedPositionalEncoder(args_training.number_frequencies_pose, args_training.use_identity_pose)
         human_pose_dim = human_pose_encoder.output_dim if args_training.human_pose_encoding else 1
         model_coarse = RenderRayNet(args_training.netdepth, args_training.netwidth, position_encoder.output_dim * 3,
                                     direction_encoder.output_dim * 3, human_pose_dim * 2,
@@ -174,12 +184,12 @@ def setup_pipeline_dataloader(args_training, device):
                                                'transforms.json'), transform)
         data_loader = torch.utils.data.DataLoader(dataset, batch_size=args_training.inf_batchsize, shuffle=False,
                                                   num_workers=0)
-        human_pose_encoder = PositionalEncoder(args_training.number_frequencies_pose, args_training.use_identity_pose)
+        human_pose_encoder = MemoisedPositionalEncoder(args_training.number_frequencies_pose, args_training.use_identity_pose)
         pipeline = AppendToNerfPipeline(model_coarse, model_fine, args_training, position_encoder, direction_encoder,
                                         human_pose_encoder)
     elif args_training.inf_model_type == "append_smpl_params":
         print("Use directional input: ", args_training.use_directional_input)
-        human_pose_encoder = PositionalEncoder(args_training.number_frequencies_pose, args_training.use_identity_pose)
+        human_pose_encoder = MemoisedPositionalEncoder(args_training.number_frequencies_pose, args_training.use_identity_pose)
         human_pose_dim = human_pose_encoder.output_dim if args_training.human_pose_encoding else 1
         model_coarse = RenderRayNet(args_training.netdepth, args_training.netwidth, position_encoder.output_dim * 3,
                                     direction_encoder.output_dim * 3, human_pose_dim * 69,
@@ -217,8 +227,48 @@ def setup_pipeline_dataloader(args_training, device):
         data_loader = torch.utils.data.DataLoader(dataset, batch_size=args_training.batchsize, shuffle=False,
                                                   num_workers=0)
         pipeline = NerfPipeline(model_coarse, model_fine, args_training, position_encoder, direction_encoder)
+    if args_training.occupancy_grid and isinstance(pipeline, NerfPipeline):
+        pipeline.occupancy_grid = occupancy_grid_from_dataset(dataset, args_training.occupancy_grid_margin,
+                                                              args_training.occupancy_grid_resolution)
     return pipeline, data_loader, dataset
 
+def render_dataset(pipeline, dataset, chunk=None, transmittance_threshold=None):
+    """
+    Renders every image of a ray dataset (in the order of its rays) with
+    render_image, so only one chunk of rays is evaluated at a time.
+
+    Parameters
+    ----------
+    pipeline : NerfPipeline
+        Pipeline that is rendered.
+    dataset : RaysFromImagesDataset or SmplNerfDataset
+        Dataset that provides the cameras, poses and ground truth.
+    chunk : int, optional
+        Number of rays rendered at once. The default is None (chosen from the free memory).
+    transmittance_threshold : float, optional
+        Rays are terminated once their transmittance is below this threshold
+        (see render_rays_early_termination). The default is None (no early termination).
+
+    Returns
+    -------
+    renders : torch.Tensor ([number_images, h, w, 3])
+        Rendered images.
+    truths : torch.Tensor ([number_images, h, w, 3])
+        Ground truth images.
+    """
+    number_pixels = dataset.h * dataset.w
+    camera_transforms = [dataset.image_transform_map[name] for name in sorted(dataset.image_transform_map)]
+    renders = torch.empty(len(camera_transforms), dataset.h, dataset.w, 3, device='cpu')
+    truths = torch.empty_like(renders)
+    for i, camera_transform in enumerate(tqdm(camera_transforms)):
+        rays = dataset.get_batch(torch.arange(i * number_pixels, (i + 1) * number_pixels, device='cpu'))
+        pose = rays[2][0] if len(rays) == 4 else None
+        renders[i] = render_image(pipeline, np.array(camera_transform), dataset.h, dataset.w, dataset.focal, pose,
+                                  chunk, transmittance_threshold=transmittance_threshold)
+        truths[i] = normalize_rgb(rays[-1]).view(dataset.h, dataset.w, 3)
+    return renders, truths
+
+
 def inference():
     parser_training = config_parser()
     parser_training.add_argument('--inf_run_dir', default="runs/Aug25_08-40-13_korhal", help='path to load model')
@@ -230,6 +280,11 @@ def inference():
                         help='save directory for inference output (appended to run_dir')
     parser_training.add_argument('--inf_batchsize', default=800, type=int,
                         help='Batch size for inference')
+    parser_training.add_argument('--inf_chunk', default=0, type=int,
+                        help='Number of rays rendered at once per image, 0 chooses it from the free memory')
+    parser_training.add_argument('--inf_transmittance_threshold', default=0., type=float,
+                        help='Stop evaluating the samples of a ray once its transmittance is below this threshold '
+                             '(e.g. 1e-3), 0 renders all samples')
     #config_file_training = os.path.join(args_training.inf_run_dir, "config.txt")
     #parser_training.add_argument('--config2', is_config_file=True,
     #                 default=config_file_training, help='config file path')
@@ -238,22 +293,27 @@ def inference():
     print("On data: ", args_training.inf_ground_truth_dir)
     print("Experiment: ", args_training.experiment_name)
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    configure_threads(args_training)
     if torch.cuda.is_available():
         torch.set_default_tensor_type('torch.cuda.FloatTensor')
     pipeline, data_loader, dataset = setup_pipeline_dataloader(args_training, device)
-    rgb_images_renders = []
-    rgb_images_truth = []
     camera_transforms = dataset.image_transform_map
-    for i, data in enumerate(tqdm(data_loader)):
-        for j, element in enumerate(data):
-            data[j] = element.to(device)
-        rgb_truth = data[-1]
-        out = pipeline(data)
-        rgb_fine = out[1]
-        rgb_images_renders.append(rgb_fine.detach().cpu())
-        rgb_images_truth.append(rgb_truth.detach().cpu())
-    rgb_images_renders = torch.cat(rgb_images_renders).reshape((len(camera_transforms), dataset.h, dataset.w, 3))
-    rgb_images_truth = torch.cat(rgb_images_truth).reshape((len(camera_transforms), dataset.h, dataset.w, 3))
+    if isinstance(pipeline, NerfPipeline):
+        rgb_images_renders, rgb_images_truth = render_dataset(pipeline, dataset, args_training.inf_chunk,
+                                                               args_training.inf_transmittance_threshold or None)
+    else:
+        rgb_images_renders = []
+        rgb_images_truth = []
+        for i, data in enumerate(tqdm(data_loader)):
+            for j, element in enumerate(data):
+                data[j] = element.to(device)
+            rgb_truth = data[-1]
+            out = pipeline(data)
+            rgb_fine = out[1]
+            rgb_images_renders.append(rgb_fine.detach().cpu())
+            rgb_images_truth.append(rgb_truth.detach().cpu())
+        rgb_images_renders = torch.cat(rgb_images_renders).reshape((len(camera_transforms), dataset.h, dataset.w, 3))
+        rgb_images_truth = torch.cat(rgb_images_truth).reshape((len(camera_transforms), dataset.h, dataset.w, 3))
     # calculate scores
     print_scores(rgb_images_renders.permute(0, 3, 1, 2), rgb_images_truth.permute(0, 3, 1, 2))
     # save renders
@@ -1,17 +1,20 @@
 import torch
 
 from models.nerf_pipeline import NerfPipeline
+from util.smpl_vertex_cache import SmplVertexCache
 from utils import PositionalEncoder, raw2outputs, fine_sampling
 
 
 class AppendVerticesPipeline(NerfPipeline):
+    # the nets get warped samples or per sample inputs
+    per_ray_inputs = None
 
     def __init__(self, model_coarse, model_fine, smpl_estimator, smpl_model, args, position_encoder: PositionalEncoder,
                  direction_encoder: PositionalEncoder):
         super(AppendVerticesPipeline, self).__init__(model_coarse, model_fine, args, position_encoder, direction_encoder)
         self.smpl_estimator = smpl_estimator
         self.smpl_model = smpl_model
-        self.global_orient = torch.zeros([1, 3], device=self.device)
+        self.smpl_vertex_cache = SmplVertexCache(smpl_model)
 
     def forward(self, data):
         """
@@ -24,6 +27,7 @@ class AppendVerticesPipeline(NerfPipeline):
             rgb_fine : torch.Tensor ([batch_size, 3])
                 Estimated RGB color with fine net.
             """
+        data = self.coarse_sample(data)
         ray_samples, ray_translation, ray_direction, z_vals, images, rb_truth = data
 
         goal_poses, betas = self.smpl_estimator(images)
@@ -31,13 +35,9 @@ class AppendVerticesPipeline(NerfPipeline):
         # print('expression ', self.smpl_estimator.expression)
         # print('goal_poses', self.smpl_estimator.goal_poses)
 
-        # right now expanding and using self.global_orient_instead of setting the correct batchisze for the smpl model since the same smpl model is used in train and validation with different batch sizes (the batchisze of the smpl_model is 1 by default)
-        global_orient = self.global_orient.expand(len(ray_samples), -1)
-
-        goal_models = self.smpl_model(betas=betas, return_verts=True, body_pose=goal_poses,
-                                      global_orient=global_orient)
-        vertices = goal_models.vertices
-        vertices_flat = vertices.reshape(vertices.shape[0],-1) # [batchsize, 6890*3]
+        # smpl only runs once per distinct goal pose of the batch
+        vertices, _, pose_indices = self.smpl_vertex_cache(goal_poses, betas)  # [number_poses, 6890, 3]
+        vertices_flat = vertices.reshape(vertices.shape[0], -1)[pose_indices]  # [batchsize, 6890*3]
 
 
         vertices_flat = vertices_flat[..., None, :].expand(vertices_flat.shape[0],
@@ -15,13 +15,14 @@ class DummySmplEstimatorModel(nn.Module):
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
         self.betas = torch.nn.Parameter(betas.data, requires_grad=False)  # [1, 10]
-        self.goal_poses = torch.nn.Parameter(goal_poses.data, requires_grad=False)  # [number_images*h*w, 69]
+        self.goal_poses = torch.nn.Parameter(goal_poses.data, requires_grad=False)  # [number_images, 69]
 
 
     def forward(self, x):
         '''
         x are indices telling the dummy estimator what image the currently processed ray is from such that the dummy
-        estimator can return the correct expressions... for that ray
+        estimator can return the correct expressions... for that ray. The goal poses are stored once per image and
+        looked up with these indices.
         '''
         betas = self.betas.expand(len(x), -1)
         return self.goal_poses[x], betas
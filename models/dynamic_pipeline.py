@@ -3,11 +3,15 @@ from collections import defaultdict
 import torch
 
 from models.nerf_pipeline import NerfPipeline
+from util.smpl_vertex_cache import SmplVertexCache
+from util.vertex_warp import sparse_vertex_warp
 from utils import PositionalEncoder, raw2outputs, modified_softmax, print_max, print_number_nans
 from torch.nn import functional as F
 
 
 class DynamicPipeline(NerfPipeline):
+    # the nets get warped samples or per sample inputs
+    per_ray_inputs = None
 
     def __init__(self, model_coarse, model_fine, smpl_estimator, smpl_model,
                  args, position_encoder: PositionalEncoder,
@@ -15,8 +19,7 @@ class DynamicPipeline(NerfPipeline):
         super(DynamicPipeline, self).__init__(model_coarse, model_fine, args, position_encoder, direction_encoder)
         self.smpl_estimator = smpl_estimator
         self.smpl_model = smpl_model
-        self.global_orient = torch.zeros([1, 3], device=self.device)
-        self.canonical_pose = torch.zeros([1, 69], device=self.device)
+        self.smpl_vertex_cache = SmplVertexCache(smpl_model)
         self.args = args
         self.pre_attention_warps = None
 
@@ -31,6 +34,7 @@ class DynamicPipeline(NerfPipeline):
             rgb_fine : torch.Tensor ([batch_size, 3])
                 Estimated RGB color with fine net.
             """
+        data = self.coarse_sample(data)
         ray_samples, ray_translation, ray_direction, z_vals, images, rb_truth = data
 
         goal_poses, betas = self.smpl_estimator(images)
@@ -38,31 +42,29 @@ class DynamicPipeline(NerfPipeline):
         #print('expression ', self.smpl_estimator.expression)
         #print('goal_poses', self.smpl_estimator.goal_poses)
 
-        # right now expanding and using self.global_orient_instead of setting the correct batchisze for the smpl model since the same smpl model is used in train and validation with different batch sizes (the batchisze of the smpl_model is 1 by default)
-        global_orient = self.global_orient.expand(len(ray_samples), -1)
-        canonical_pose = self.canonical_pose.expand(len(ray_samples), -1)
+        # smpl only runs once per distinct goal pose of the batch, rays with the same goal pose share one neighbour search
+        goal_vertices, warps, pose_indices = self.smpl_vertex_cache(goal_poses, betas)  # [number_poses, number_vertices, 3]
 
-        canonical_model = self.smpl_model(betas=betas, return_verts=True,
-                                          body_pose=canonical_pose,
-                                          global_orient=global_orient)  # [number_vertices, 3]
-        goal_models = self.smpl_model(betas=betas, return_verts=True, body_pose=goal_poses,
-                                      global_orient=global_orient)
-        goal_vertices = goal_models.vertices  # [batchsize, number_vertices, 3]
-        warps = canonical_model.vertices - goal_vertices  # [batchsize, number_vertices, 3]
+        if self.args.warp_number_neighbours > 0:
+            warps = sparse_vertex_warp(ray_samples, goal_vertices, warps, self.args.warp_radius,
+                                       self.args.warp_number_neighbours, self.args.warp_temperature,
+                                       pose_indices=pose_indices)  # [batchsize, number_samples, 3]
+        else:
+            goal_vertices = goal_vertices[pose_indices]  # [batchsize, number_vertices, 3]
+            warps = warps[pose_indices]  # [batchsize, number_vertices, 3]
+            distances = ray_samples[:, :, None, :] - goal_vertices[:, None, :, :].expand(
+                (-1, ray_samples.shape[1], -1, -1))  # [batchsize, number_samples, number_vertices, 3]
+            distances = torch.norm(distances, dim=-1)  # [batchsize, number_samples, number_vertices]
+            attentions_1 = distances - self.args.warp_radius  # [batchsize, number_samples, number_vertices]
+            attentions_2 = F.relu(-attentions_1)
+            #print('iter')
+            #attentions_2.register_hook(lambda x: print_number_nans('pre', x))
+            #attentions_2.register_hook(lambda x: print_max('pre',x))
 
-        distances = ray_samples[:, :, None, :] - goal_vertices[:, None, :, :].expand(
-            (-1, ray_samples.shape[1], -1, -1))  # [batchsize, number_samples, number_vertices, 3]
-        distances = torch.norm(distances, dim=-1)  # [batchsize, number_samples, number_vertices]
-        attentions_1 = distances - self.args.warp_radius  # [batchsize, number_samples, number_vertices]
-        attentions_2 = F.relu(-attentions_1)
-        #print('iter')
-        #attentions_2.register_hook(lambda x: print_number_nans('pre', x))
-        #attentions_2.register_hook(lambda x: print_max('pre',x))
-
-        attentions_3 = modified_softmax(self.args.warp_temperature * attentions_2)
-        #attentions_3.register_hook(lambda x: print_max('post',x))
-        warps = warps[:, None, :, :] * attentions_3[:, :, :, None]  # [batchsize, number_samples, number_vertices, 3]
-        warps = warps.sum(dim=-2)  # [batchsize, number_samples, 3]
+            attentions_3 = modified_softmax(self.args.warp_temperature * attentions_2)
+            #attentions_3.register_hook(lambda x: print_max('post',x))
+            warps = warps[:, None, :, :] * attentions_3[:, :, :, None]  # [batchsize, number_samples, number_vertices, 3]
+            warps = warps.sum(dim=-2)  # [batchsize, number_samples, 3]
         warped_samples = ray_samples + warps
 
         samples_encoding = self.position_encoder.encode(warped_samples)
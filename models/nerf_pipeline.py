@@ -1,5 +1,6 @@
 import torch
 
+from datasets.transforms import CoarseSampling
 from models.singe_sample_pipeline import SmplPipeline
 from utils import PositionalEncoder, raw2outputs, fine_sampling
 
@@ -10,6 +11,60 @@ class NerfPipeline(SmplPipeline):
                  direction_encoder: PositionalEncoder):
         super(NerfPipeline, self).__init__(model_coarse, args, position_encoder, direction_encoder)
         self.model_fine = model_fine
+        self.coarse_sampling = CoarseSampling(args.near, args.far, args.number_coarse_samples, args.perturb_per_bin)
+        self.occupancy_grid = None
+
+    def __call__(self, data):
+        """
+        Runs forward. If an occupancy_grid (OccupancyGrid) is set and the batch
+        contains plain rays, the coarse samples are placed in the occupied cells
+        and forward only runs on the rays that hit occupied cells. The rgb
+        outputs of the other rays are the background color and their
+        per-sample outputs are zero.
+        """
+        if self.occupancy_grid is None or data[0].dim() != 2:
+            return super(NerfPipeline, self).__call__(data)
+        ray_samples, z_vals, hits = self.occupancy_grid.sample_batch(data[0], data[1], self.coarse_sampling)
+        data = [ray_samples, data[0], data[1], z_vals] + list(data[2:])
+        if hits.all():
+            return super(NerfPipeline, self).__call__(data)
+        # without any hit one ray is still rendered for the shapes of the outputs, its values are not used
+        rendered = hits if hits.any() else torch.arange(len(hits), device=hits.device) == 0
+        outputs = super(NerfPipeline, self).__call__([element[rendered] for element in data])
+        background = 1. if self.args.white_background else 0.
+        full_outputs = []
+        for i, output in enumerate(outputs):
+            full_output = output.new_full((len(hits),) + output.shape[1:], background if i < 2 else 0.)
+            full_output[hits] = output[hits[rendered]]
+            full_outputs.append(full_output)
+        return tuple(full_outputs)
+
+    def per_ray_inputs(self, data):
+        """
+        Inputs of the nets that are shared by all samples of a ray, for plain rays
+        [rays_translation ([batch_size, 3]), rays_direction, *extras, rgb]. They are
+        passed to the nets after the sample encodings and let renderers like
+        render_rays_early_termination evaluate any subset of rays and samples.
+        Pipelines that warp the samples set per_ray_inputs to None.
+
+        Returns
+        -------
+        per_ray_inputs : list of torch.Tensor ([batch_size, ...])
+            Direction encoding per ray.
+        """
+        rays_direction = data[1]
+        rays_direction_norm = rays_direction / torch.norm(rays_direction, dim=-1, keepdim=True)
+        return [self.direction_encoder.encode(rays_direction_norm)]
+
+    def coarse_sample(self, data):
+        """
+        Coarse samples the batch on its device if it contains plain rays
+        [rays_translation ([batch_size, 3]), rays_direction, *extras, rgb] as returned by a
+        RayBatchLoader without coarse sampling. Batches that are already sampled are returned unchanged.
+        """
+        if data[0].dim() == 2:
+            return self.coarse_sampling.sample_data(data)
+        return data
 
     def forward(self, data):
         """
@@ -23,45 +78,45 @@ class NerfPipeline(SmplPipeline):
                 Estimated RGB color with fine net.
             """
 
+        data = self.coarse_sample(data)
         ray_samples, ray_translation, ray_direction, z_vals, _ = data
 
         # get values for coarse network and run them through the coarse network
-        samples_encoding = self.position_encoder.encode(ray_samples)
+        with self.profiler.section('encoding'):
+            samples_encoding = self.position_encoder.encode(ray_samples)
+            # the direction is the same for all samples of a ray, so it is encoded once per ray
+            rays_direction_norm = ray_direction / torch.norm(ray_direction, dim=-1, keepdim=True)
+            directions_encoding = self.direction_encoder.encode(rays_direction_norm)  # [batchsize, encoding_size]
         coarse_samples_directions = ray_direction[..., None, :].expand(ray_direction.shape[0], ray_samples.shape[1],
                                                                        ray_direction.shape[
                                                                            -1])  # [batchsize, number_coarse_samples, 3]
-        samples_directions_norm = coarse_samples_directions / torch.norm(coarse_samples_directions, dim=-1,
-                                                                         keepdim=True)
-        directions_encoding = self.direction_encoder.encode(samples_directions_norm)
-        # flatten the encodings from [batchsize, number_coarse_samples, encoding_size] to [batchsize * number_coarse_samples, encoding_size] and concatenate
-        inputs = torch.cat([samples_encoding.view(-1, samples_encoding.shape[-1]),
-                            directions_encoding.view(-1, directions_encoding.shape[-1])], -1)
-        raw_outputs = self.model_coarse(inputs)  # [batchsize * number_coarse_samples, 4]
-        raw_outputs = raw_outputs.view(samples_encoding.shape[0], samples_encoding.shape[1],
-                                       raw_outputs.shape[-1])  # [batchsize, number_coarse_samples, 4]
-        rgb, weights, densities = raw2outputs(raw_outputs, z_vals, coarse_samples_directions, self.args)
+        with self.profiler.section('coarse_forward'):
+            # flatten the encodings from [batchsize, number_coarse_samples, encoding_size] to [batchsize * number_coarse_samples, encoding_size]
+            inputs = samples_encoding.view(-1, samples_encoding.shape[-1])
+            raw_outputs = self.model_coarse(inputs, directions_encoding)  # [batchsize * number_coarse_samples, 4]
+            raw_outputs = raw_outputs.view(samples_encoding.shape[0], samples_encoding.shape[1],
+                                           raw_outputs.shape[-1])  # [batchsize, number_coarse_samples, 4]
+            rgb, weights, densities = raw2outputs(raw_outputs, z_vals, coarse_samples_directions, self.args)
         if not self.args.run_fine:
             return rgb, rgb, ray_samples, densities
 
         # get values for the fine network and run them through the fine network
-        z_vals, ray_samples_fine = fine_sampling(ray_translation, ray_direction, z_vals, weights,
-                                                 self.args)  # [batchsize, number_coarse_samples + number_fine_samples, 3]
-        samples_encoding_fine = self.position_encoder.encode(ray_samples_fine)
-        # expand directions and translations to the number of coarse samples + fine_samples
-        directions_encoding_fine = directions_encoding[..., :1, :].expand(directions_encoding.shape[0],
-                                                                          ray_samples_fine.shape[1],
-                                                                          directions_encoding.shape[-1])
-        inputs_fine = torch.cat([samples_encoding_fine.view(-1, samples_encoding_fine.shape[-1]),
-                                 directions_encoding_fine.reshape(-1, directions_encoding_fine.shape[-1])], -1)
-        raw_outputs_fine = self.model_fine(
-            inputs_fine)  # [batchsize * (number_coarse_samples + number_fine_samples), 4]
-        raw_outputs_fine = raw_outputs_fine.reshape(samples_encoding_fine.shape[0], samples_encoding_fine.shape[1],
-                                                    raw_outputs_fine.shape[
-                                                        -1])  # [batchsize, number_coarse_samples + number_fine_samples, 4]
-        # expand directions and translations to the number of coarse samples + fine_samples
-        fine_samples_directions = ray_direction[..., None, :].expand(ray_direction.shape[0],
-                                                                     ray_samples_fine.shape[1],
-                                                                     ray_direction.shape[-1])
-        rgb_fine, _, densities = raw2outputs(raw_outputs_fine, z_vals, fine_samples_directions, self.args)
+        with self.profiler.section('fine_sampling'):
+            z_vals, ray_samples_fine = fine_sampling(ray_translation, ray_direction, z_vals, weights,
+                                                     self.args)  # [batchsize, number_coarse_samples + number_fine_samples, 3]
+        with self.profiler.section('encoding'):
+            samples_encoding_fine = self.position_encoder.encode(ray_samples_fine)
+        with self.profiler.section('fine_forward'):
+            inputs_fine = samples_encoding_fine.view(-1, samples_encoding_fine.shape[-1])
+            raw_outputs_fine = self.model_fine(
+                inputs_fine, directions_encoding)  # [batchsize * (number_coarse_samples + number_fine_samples), 4]
+            raw_outputs_fine = raw_outputs_fine.reshape(samples_encoding_fine.shape[0], samples_encoding_fine.shape[1],
+                                                        raw_outputs_fine.shape[
+                                                            -1])  # [batchsize, number_coarse_samples + number_fine_samples, 4]
+            # expand directions and translations to the number of coarse samples + fine_samples
+            fine_samples_directions = ray_direction[..., None, :].expand(ray_direction.shape[0],
+                                                                         ray_samples_fine.shape[1],
+                                                                         ray_direction.shape[-1])
+            rgb_fine, _, densities = raw2outputs(raw_outputs_fine, z_vals, fine_samples_directions, self.args)
 
         return rgb, rgb_fine, ray_samples_fine, densities
@@ -39,19 +39,63 @@ class RenderRayNet(nn.Module):
             self.directional_net.append(torch.nn.Linear(directional_width, directional_width))
         self.rgb_out_layer = torch.nn.Linear(directional_width, 3)
 
-    def forward(self, x):
-        positions_pose, directions = x[..., :self.positions_dim + self.additional_input_dim], x[..., -self.direcions_dim:]
+    def forward(self, x, directions_encoding=None, pose_encoding=None):
+        """
+        Parameters
+        ----------
+        x : torch.Tensor ([batch_size * number_samples, input_dim])
+            Additional input (e.g. the pose) and positions of the samples followed
+            by the directions of the samples. If directions_encoding is given x
+            contains no directions, if pose_encoding is given x contains no
+            additional input.
+        directions_encoding : torch.Tensor ([batch_size, directions_dim]), optional
+            Direction encoding per ray that is shared by all samples of the ray.
+            The directional part of the first directional layer is then only
+            computed once per ray and broadcast over the samples. The default is None.
+        pose_encoding : torch.Tensor ([batch_size, additional_input_dim]), optional
+            Additional input per ray that is shared by all samples of the ray.
+            Its part of the input and skip layers is computed once per unique
+            pose and added as a bias to the samples. The default is None.
+
+        Returns
+        -------
+        raw : torch.Tensor ([batch_size * number_samples, 4])
+            RGB and density of the samples.
+        """
+        if pose_encoding is None:
+            positions_pose = x[..., :self.positions_dim + self.additional_input_dim]
+        else:
+            positions_pose = x[..., :self.positions_dim]
+            if torch.is_grad_enabled() and pose_encoding.requires_grad:
+                poses, pose_indices = pose_encoding, torch.arange(len(pose_encoding), device=x.device)
+            else:
+                poses, pose_indices = torch.unique(pose_encoding, dim=0, return_inverse=True)
+        if directions_encoding is None:
+            directions = x[..., -self.direcions_dim:]
         o = positions_pose
-        o = F.relu(self.positions_pose_input(o))
+        if pose_encoding is None:
+            o = F.relu(self.positions_pose_input(o))
+        else:
+            o = F.relu(self.pose_conditioned_linear(self.positions_pose_input, o, 0, poses, pose_indices))
         for i, positional_layer in enumerate(self.positional_net):
-            if i in self.skips:
+            if i in self.skips and pose_encoding is None:
                 o = F.relu(positional_layer(torch.cat([o, positions_pose], -1)))
+            elif i in self.skips:
+                o = F.relu(self.pose_conditioned_linear(positional_layer, torch.cat([o, positions_pose], -1),
+                                                        self.width, poses, pose_indices))
             else:
                 o = F.relu(positional_layer(o))
         o = self.additional_linear_layer(o)
         sigma = self.sigma_out_layer(o)
 
-        if self.use_directional_input:
+        if self.use_directional_input and directions_encoding is not None:
+            # split the first directional layer into its part for o and its part for the directions
+            weight = self.directional_input.weight
+            per_ray = F.linear(directions_encoding, weight[:, self.width:],
+                               self.directional_input.bias)  # [batch_size, directional_width]
+            o = F.linear(o, weight[:, :self.width]).view(len(directions_encoding), -1, per_ray.shape[-1])
+            o = (o + per_ray[:, None, :]).view(-1, per_ray.shape[-1])
+        elif self.use_directional_input:
             o = self.directional_input(torch.cat([o, directions], -1))
         else:
             o = self.directional_input(o)
@@ -60,6 +104,36 @@ class RenderRayNet(nn.Module):
         rgb = self.rgb_out_layer(o)
         return torch.cat([rgb, sigma], -1)
 
+    def pose_conditioned_linear(self, layer, inputs, pose_start, poses, pose_indices):
+        """
+        Applies layer to the per sample inputs with the pose inserted at column
+        pose_start of the layer input. The pose part of the layer is computed
+        once per unique pose and added to the samples of its rays as a bias.
+
+        Parameters
+        ----------
+        layer : torch.nn.Linear
+            Layer whose input is [inputs[:, :pose_start], pose, inputs[:, pose_start:]].
+        inputs : torch.Tensor ([batch_size * number_samples, in_features - additional_input_dim])
+            Per sample part of the layer input.
+        pose_start : int
+            Column of the layer input where the pose starts.
+        poses : torch.Tensor ([number_poses, additional_input_dim])
+            Unique poses.
+        pose_indices : torch.Tensor ([batch_size])
+            Index into poses of every ray.
+
+        Returns
+        -------
+        o : torch.Tensor ([batch_size * number_samples, out_features])
+        """
+        weight = layer.weight
+        pose_end = pose_start + self.additional_input_dim
+        pose_bias = F.linear(poses, weight[:, pose_start:pose_end], layer.bias)[pose_indices]  # [batch_size, out_features]
+        sample_weight = torch.cat([weight[:, :pose_start], weight[:, pose_end:]], 1)
+        o = F.linear(inputs, sample_weight).view(len(pose_bias), -1, weight.shape[0])
+        return (o + pose_bias[:, None, :]).view(-1, weight.shape[0])
+
     @property
     def is_cuda(self):
         """
@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+from util.step_profiler import DISABLED_PROFILER
 from utils import PositionalEncoder
 
 
@@ -13,6 +14,8 @@ class SmplPipeline(nn.Module):
         self.model_coarse = model_coarse
         self.position_encoder = position_encoder
         self.direction_encoder = direction_encoder
+        # set by solvers that profile their steps, see StepProfiler
+        self.profiler = DISABLED_PROFILER
 
     def forward(self, data):
         """
@@ -5,6 +5,8 @@ from utils import PositionalEncoder, raw2outputs, fine_sampling
 
 
 class SmplNerfPipeline(NerfPipeline):
+    # the nets get warped samples or per sample inputs
+    per_ray_inputs = None
 
     def __init__(self, model_coarse, model_fine, model_warp_field, args, position_encoder: PositionalEncoder,
                  direction_encoder: PositionalEncoder, human_pose_encoder: PositionalEncoder):
@@ -24,6 +26,7 @@ class SmplNerfPipeline(NerfPipeline):
             rgb_fine : torch.Tensor ([batch_size, 3])
                 Estimated RGB color with fine net.
             """
+        data = self.coarse_sample(data)
         ray_samples, ray_translation, ray_direction, z_vals, goal_pose, _ = data
         goal_pose = torch.stack([goal_pose[:, 38], goal_pose[:, 41]], axis=-1)
         # get values for coarse network and run them through the coarse network
@@ -5,6 +5,8 @@ from utils import PositionalEncoder, raw2outputs, fine_sampling
 
 
 class VertexSpherePipeline(NerfPipeline):
+    # the nets get warped samples or per sample inputs
+    per_ray_inputs = None
 
     def __init__(self, model_coarse, model_fine, args, position_encoder: PositionalEncoder,
                  direction_encoder: PositionalEncoder):
@@ -22,6 +24,7 @@ class VertexSpherePipeline(NerfPipeline):
             rgb_fine : torch.Tensor ([batch_size, 3])
                 Estimated RGB color with fine net.
             """
+        data = self.coarse_sample(data)
         ray_samples, ray_translation, ray_direction, z_vals, warp, _ = data
         # get values for coarse network and run them through the coarse network
 
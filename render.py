@@ -11,10 +11,50 @@ from PIL import Image
 import numpy as np
 from camera import get_sphere_pose
 from utils import get_rays
-from trimesh.ray.ray_triangle import RayMeshIntersector
+from util.ray_mesh_bvh import BVHIntersector, warp_from_hits
 import smplx
 
 
+# Process-wide caches of loaded SMPL models, decoded textures and uv-maps keyed by file name
+smpl_model_cache = {}
+texture_cache = {}
+uv_map_cache = {}
+
+
+def get_smpl_model(smpl_file_name: str):
+    """
+    SMPL model of smpl_file_name. It is only created once per process and
+    shared by all callers, so it must not be modified.
+    """
+    if smpl_file_name not in smpl_model_cache:
+        smpl_model_cache[smpl_file_name] = smplx.create(smpl_file_name, model_type='smpl')
+    return smpl_model_cache[smpl_file_name]
+
+
+def get_texture(texture_file_name: str) -> Image.Image:
+    """
+    Decoded texture of texture_file_name, only read once per process.
+    """
+    if texture_file_name not in texture_cache:
+        texture_cache[texture_file_name] = load_texture(texture_file_name)
+    return texture_cache[texture_file_name]
+
+
+def get_uv_map(uv_map_file_name: str) -> np.array:
+    """
+    uv-map of uv_map_file_name, only read once per process.
+    """
+    if uv_map_file_name not in uv_map_cache:
+        uv_map_cache[uv_map_file_name] = np.load(uv_map_file_name)
+    return uv_map_cache[uv_map_file_name]
+
+
+def clear_smpl_caches():
+    smpl_model_cache.clear()
+    texture_cache.clear()
+    uv_map_cache.clear()
+
+
 def get_smpl_mesh(smpl_file_name: str = None, texture_file_name: str = None,
                   uv_map_file_name: str = None, body_pose: torch.Tensor = None,
                   return_betas_exps=False, return_pyrender=True) -> pyrender.Mesh:
@@ -49,19 +89,56 @@ def get_smpl_mesh(smpl_file_name: str = None, texture_file_name: str = None,
         texture_file_name = "textures/female1.jpg"
     if uv_map_file_name is None:
         uv_map_file_name = "textures/smpl_uv_map.npy"
-    model = smplx.create(smpl_file_name, model_type='smpl')
-    # set betas and expression to fixed values
+    model = get_smpl_model(smpl_file_name)
+    texture = get_texture(texture_file_name)
+    uv = get_uv_map(uv_map_file_name)
+    return smpl_mesh_from_model(model, texture, uv, body_pose, return_betas_exps, return_pyrender)
+
+
+def default_betas_expression():
+    """
+    Fixed betas (1, 10) and expression (1, 10) used for all rendered SMPLs.
+    """
     betas = torch.tensor([[-0.3596, -1.0232, -1.7584, -2.0465, 0.3387,
                            -0.8562, 0.8869, 0.5013, 0.5338, -0.0210]])
     expression = torch.tensor([[2.7228, -1.8139, 0.6270, -0.5565, 0.3251,
                                 0.5643, -1.2158, 1.4149, 0.4050, 0.6516]])
-    
+    return betas, expression
+
+
+def load_texture(texture_file_name: str) -> Image.Image:
+    with open(texture_file_name, 'rb') as file:
+        texture = Image.open(BytesIO(file.read()))
+    return texture
+
+
+def smpl_mesh_from_model(model, texture: Image.Image, uv: np.array, body_pose: torch.Tensor = None,
+                         return_betas_exps=False, return_pyrender=True) -> pyrender.Mesh:
+    """
+    Same as get_smpl_mesh but with an already loaded SMPL model, texture and
+    uv-map, so they can be reused for many poses.
+
+    Parameters
+    ----------
+    model : smplx.SMPL
+        SMPL model created with smplx.create.
+    texture : PIL.Image.Image
+        Texture for smpl.
+    uv : np.array
+        uv-map for smpl.
+    body_pose : torch.Tensor[1, 69]
+        Body poses for SMPL
+
+    Returns
+    -------
+    mesh : pyrender.Mesh
+        SMPL mesh with texture and desired body pose.
+
+    """
+    betas, expression = default_betas_expression()
     output = model(betas=betas, expression=expression,
                    return_verts=True, body_pose=body_pose)
     vertices = output.vertices.detach().cpu().numpy().squeeze()
-    with open(texture_file_name, 'rb') as file:
-        texture = Image.open(BytesIO(file.read()))
-    uv = np.load(uv_map_file_name)
     smpl_mesh = trimesh.Trimesh(vertices, model.faces,
                 visual=trimesh.visual.TextureVisuals(uv=uv, image=texture),
                                 process=False)
@@ -106,12 +183,9 @@ def get_smpl_mesh_distorted(smpl_file_name: str = None, texture_file_name: str =
         texture_file_name = "textures/female1.jpg"
     if uv_map_file_name is None:
         uv_map_file_name = "textures/smpl_uv_map.npy"
-    model = smplx.create(smpl_file_name, model_type='smpl')
-    # set betas and expression to fixed values
-    betas = torch.tensor([[-0.3596, -1.0232, -1.7584, -2.0465, 0.3387,
-                           -0.8562, 0.8869, 0.5013, 0.5338, -0.0210]])
-    expression = torch.tensor([[2.7228, -1.8139, 0.6270, -0.5565, 0.3251,
-                                0.5643, -1.2158, 1.4149, 0.4050, 0.6516]])
+    model = get_smpl_model(smpl_file_name)
+    # fresh tensors, so they can be changed in place below
+    betas, expression = default_betas_expression()
 
     if var is not None:
         betas += (var**0.5)*torch.randn(10)
@@ -125,9 +199,8 @@ def get_smpl_mesh_distorted(smpl_file_name: str = None, texture_file_name: str =
     output = model(betas=betas, expression=expression,
                    return_verts=True, body_pose=body_pose)
     vertices = output.vertices.detach().cpu().numpy().squeeze()
-    with open(texture_file_name, 'rb') as file:
-        texture = Image.open(BytesIO(file.read()))
-    uv = np.load(uv_map_file_name)
+    texture = get_texture(texture_file_name)
+    uv = get_uv_map(uv_map_file_name)
     smpl_mesh = trimesh.Trimesh(vertices, model.faces,
                                 visual=trimesh.visual.TextureVisuals(uv=uv, image=texture),
                                 process=False)
@@ -178,7 +251,7 @@ def get_smpl_vertices(betas, expression,
         texture_file_name = "textures/female1.jpg"
     if uv_map_file_name is None:
         uv_map_file_name = "textures/smpl_uv_map.npy"
-    model = smplx.create(smpl_file_name, model_type='smpl')
+    model = get_smpl_model(smpl_file_name)
     # set betas and expression to fixed values
     betas = torch.tensor(betas).float()
     expression = torch.tensor(expression).float()
@@ -187,6 +260,50 @@ def get_smpl_vertices(betas, expression,
     vertices = output.vertices.detach().cpu().numpy().squeeze()
     return vertices
 
+def get_smpl_vertices_batch(poses, betas=None, expression=None, smpl_file_name: str = None,
+                            chunk_size: int = 256) -> np.array:
+    """
+    Vertices of many SMPL poses with the same betas and expression, posed
+    with one SMPL forward pass per chunk of poses.
+
+    Parameters
+    ----------
+    poses : torch.Tensor or np.array (N, 69)
+        Body poses for SMPL.
+    betas : np.array (1, 10), optional
+        Betas for smpl. The default are the fixed betas of get_smpl_mesh.
+    expression : np.array (1, 10), optional
+        Expression for smpl. The default is the fixed expression of get_smpl_mesh.
+    smpl_file_name : str, optional
+        file name of smpl model (.pkl).
+    chunk_size : int, optional
+        Number of poses per forward pass. The default is 256.
+
+    Returns
+    -------
+    vertices : np.array (N, 6890, 3)
+        Vertices of the posed SMPLs.
+
+    """
+    if smpl_file_name is None:
+        smpl_file_name = "SMPLs/smpl/models/basicModel_f_lbs_10_207_0_v1.0.0.pkl"
+    default_betas, default_expression = default_betas_expression()
+    betas = default_betas if betas is None else torch.tensor(betas).float().view(1, -1)
+    expression = default_expression if expression is None else torch.tensor(expression).float().view(1, -1)
+    poses = torch.as_tensor(poses).float().view(-1, 69)
+    model = get_smpl_model(smpl_file_name)
+    vertices = []
+    with torch.no_grad():
+        for start in range(0, len(poses), chunk_size):
+            body_pose = poses[start:start + chunk_size]
+            batch_size = len(body_pose)
+            output = model(betas=betas.expand(batch_size, -1), expression=expression.expand(batch_size, -1),
+                           global_orient=torch.zeros(batch_size, 3), transl=torch.zeros(batch_size, 3),
+                           return_verts=True, body_pose=body_pose)
+            vertices.append(output.vertices.cpu().numpy())
+    return np.concatenate(vertices)
+
+
 def get_human_poses(joints: list, start_angle: list, end_angle: list,
                     number_steps: list) -> list:
     """
@@ -254,51 +371,19 @@ def get_warp(canonical: trimesh.base.Trimesh, goal: trimesh.base.Trimesh,
     """
     f = .5 * w / np.tan(.5 * camera_angle_x)
     rays_translation, rays_direction = get_rays(h, w, f, camera_transform)
-    camera_origin = rays_translation[0][0]
-
-    # calculate intersections with rays and goal smpl 
-    intersector = RayMeshIntersector(goal)
-    goal_intersections = intersector.intersects_location(rays_translation.reshape(-1, 3), rays_direction.reshape(-1, 3))
-    goal_intersections_points = goal_intersections[0]  # (N_intersects, 3)
-    goal_intersections_face_indices = goal_intersections[2]  # (N_intersects, )
-    goal_intersections_ray_indices = goal_intersections[1] # (N_intersects, )
-
-    # Find multiple intersections and use only closest
-    unique_goal_intersect_points = []
-    unique_goal_intersect_face_indices = []
-    unique_goal_intersect_ray_indices = []
+
+    # calculate the closest intersection of every ray with the goal smpl
+    intersector = BVHIntersector(goal)
+    distances, face_indices, barycentrics = intersector.intersects_first(rays_translation.reshape(-1, 3),
+                                                                         rays_direction.reshape(-1, 3))
+    goal_intersections_ray_indices = np.nonzero(face_indices >= 0)[0]
     depth = np.zeros((w*h))
-    intersect_indices = np.arange(len(goal_intersections_points))
-    for ray in np.unique(goal_intersections_ray_indices):
-        ray_mask = goal_intersections_ray_indices == ray
-        indices_ray = intersect_indices[ray_mask]
-        ray_intersects = goal_intersections_points[ray_mask]
-        distances_camera = np.linalg.norm(ray_intersects-camera_origin, axis=1)
-        closest_intersect_index = indices_ray[np.argmin(distances_camera)]
-        unique_goal_intersect_points.append(goal_intersections_points[closest_intersect_index])
-        unique_goal_intersect_face_indices.append(goal_intersections_face_indices[closest_intersect_index])
-        unique_goal_intersect_ray_indices.append(goal_intersections_ray_indices[closest_intersect_index])
-        depth[ray] = np.min(distances_camera)
-    assert(len(unique_goal_intersect_points)==len(unique_goal_intersect_face_indices)==len(unique_goal_intersect_ray_indices))
-    assert((np.unique(goal_intersections_ray_indices) == unique_goal_intersect_ray_indices).all())
-    goal_intersections_points = np.array(unique_goal_intersect_points)
-    goal_intersections_face_indices = np.array(unique_goal_intersect_face_indices)
-    goal_intersections_ray_indices = np.array(unique_goal_intersect_ray_indices)
-    
-    # Calculate for each intersection on goal SMPL the corresponding 
-    # intersection on the canonical SMPL
-    canonical_intersections = []
-    for i, face_idx in enumerate(goal_intersections_face_indices):
-        vertex_indices = goal.faces[face_idx]
-        goal_vertices = goal.vertices[vertex_indices]
-        canonical_vertices = canonical.vertices[vertex_indices]
-        lin_coeffs_vertices = np.linalg.solve(goal_vertices.T, goal_intersections_points[i])
-        canonical_intersection = canonical_vertices.T.dot(lin_coeffs_vertices)
-        canonical_intersections.append(canonical_intersection)
-    canonical_intersections = np.array(canonical_intersections)
-
-    # Calculate actual warp for intersections
-    warp = canonical_intersections-goal_intersections_points
+    depth[goal_intersections_ray_indices] = distances[goal_intersections_ray_indices]
+
+    # Transfer every intersection on the goal SMPL with its barycentric
+    # coordinates to the canonical SMPL and calculate the warp
+    warp = warp_from_hits(goal, canonical, face_indices[goal_intersections_ray_indices],
+                          barycentrics=barycentrics[goal_intersections_ray_indices])
     # Set each pixel corresponding to ray index to the warp
     warp_img_flat = np.zeros((h*w, 3))
     warp_img_flat[goal_intersections_ray_indices] = warp
@@ -311,6 +396,8 @@ def get_warp(canonical: trimesh.base.Trimesh, goal: trimesh.base.Trimesh,
         plt.imshow(warp_normalized)
         plt.show()
         scene = pyrender.Scene()
+        goal_intersections_points = np.einsum('ij,ijk->ik', barycentrics[goal_intersections_ray_indices],
+                                              goal.vertices[goal.faces[face_indices[goal_intersections_ray_indices]]])
         lines_warp = np.hstack((goal_intersections_points, goal_intersections_points+warp)).reshape(-1, 3)
         primitive = [pyrender.Primitive(lines_warp, mode=1)]
         primitive_mesh = pyrender.Mesh(primitive)
@@ -319,12 +406,113 @@ def get_warp(canonical: trimesh.base.Trimesh, goal: trimesh.base.Trimesh,
     return warp_img, depth.reshape((h, w))
 
 
+class RenderSession():
+    """
+    Persistent offscreen rendering session.
+
+    It keeps one pyrender.OffscreenRenderer per resolution and one scene with
+    a mesh, a camera and a light node. Between frames only the poses of the
+    nodes are changed and the mesh node is only replaced if a different mesh
+    is rendered, so GL contexts and uploaded meshes are reused instead of
+    being created for every image.
+    """
+
+    def __init__(self):
+        self.renderers = {}
+        self.scene = pyrender.Scene()
+        self.light_node = self.scene.add(pyrender.DirectionalLight(color=np.ones(3), intensity=28.0))
+        self.camera_node = None
+        self.mesh_node = None
+
+    def get_renderer(self, height: int, width: int) -> pyrender.OffscreenRenderer:
+        if (height, width) not in self.renderers:
+            self.renderers[(height, width)] = pyrender.OffscreenRenderer(height, width)
+        return self.renderers[(height, width)]
+
+    def set_mesh(self, mesh: pyrender.Mesh, human_pose: np.array):
+        if self.mesh_node is not None and self.mesh_node.mesh is mesh:
+            self.scene.set_pose(self.mesh_node, human_pose)
+            return
+        if self.mesh_node is not None:
+            self.scene.remove_node(self.mesh_node)
+        self.mesh_node = self.scene.add(mesh, pose=human_pose)
+
+    def set_camera(self, camera_pose: np.array, yfov: float):
+        if self.camera_node is not None and self.camera_node.camera.yfov == yfov:
+            self.scene.set_pose(self.camera_node, camera_pose)
+            return
+        if self.camera_node is not None:
+            self.scene.remove_node(self.camera_node)
+        self.camera_node = self.scene.add(pyrender.PerspectiveCamera(yfov=yfov, aspectRatio=1.0), pose=camera_pose)
+
+    def render(self, mesh: pyrender.Mesh, camera_pose: np.array,
+               human_pose: np.array, light_pose: np.array,
+               height: int, width: int, yfov: float, return_depth=False):
+        """
+        Same as render_scene but reuses the scene and renderer of the session.
+        """
+        self.set_mesh(mesh, human_pose)
+        self.set_camera(camera_pose, yfov)
+        self.scene.set_pose(self.light_node, light_pose)
+        img, depth = self.get_renderer(height, width).render(self.scene)
+        if return_depth:
+            return img, depth
+        return img
+
+    def render_many(self, mesh: pyrender.Mesh, camera_poses, human_pose: np.array, light_poses,
+                    height: int, width: int, yfov: float, return_depth=False):
+        """
+        Render the same mesh from many camera poses.
+
+        Parameters
+        ----------
+        camera_poses : np.array (N, 4, 4)
+            camera pose matrices in homogeneous coordinates.
+        light_poses : np.array (N, 4, 4)
+            light pose matrices in homogeneous coordinates.
+
+        Returns
+        -------
+        imgs : np.array (N, height, width, 3)
+            rendered images.
+        depths : np.array (N, height, width)
+            depth maps (only if return_depth).
+        """
+        imgs, depths = [], []
+        for camera_pose, light_pose in zip(camera_poses, light_poses):
+            img, depth = self.render(mesh, camera_pose, human_pose, light_pose, height, width, yfov,
+                                     return_depth=True)
+            imgs.append(img)
+            depths.append(depth)
+        if return_depth:
+            return np.stack(imgs), np.stack(depths)
+        return np.stack(imgs)
+
+    def delete(self):
+        """
+        Free the GL contexts of all renderers.
+        """
+        for renderer in self.renderers.values():
+            renderer.delete()
+        self.renderers = {}
+
+
+render_session = None  # RenderSession shared by all render_scene calls of this process
+
+
+def get_render_session() -> RenderSession:
+    global render_session
+    if render_session is None:
+        render_session = RenderSession()
+    return render_session
+
+
 def render_scene(mesh: pyrender.Mesh, camera_pose: np.array,
                  human_pose: np.array, light_pose: np.array,
                  height: int, width: int, yfov: float, return_depth=False):
     """
     Add mesh, camera and light to scene at desired poses and return rendered
-    image.
+    image. Uses the RenderSession of the process.
 
     Parameters
     ----------
@@ -351,20 +539,8 @@ def render_scene(mesh: pyrender.Mesh, camera_pose: np.array,
         rendered image.
 
     """
-    scene = pyrender.Scene()
-    scene.add(mesh, pose=human_pose)
-    camera = pyrender.PerspectiveCamera(yfov=yfov, aspectRatio=1.0)
-    scene.add(camera, pose=camera_pose)
-    #light = pyrender.SpotLight(color=np.ones(3), intensity=200.0,
-    #                            innerConeAngle=np.pi/16.0,
-    #                            outerConeAngle=np.pi/6.0)
-    light = pyrender.DirectionalLight(color=np.ones(3), intensity=28.0)
-    scene.add(light, pose=camera_pose)
-    r = pyrender.OffscreenRenderer(height, width)
-    img, depth = r.render(scene)
-    if return_depth:
-        return img, depth
-    return img
+    return get_render_session().render(mesh, camera_pose, human_pose, light_pose, height, width, yfov,
+                                       return_depth)
 
 
 def save_render(render, f_name):
@@ -8,6 +8,7 @@ from torch.nn import functional as F
 from camera import get_sphere_pose
 from datasets.sub_dataset import SubDataset
 from solver.nerf_solver import NerfSolver
+from util.vertex_warp import sparse_vertex_warp
 from utils import PositionalEncoder, tensorboard_rerenders, vedo_data, raw2outputs
 from torch.utils.data import DataLoader
 
@@ -52,6 +53,7 @@ class ImageWiseSolver(NerfSolver):
             width of images.
         """
         args = self.args
+        profiler = self.init_profiler(samples_per_ray=args.number_coarse_samples)
 
         print('START TRAIN.')
 
@@ -81,23 +83,28 @@ class ImageWiseSolver(NerfSolver):
                 goal_vertices = goal_models.vertices  # [1, number_vertices, 3]
                 warp = canonical_model.vertices - goal_vertices  # [1, number_vertices, 3]
                 warp = warp.expand(args.batchsize, -1, -1)
-                for j, ray_batch in enumerate(dataloader):
-                    for c, element in enumerate(ray_batch):
-                        ray_batch[c] = element.to(self.device)
+                for j, ray_batch in enumerate(profiler.iterate(dataloader)):
+                    with profiler.section('to_device'):
+                        for c, element in enumerate(ray_batch):
+                            ray_batch[c] = element.to(self.device)
                     ray_samples, rays_translation, rays_direction, rgb_truth = ray_batch
 
-                    distances = ray_samples[:, :, None, :] - goal_vertices[:, None, :, :].expand(
-                        (-1, ray_samples.shape[1], -1, -1))  # [batchsize, number_samples, number_vertices, 3]
-                    distances = torch.norm(distances, dim=-1)  # [batchsize, number_samples, number_vertices]
-                    attentions = distances - self.args.warp_radius  # [batchsize, number_samples, number_vertices]
-                    attentions = F.relu(-attentions)
+                    if self.args.warp_number_neighbours > 0:
+                        warps = sparse_vertex_warp(ray_samples, goal_vertices, warp[:1], self.args.warp_radius,
+                                                   self.args.warp_number_neighbours)  # [batchsize, number_samples, 3]
+                    else:
+                        distances = ray_samples[:, :, None, :] - goal_vertices[:, None, :, :].expand(
+                            (-1, ray_samples.shape[1], -1, -1))  # [batchsize, number_samples, number_vertices, 3]
+                        distances = torch.norm(distances, dim=-1)  # [batchsize, number_samples, number_vertices]
+                        attentions = distances - self.args.warp_radius  # [batchsize, number_samples, number_vertices]
+                        attentions = F.relu(-attentions)
 
-                    # attentions = torch.softmax(self.args.warp_temperature * attentions, dim=-1)
-                    attentions = attentions / (attentions.sum(-1, keepdims=True) + 1e-5)
+                        # attentions = torch.softmax(self.args.warp_temperature * attentions, dim=-1)
+                        attentions = attentions / (attentions.sum(-1, keepdims=True) + 1e-5)
 
-                    warps = warp[:, None, :, :] * attentions[:, :, :,
-                                                  None]  # [batchsize, number_samples, number_vertices, 3]
-                    warps = warps.sum(dim=-2)  # [batchsize, number_samples, 3]
+                        warps = warp[:, None, :, :] * attentions[:, :, :,
+                                                      None]  # [batchsize, number_samples, number_vertices, 3]
+                        warps = warps.sum(dim=-2)  # [batchsize, number_samples, 3]
                     warped_samples = ray_samples + warps
 
                     samples_encoding = self.position_encoder.encode(warped_samples)
@@ -110,7 +117,8 @@ class ImageWiseSolver(NerfSolver):
                     # flatten the encodings from [batchsize, number_coarse_samples, encoding_size] to [batchsize * number_coarse_samples, encoding_size] and concatenate
                     inputs = torch.cat([samples_encoding.view(-1, samples_encoding.shape[-1]),
                                         directions_encoding.view(-1, directions_encoding.shape[-1])], -1)
-                    raw_outputs = self.model_coarse(inputs)  # [batchsize * number_coarse_samples, 4]
+                    with profiler.section('coarse_forward'):
+                        raw_outputs = self.model_coarse(inputs)  # [batchsize * number_coarse_samples, 4]
                     raw_outputs = raw_outputs.view(samples_encoding.shape[0], samples_encoding.shape[1],
                                                    raw_outputs.shape[-1])  # [batchsize, number_coarse_samples, 4]
                     rgb, weights, densities = raw2outputs(raw_outputs, z_vals, coarse_samples_directions, self.args)
@@ -118,8 +126,11 @@ class ImageWiseSolver(NerfSolver):
                     self.optim.zero_grad()
                     loss = self.loss_func(rgb, rgb_truth)
 
-                    loss.backward(retain_graph=True)
-                    self.optim.step()
+                    with profiler.section('backward'):
+                        loss.backward(retain_graph=True)
+                    with profiler.section('optimizer'):
+                        self.optim.step()
+                    profiler.step(len(rgb_truth))
 
                     loss_item = loss.item()
                     left_arm_loss = (self.smpl_estimator.arm_angle_l[0] -
@@ -173,18 +184,22 @@ class ImageWiseSolver(NerfSolver):
                     ray_samples, rays_translation, rays_direction, rgb_truth = ray_batch
 
                     with torch.no_grad():
-                        distances = ray_samples[:, :, None, :] - goal_vertices[:, None, :, :].expand(
-                            (-1, ray_samples.shape[1], -1, -1))  # [batchsize, number_samples, number_vertices, 3]
-                        distances = torch.norm(distances, dim=-1)  # [batchsize, number_samples, number_vertices]
-                        attentions = distances - self.args.warp_radius  # [batchsize, number_samples, number_vertices]
-                        attentions = F.relu(-attentions)
-
-                        # attentions = torch.softmax(self.args.warp_temperature * attentions, dim=-1)
-                        attentions = attentions / (attentions.sum(-1, keepdims=True) + 1e-5)
-
-                        warps = warp[:, None, :, :] * attentions[:, :, :,
-                                                      None]  # [batchsize, number_samples, number_vertices, 3]
-                        warps = warps.sum(dim=-2)  # [batchsize, number_samples, 3]
+                        if self.args.warp_number_neighbours > 0:
+                            warps = sparse_vertex_warp(ray_samples, goal_vertices, warp[:1], self.args.warp_radius,
+                                                       self.args.warp_number_neighbours)  # [batchsize, number_samples, 3]
+                        else:
+                            distances = ray_samples[:, :, None, :] - goal_vertices[:, None, :, :].expand(
+                                (-1, ray_samples.shape[1], -1, -1))  # [batchsize, number_samples, number_vertices, 3]
+                            distances = torch.norm(distances, dim=-1)  # [batchsize, number_samples, number_vertices]
+                            attentions = distances - self.args.warp_radius  # [batchsize, number_samples, number_vertices]
+                            attentions = F.relu(-attentions)
+
+                            # attentions = torch.softmax(self.args.warp_temperature * attentions, dim=-1)
+                            attentions = attentions / (attentions.sum(-1, keepdims=True) + 1e-5)
+
+                            warps = warp[:, None, :, :] * attentions[:, :, :,
+                                                          None]  # [batchsize, number_samples, number_vertices, 3]
+                            warps = warps.sum(dim=-2)  # [batchsize, number_samples, 3]
                         warped_samples = ray_samples + warps
 
                         samples_encoding = self.position_encoder.encode(warped_samples)
@@ -258,4 +273,5 @@ class ImageWiseSolver(NerfSolver):
                                                        val_loader) * iter_per_image_val)},
                                     epoch + 1)
             self.writer.add_scalar('Pose difference', pose_loss / iter_per_image * len(train_loader), epoch + 1)
+        profiler.stop()
         print('FINISH.')
@@ -3,6 +3,11 @@ from torch.utils.tensorboard import SummaryWriter
 import numpy as np
 
 from models.nerf_pipeline import NerfPipeline
+from util.checkpoint_manager import CheckpointManager, latest_checkpoint
+from util.distributed import DisabledWriter, all_reduce_gradients, broadcast_parameters, is_main_process, \
+    set_epoch, solver_device
+from util.image_accumulator import ImageAccumulator
+from util.step_profiler import StepProfiler
 from utils import PositionalEncoder, tensorboard_rerenders, vedo_data, vedo_data, save_run
 
 
@@ -34,9 +39,10 @@ class NerfSolver():
         self.loss_func = loss_func
         self.positions_encoder = positions_encoder
         self.directions_encoder = directions_encoder
-        self.writer = SummaryWriter()
+        # only rank 0 of a distributed run logs
+        self.writer = SummaryWriter() if is_main_process() else DisabledWriter()
         self.args = args
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.device = solver_device()
         self.model_coarse = model_coarse.to(self.device)
         self.model_fine = model_fine.to(self.device)
         self.pipeline = self.init_pipeline()
@@ -45,6 +51,40 @@ class NerfSolver():
         return NerfPipeline(self.model_coarse, self.model_fine, self.args, self.positions_encoder,
                             self.directions_encoder)
 
+    def init_profiler(self, samples_per_ray: int = None) -> StepProfiler:
+        """
+        Step profiler of the training loop that is shared with the pipeline (only active with args.profile).
+        """
+        profiler = StepProfiler(self.writer, self.args, self.device, samples_per_ray)
+        if getattr(self, 'pipeline', None) is not None:
+            self.pipeline.profiler = profiler
+        return profiler
+
+    def checkpoint_models(self) -> dict:
+        """
+        Models of the checkpoints by the name of their file in the run directory.
+        """
+        return {'model_coarse': self.model_coarse, 'model_fine': self.model_fine}
+
+    def init_checkpoints(self):
+        """
+        Checkpoint manager of the run that resumes from the latest checkpoint in args.load_run if there is one.
+        The ranks of a distributed run start with the models of rank 0.
+
+        Returns
+        -------
+        checkpoints : CheckpointManager
+        start_epoch : int
+            First epoch to train (0 without a checkpoint to resume from).
+        """
+        checkpoints = CheckpointManager(self.writer.log_dir, self.checkpoint_models(), self.optim,
+                                        self.args.checkpoint_keep, bool(self.args.checkpoint_async))
+        start_epoch = 0
+        if self.args.load_run is not None and latest_checkpoint(self.args.load_run) is not None:
+            start_epoch, _ = checkpoints.load(self.args.load_run)
+        broadcast_parameters(self.optim)
+        return checkpoints, start_epoch
+
     def nerf_loss(self, rgb, rgb_fine, rgb_truth):
         loss_coarse = self.loss_func(rgb, rgb_truth)
         loss_fine = self.loss_func(rgb_fine, rgb_truth)
@@ -66,28 +106,40 @@ class NerfSolver():
         """
         args = self.args
         iter_per_epoch = len(train_loader)
+        profiler = self.init_profiler()
+        checkpoints, start_epoch = self.init_checkpoints()
+        # the config does not change during training, the models are written with the checkpoints
+        save_run(self.writer.log_dir, [], [], parser)
 
         print('START TRAIN.')
 
-        for epoch in range(args.num_epochs):  # loop over the dataset multiple times
+        for epoch in range(start_epoch, args.num_epochs):  # loop over the dataset multiple times
+            set_epoch(train_loader, epoch)
             self.model_coarse.train()
             self.model_fine.train()
             train_loss = 0
-            for i, data in enumerate(train_loader):
-                for j, element in enumerate(data):
-                    data[j] = element.to(self.device)
+            for i, data in enumerate(profiler.iterate(train_loader)):
+                with profiler.section('to_device'):
+                    for j, element in enumerate(data):
+                        data[j] = element.to(self.device)
                 rgb_truth = data[-1]
 
-                rgb, rgb_fine, ray_samples, densities = self.pipeline(data)
+                with profiler.section('forward'):
+                    rgb, rgb_fine, ray_samples, densities = self.pipeline(data)
 
                 self.optim.zero_grad()
 
                 loss = self.nerf_loss(rgb, rgb_fine, rgb_truth)
-                loss.backward()
-                self.optim.step()
+                with profiler.section('backward'):
+                    loss.backward()
+                with profiler.section('all_reduce'):
+                    all_reduce_gradients(self.optim)
+                with profiler.section('optimizer'):
+                    self.optim.step()
+                profiler.step(len(rgb_truth))
 
                 loss_item = loss.item()
-                if i % args.log_iterations == args.log_iterations - 1:
+                if i % args.log_iterations == args.log_iterations - 1 and is_main_process():
                     print('[Epoch %d, Iteration %5d/%5d] TRAIN loss: %.7f' %
                           (epoch + 1, i + 1, iter_per_epoch, loss_item))
                     if args.early_validation:
@@ -109,6 +161,9 @@ class NerfSolver():
                                                 i // args.log_iterations + epoch * (
                                                         iter_per_epoch // args.log_iterations))
                 train_loss += loss_item
+            if not is_main_process():
+                # validation, logging and checkpoints only on rank 0
+                continue
             print('[Epoch %d] Average loss of Epoch: %.7f' %
                   (epoch + 1, train_loss / iter_per_epoch))
 
@@ -116,10 +171,8 @@ class NerfSolver():
             self.model_fine.eval()
             val_loss = 0
             rerender_images = []
-            samples = []
             ground_truth_images = []
-            densities_list = []
-            image_counter = 0
+            accumulator = ImageAccumulator(h, w)
             for i, data in enumerate(val_loader):
                 for j, element in enumerate(data):
                     data[j] = element.to(self.device)
@@ -130,25 +183,15 @@ class NerfSolver():
                     loss = self.nerf_loss(rgb, rgb_fine, rgb_truth)
                     val_loss += loss.item()
 
-                    ground_truth_images.append(rgb_truth.detach().cpu().numpy())
-                    rerender_images.append(rgb_fine.detach().cpu().numpy())
-                    samples.append(ray_samples.detach().cpu().numpy())
-                    densities_list.append(densities.detach().cpu().numpy())
-                    if np.concatenate(densities_list).shape[0]>=(h*w):
-                        while np.concatenate(densities_list).shape[0]>=(h*w):
-                            densities_list = np.concatenate(densities_list)
-                            image_densities = densities_list[:h*w].reshape(-1)
-                            densities_list = [densities_list[h*w:]]
-                            samples = np.concatenate(samples)
-                            image_samples = samples[:h*w].reshape(-1, 3)
-                            samples = [samples[h*w:]]
-                            vedo_data(self.writer, image_densities, image_samples,
-                                      image_warps=None, epoch=epoch + 1,
-                                      image_idx=image_counter)
-                            image_counter += 1
+                    for image in accumulator.add(rgb=rgb_fine, rgb_truth=rgb_truth, samples=ray_samples,
+                                                 densities=densities):
+                        vedo_data(self.writer, image['densities'].reshape(-1), image['samples'].reshape(-1, 3),
+                                  image_warps=None, epoch=epoch + 1, image_idx=len(rerender_images))
+                        rerender_images.append(image['rgb'].reshape((h, w, 3)))
+                        ground_truth_images.append(image['rgb_truth'].reshape((h, w, 3)))
             if len(val_loader) != 0:
-                rerender_images = np.concatenate(rerender_images, 0).reshape((-1, h, w, 3))
-                ground_truth_images = np.concatenate(ground_truth_images).reshape((-1, h, w, 3))
+                rerender_images = np.stack(rerender_images)
+                ground_truth_images = np.stack(ground_truth_images)
 
             tensorboard_rerenders(self.writer, args.number_validation_images, rerender_images, ground_truth_images,
                                   step=epoch, ray_warps=None)
@@ -158,6 +201,7 @@ class NerfSolver():
                                                    'val loss': val_loss / (len(val_loader) or not len(val_loader))},
                                     epoch)
 
-            save_run(self.writer.log_dir, [self.model_coarse, self.model_fine],
-                         ['model_coarse.pt', 'model_fine.pt'], parser)
+            checkpoints.save(epoch + 1, (epoch + 1) * iter_per_epoch)
+        checkpoints.wait()
+        profiler.stop()
         print('FINISH.')
@@ -2,6 +2,7 @@ import torch
 import numpy as np
 
 #from solver.nerf_solver import NerfSolver
+from util.step_profiler import StepProfiler
 from utils import tensorboard_rerenders, tensorboard_warps
 from torch.utils.tensorboard import SummaryWriter
 
@@ -43,23 +44,30 @@ class SmplEstimatorSolver():
 
         args = self.args
         iter_per_epoch = len(train_loader)
+        # the estimator sees images instead of rays, so rays per second are images per second
+        profiler = StepProfiler(self.writer, args, self.device, samples_per_ray=1)
 
         print('START TRAIN.')
 
         for epoch in range(args.num_epochs):  # loop over the dataset multiple times
             ### Training ###
             train_loss = 0
-            for i, data in enumerate(train_loader):
-                for j, element in enumerate(data):
-                    data[j] = element.to(self.device)
+            for i, data in enumerate(profiler.iterate(train_loader)):
+                with profiler.section('to_device'):
+                    for j, element in enumerate(data):
+                        data[j] = element.to(self.device)
                 image_truth, goal_pose_truth = data
                 goal_pose_truth = torch.stack([goal_pose_truth[:, 38], goal_pose_truth[:, 41]], axis=-1)
-                goal_pose = self.model_smpl_estimator.forward(image_truth)
+                with profiler.section('forward'):
+                    goal_pose = self.model_smpl_estimator.forward(image_truth)
                 self.optim.zero_grad()
                 loss = self.loss_func(goal_pose, goal_pose_truth)
-                loss.backward()
+                with profiler.section('backward'):
+                    loss.backward()
                 loss_item = loss.item()
-                self.optim.step()
+                with profiler.section('optimizer'):
+                    self.optim.step()
+                profiler.step(len(image_truth))
                 if i % args.log_iterations == args.log_iterations - 1:
                     print('[Epoch %d, Iteration %5d/%5d] TRAIN loss: %.7f' %
                           (epoch + 1, i + 1, iter_per_epoch, loss_item))
@@ -85,4 +93,5 @@ class SmplEstimatorSolver():
             self.writer.add_scalars('Loss Curve', {'train loss': train_loss / iter_per_epoch,
                                                    'val loss': val_loss / (len(val_loader) or not len(val_loader))},
                                     epoch)
+        profiler.stop()
         print('FINISH.')
\ No newline at end of file
@@ -3,6 +3,8 @@ import numpy as np
 
 from models.smpl_nerf_pipeline import SmplNerfPipeline
 from solver.nerf_solver import NerfSolver
+from util.distributed import all_reduce_gradients, is_main_process, set_epoch, solver_device
+from util.image_accumulator import ImageAccumulator
 from utils import PositionalEncoder, tensorboard_rerenders, tensorboard_warps, GaussianMixture, \
     vedo_data, vedo_data
 
@@ -17,7 +19,7 @@ class SmplNerfSolver(NerfSolver):
                  directions_encoder: PositionalEncoder, human_pose_encoder: PositionalEncoder,
                  canonical_smpl, args,
                  optim=torch.optim.Adam, loss_func=torch.nn.MSELoss()):
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.device = solver_device()
         self.model_warp_field = model_warp_field.to(self.device)
         self.human_pose_encoder = human_pose_encoder
         self.canonical_mixture = GaussianMixture(canonical_smpl, args.gmm_std, self.device)
@@ -42,6 +44,10 @@ class SmplNerfSolver(NerfSolver):
         # loss += 0.5 * torch.mean(torch.norm(warp, p=1, dim=-1))
         return loss, loss_coarse, loss_fine
 
+    def checkpoint_models(self) -> dict:
+        return {'model_coarse': self.model_coarse, 'model_fine': self.model_fine,
+                'model_warp_field': self.model_warp_field}
+
     def train(self, train_loader, val_loader, h: int, w: int):
         """
         Train coarse and fine model on training data and run validation
@@ -57,31 +63,41 @@ class SmplNerfSolver(NerfSolver):
         """
         args = self.args
         iter_per_epoch = len(train_loader)
+        profiler = self.init_profiler()
+        checkpoints, start_epoch = self.init_checkpoints()
 
         print('START TRAIN.')
 
-        for epoch in range(args.num_epochs):  # loop over the dataset multiple times
+        for epoch in range(start_epoch, args.num_epochs):  # loop over the dataset multiple times
+            set_epoch(train_loader, epoch)
             self.model_coarse.train()
             self.model_fine.train()
             train_loss = 0
             train_coarse_loss = 0
             train_fine_loss = 0
-            for i, data in enumerate(train_loader):
-                for j, element in enumerate(data):
-                    data[j] = element.to(self.device)
+            for i, data in enumerate(profiler.iterate(train_loader)):
+                with profiler.section('to_device'):
+                    for j, element in enumerate(data):
+                        data[j] = element.to(self.device)
                 rgb_truth = data[-1]
 
-                rgb, rgb_fine, warp, ray_samples, warped_samples, densities = self.pipeline(data)
+                with profiler.section('forward'):
+                    rgb, rgb_fine, warp, ray_samples, warped_samples, densities = self.pipeline(data)
 
                 self.optim.zero_grad()
                 loss, loss_coarse, loss_fine, = self.smpl_nerf_loss(rgb, rgb_fine, rgb_truth,
                                                                     warp, densities,
                                                                     warped_samples)
-                loss.backward()
-                self.optim.step()
+                with profiler.section('backward'):
+                    loss.backward()
+                with profiler.section('all_reduce'):
+                    all_reduce_gradients(self.optim)
+                with profiler.section('optimizer'):
+                    self.optim.step()
+                profiler.step(len(rgb_truth))
 
                 loss_item = loss.item()
-                if i % args.log_iterations == args.log_iterations - 1:
+                if i % args.log_iterations == args.log_iterations - 1 and is_main_process():
                     print('[Epoch %d, Iteration %5d/%5d] TRAIN loss: %.7f' %
                           (epoch + 1, i + 1, iter_per_epoch, loss_item))
                     if args.early_validation:
@@ -110,6 +126,9 @@ class SmplNerfSolver(NerfSolver):
                 train_loss += loss_item
                 train_coarse_loss += loss_coarse.item()
                 train_fine_loss += loss_fine.item()
+            if not is_main_process():
+                # validation, logging and checkpoints only on rank 0
+                continue
             print('[Epoch %d] Average loss of Epoch: %.7f' %
                   (epoch + 1, train_loss / iter_per_epoch))
 
@@ -118,11 +137,8 @@ class SmplNerfSolver(NerfSolver):
             val_loss = 0
             rerender_images = []
             ground_truth_images = []
-            samples = []
-            warps = []
             ray_warp_magnitudes = []
-            densities_list = []
-            image_counter = 0
+            accumulator = ImageAccumulator(h, w)
             for i, data in enumerate(val_loader):
                 for j, element in enumerate(data):
                     data[j] = element.to(self.device)
@@ -134,32 +150,19 @@ class SmplNerfSolver(NerfSolver):
                                                                        warped_samples)
                     val_loss += loss.item()
 
-                    ground_truth_images.append(rgb_truth.detach().cpu().numpy())
-                    rerender_images.append(rgb_fine.detach().cpu().numpy())
-                    samples.append(ray_samples.detach().cpu().numpy())
-                    warps.append(warp.detach().cpu().numpy())
-                    densities_list.append(densities.detach().cpu().numpy())
-                    warp_magnitude = np.linalg.norm(warp.detach().cpu().numpy(), axis=-1)  # [batchsize, number_samples]
-                    ray_warp_magnitudes.append(warp_magnitude.mean(axis=1))  # mean over the samples => [batchsize]
-                    if np.concatenate(densities_list).shape[0] >= (h * w):
-                        while np.concatenate(densities_list).shape[0] >= (h * w):
-                            densities_list = np.concatenate(densities_list)
-                            image_densities = densities_list[:h * w].reshape(-1)
-                            densities_list = [densities_list[h * w:]]
-                            samples = np.concatenate(samples)
-                            image_samples = samples[:h * w].reshape(-1, 3)
-                            samples = [samples[h * w:]]
-                            warps = np.concatenate(warps)
-                            image_warps = warps[:h * w].reshape(-1, 3)
-                            warps = [warps[h * w:]]
-                            vedo_data(self.writer, image_densities, image_samples,
-                                      image_warps=image_warps, epoch=epoch + 1,
-                                      image_idx=image_counter)
-                            image_counter += 1
+                    for image in accumulator.add(rgb=rgb_fine, rgb_truth=rgb_truth, samples=ray_samples,
+                                                 warps=warp, densities=densities):
+                        vedo_data(self.writer, image['densities'].reshape(-1), image['samples'].reshape(-1, 3),
+                                  image_warps=image['warps'].reshape(-1, 3), epoch=epoch + 1,
+                                  image_idx=len(rerender_images))
+                        rerender_images.append(image['rgb'].reshape((h, w, 3)))
+                        ground_truth_images.append(image['rgb_truth'].reshape((h, w, 3)))
+                        # mean warp magnitude over the samples of every ray
+                        ray_warp_magnitudes.append(np.linalg.norm(image['warps'], axis=-1).mean(axis=1).reshape((h, w)))
             if len(val_loader) != 0:
-                rerender_images = np.concatenate(rerender_images, 0).reshape((-1, h, w, 3))
-                ground_truth_images = np.concatenate(ground_truth_images).reshape((-1, h, w, 3))
-                ray_warp_magnitudes = np.concatenate(ray_warp_magnitudes).reshape((-1, h, w))
+                rerender_images = np.stack(rerender_images)
+                ground_truth_images = np.stack(ground_truth_images)
+                ray_warp_magnitudes = np.stack(ray_warp_magnitudes)
 
             tensorboard_rerenders(self.writer, args.number_validation_images, rerender_images, ground_truth_images,
                                   step=epoch + 1, ray_warps=ray_warp_magnitudes)
@@ -171,4 +174,7 @@ class SmplNerfSolver(NerfSolver):
             self.writer.add_scalars('Train Losses', {'coarse': train_coarse_loss / iter_per_epoch,
                                                      'fine': train_fine_loss / iter_per_epoch},
                                     epoch + 1)
+            checkpoints.save(epoch + 1, (epoch + 1) * iter_per_epoch)
+        checkpoints.wait()
+        profiler.stop()
         print('FINISH.')
@@ -15,3 +15,7 @@ class VertexSphereSolver(SmplNerfSolver):
     def init_pipeline(self):
         return VertexSpherePipeline(self.model_coarse, self.model_fine, self.args, self.positions_encoder,
                                     self.directions_encoder)
+
+    def checkpoint_models(self) -> dict:
+        # the vertex sphere pipeline has no warp field
+        return {'model_coarse': self.model_coarse, 'model_fine': self.model_fine}
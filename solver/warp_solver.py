@@ -57,22 +57,28 @@ class WarpSolver(NerfSolver):
         """
         args = self.args
         iter_per_epoch = len(train_loader)
+        profiler = self.init_profiler(samples_per_ray=1)
 
         print('START TRAIN.')
 
         for epoch in range(args.num_epochs):  # loop over the dataset multiple times
             ### Training ###
             train_loss = 0
-            for i, data in enumerate(train_loader):
-                for j, element in enumerate(data):
-                    data[j] = element.to(self.device)
+            for i, data in enumerate(profiler.iterate(train_loader)):
+                with profiler.section('to_device'):
+                    for j, element in enumerate(data):
+                        data[j] = element.to(self.device)
                 ray_sample, ray_translation, samples_direction, warp_truth, rgb_truth, goal_pose = data
-                warp = self.forward(ray_sample, goal_pose)
+                with profiler.section('forward'):
+                    warp = self.forward(ray_sample, goal_pose)
                 self.optim.zero_grad()
                 loss = self.loss_func(warp, warp_truth)
-                loss.backward()
+                with profiler.section('backward'):
+                    loss.backward()
                 loss_item = loss.item()
-                self.optim.step()
+                with profiler.section('optimizer'):
+                    self.optim.step()
+                profiler.step(len(ray_sample))
                 if i % args.log_iterations == args.log_iterations - 1:
                     print('[Epoch %d, Iteration %5d/%5d] TRAIN loss: %.7f' %
                           (epoch + 1, i + 1, iter_per_epoch, loss_item))
@@ -125,4 +131,5 @@ class WarpSolver(NerfSolver):
             self.writer.add_scalars('Loss Curve', {'train loss': train_loss / iter_per_epoch,
                                                    'val loss': val_loss / (len(val_loader) or not len(val_loader))},
                                     epoch)
+        profiler.stop()
         print('FINISH.')
@@ -1,8 +1,14 @@
+import os
+import sys
 import timeit
 
 import torch
 import numpy as np
-from torchsearchsorted import searchsorted, numpy_searchsorted
+from torchsearchsorted import numpy_searchsorted
+
+# the backends of sample_pdf live in the SMPLNeRF repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from util.searchsorted import searchsorted, default_backend, SEARCHSORTED_CPU_AVAILABLE, SEARCHSORTED_GPU_AVAILABLE
 
 B = 5_000
 A = 300
@@ -37,11 +43,25 @@ def get_tensors(device):
         torch.cuda.synchronize()
     return a, v, out
 
-def searchsorted_synchronized(a,v,out=None,side='left'):
-    out = searchsorted(a,v,out,side)
+def searchsorted_synchronized(a, v, side='left', backend=None):
+    out = searchsorted(a, v, side, backend)
     torch.cuda.synchronize()
     return out
 
+
+def backends(device):
+    """
+    Backends that are available on the device: torch.searchsorted, the
+    torchsearchsorted extension and the pure PyTorch fallback.
+    """
+    available = ['fallback']
+    if hasattr(torch, 'searchsorted'):
+        available.insert(0, 'torch')
+    if SEARCHSORTED_GPU_AVAILABLE if device == 'cuda' else SEARCHSORTED_CPU_AVAILABLE:
+        available.insert(-1, 'extension')
+    return available
+
+
 numpy = timeit.repeat(
     stmt="numpy_searchsorted(a, v, side='left')",
     setup="a, v, out = get_arrays()",
@@ -51,21 +71,16 @@ numpy = timeit.repeat(
 )
 print('Numpy: ', min(numpy), sep='\t')
 
-cpu = timeit.repeat(
-    stmt="searchsorted(a, v, out, side='left')",
-    setup="a, v, out = get_tensors(device='cpu')",
-    globals=globals(),
-    repeat=repeats,
-    number=number
-)
-print('CPU: ', min(cpu), sep='\t')
-
-if torch.cuda.is_available():
-    gpu = timeit.repeat(
-        stmt="searchsorted_synchronized(a, v, out, side='left')",
-        setup="a, v, out = get_tensors(device='cuda')",
-        globals=globals(),
-        repeat=repeats,
-        number=number
-    )
-    print('CUDA: ', min(gpu), sep='\t')
+devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+for device in devices:
+    print('Default backend on {}: {}'.format(device, default_backend(torch.device(device))))
+    statement = 'searchsorted_synchronized' if device == 'cuda' else 'searchsorted'
+    for backend in backends(device):
+        times = timeit.repeat(
+            stmt="{}(a, v, side='left', backend='{}')".format(statement, backend),
+            setup="a, v, out = get_tensors(device='{}')".format(device),
+            globals=globals(),
+            repeat=repeats,
+            number=number
+        )
+        print('{} {}: '.format(device.upper(), backend), min(times), sep='\t')
@@ -7,7 +7,10 @@ from torchvision.transforms import transforms
 from config_parser import config_parser
 from datasets.dummy_dynamic_dataset import DummyDynamicDataset
 from datasets.image_wise_dataset import ImageWiseDataset
+from datasets.ray_batch_loader import RayBatchLoader
 from datasets.rays_from_images_dataset import RaysFromImagesDataset
+from datasets.ray_store import RayStore
+from datasets.ray_index_dataset import RayIndexDataset
 from datasets.single_sample_dataset import SmplDataset
 from datasets.smpl_nerf_dataset import SmplNerfDataset
 from datasets.smpl_estimator_dataset import SmplEstimatorDataset
@@ -33,10 +36,14 @@ import numpy as np
 
 from solver.smpl_nerf_solver import SmplNerfSolver
 from solver.singel_sample_solver import SmplSolver
-from utils import PositionalEncoder, save_run
+from utils import PositionalEncoder, MemoisedPositionalEncoder, save_run
 from models.smpl_estimator import SmplEstimator
 from solver.smpl_estimator_solver import SmplEstimatorSolver
 from inference import inference_gif
+from util.cpu_threads import configure_threads
+from util.distributed import barrier, destroy_distributed, get_rank, get_world_size, init_distributed, \
+    is_main_process
+from util.occupancy_grid import occupancy_grid_from_dataset
 
 np.random.seed(0)
 
@@ -44,27 +51,53 @@ np.random.seed(0)
 def train():
     parser = config_parser()
     args = parser.parse_args()
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    device = init_distributed(args)
     args.default_device = device
+    args.thread_config = configure_threads(args)
     if args.model_type not in ["nerf", "smpl_nerf", "append_to_nerf", "smpl", "warp", 'vertex_sphere', "smpl_estimator",
                                "original_nerf", 'dummy_dynamic', 'image_wise_dynamic',
                                "append_vertex_locations_to_nerf", 'append_smpl_params']:
         raise Exception("The model type ", args.model_type, " does not exist.")
+    if args.distributed and args.model_type not in ["nerf", "original_nerf", "smpl", "smpl_nerf", "append_to_nerf",
+                                                    "append_smpl_params", "vertex_sphere", "dummy_dynamic",
+                                                    "append_vertex_locations_to_nerf"]:
+        raise Exception("The model type ", args.model_type, " does not support distributed training.")
+    if args.compact_rays and args.use_ray_store:
+        raise Exception("--compact_rays and --use_ray_store are two different ways to store the rays, "
+                        "set only one of them.")
 
-    transform = transforms.Compose(
-        [NormalizeRGB(), CoarseSampling(args.near, args.far, args.number_coarse_samples), ToTensor()])
+    coarse_sampling = CoarseSampling(args.near, args.far, args.number_coarse_samples, args.perturb_per_bin)
+    transform = transforms.Compose([NormalizeRGB(), coarse_sampling, ToTensor()])
 
     train_dir = os.path.join(args.dataset_dir, 'train')
     val_dir = os.path.join(args.dataset_dir, 'val')
-    if args.model_type == "nerf":
-        train_data = RaysFromImagesDataset(train_dir, os.path.join(train_dir, 'transforms.json'), transform)
-        val_data = RaysFromImagesDataset(val_dir, os.path.join(val_dir, 'transforms.json'), transform)
+    if args.use_ray_store and args.model_type in ["nerf", "smpl_nerf", "append_to_nerf", "append_smpl_params"]:
+        # rank 0 packs the ray stores, the other ranks only open them once they are current
+        if is_main_process():
+            for split_dir in [train_dir, val_dir]:
+                RayStore.open(split_dir, os.path.join(split_dir, 'transforms.json'))
+        barrier()
+    if args.model_type == "nerf" and args.compact_rays:
+        train_data = RayIndexDataset(train_dir, os.path.join(train_dir, 'transforms.json'), transform)
+        val_data = RayIndexDataset(val_dir, os.path.join(val_dir, 'transforms.json'), transform)
+    elif args.model_type == "nerf":
+        train_data = RaysFromImagesDataset(train_dir, os.path.join(train_dir, 'transforms.json'), transform,
+                                           args.use_ray_store)
+        val_data = RaysFromImagesDataset(val_dir, os.path.join(val_dir, 'transforms.json'), transform,
+                                         args.use_ray_store)
     elif args.model_type == "smpl" or args.model_type == "warp":
         train_data = SmplDataset(train_dir, os.path.join(train_dir, 'transforms.json'), args, transform=NormalizeRGB())
         val_data = SmplDataset(val_dir, os.path.join(val_dir, 'transforms.json'), args, transform=NormalizeRGB())
+    elif (args.model_type == "smpl_nerf" or args.model_type == "append_to_nerf" or
+          args.model_type == "append_smpl_params") and args.compact_rays:
+        train_data = RayIndexDataset(train_dir, os.path.join(train_dir, 'transforms.json'), transform,
+                                     return_human_pose=True)
+        val_data = RayIndexDataset(val_dir, os.path.join(val_dir, 'transforms.json'), transform,
+                                   return_human_pose=True)
     elif args.model_type == "smpl_nerf" or args.model_type == "append_to_nerf" or args.model_type == "append_smpl_params":
-        train_data = SmplNerfDataset(train_dir, os.path.join(train_dir, 'transforms.json'), transform)
-        val_data = SmplNerfDataset(val_dir, os.path.join(val_dir, 'transforms.json'), transform)
+        train_data = SmplNerfDataset(train_dir, os.path.join(train_dir, 'transforms.json'), transform,
+                                     args.use_ray_store)
+        val_data = SmplNerfDataset(val_dir, os.path.join(val_dir, 'transforms.json'), transform, args.use_ray_store)
     elif args.model_type == "vertex_sphere":
         train_data = VertexSphereDataset(train_dir, os.path.join(train_dir, 'transforms.json'), args)
         val_data = VertexSphereDataset(val_dir, os.path.join(val_dir, 'transforms.json'), args)
@@ -97,8 +130,27 @@ def train():
                                       transform,
                                       args)
         val_data = ImageWiseDataset(val_dir, os.path.join(val_dir, 'transforms.json'), smpl_estimator, transform, args)
-    train_loader = torch.utils.data.DataLoader(train_data, batch_size=args.batchsize, shuffle=True, num_workers=0)
-    val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batchsize_val, shuffle=False, num_workers=0)
+    if args.occupancy_grid and not (args.batch_loader and hasattr(train_data, 'get_batch')):
+        # the datasets of a DataLoader are already coarse sampled by their transform
+        raise Exception("The occupancy grid needs the plain rays of a batch loader, set --batch_loader=1 "
+                        "with a dataset that implements get_batch.")
+    if args.batch_loader and hasattr(train_data, 'get_batch'):
+        # without a coarse sampling in the loader the pipelines sample the plain rays themselves
+        loader_coarse_sampling = None if args.coarse_sampling_in_pipeline or args.occupancy_grid else coarse_sampling
+        # the train rays are sharded across the ranks of a distributed run, rank 0 validates on all rays
+        train_loader = RayBatchLoader(train_data, args.batchsize, loader_coarse_sampling, shuffle=True, device=device,
+                                      rank=get_rank(), world_size=get_world_size())
+        val_loader = RayBatchLoader(val_data, args.batchsize_val, loader_coarse_sampling, shuffle=False,
+                                    device=device)
+    elif args.distributed:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_data, get_world_size(), get_rank(),
+                                                                        shuffle=True, drop_last=True)
+        train_loader = torch.utils.data.DataLoader(train_data, batch_size=args.batchsize, sampler=train_sampler,
+                                                   num_workers=0)
+        val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batchsize_val, shuffle=False, num_workers=0)
+    else:
+        train_loader = torch.utils.data.DataLoader(train_data, batch_size=args.batchsize, shuffle=True, num_workers=0)
+        val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batchsize_val, shuffle=False, num_workers=0)
     position_encoder = PositionalEncoder(args.number_frequencies_postitional, args.use_identity_positional)
     direction_encoder = PositionalEncoder(args.number_frequencies_directional, args.use_identity_directional)
     model_coarse = RenderRayNet(args.netdepth, args.netwidth, position_encoder.output_dim * 3,
@@ -107,7 +159,7 @@ def train():
                               direction_encoder.output_dim * 3, skips=args.skips_fine)
 
     if args.model_type == "smpl_nerf":
-        human_pose_encoder = PositionalEncoder(args.number_frequencies_pose, args.use_identity_pose)
+        human_pose_encoder = MemoisedPositionalEncoder(args.number_frequencies_pose, args.use_identity_pose)
         positions_dim = position_encoder.output_dim if args.human_pose_encoding else 1
         human_pose_dim = human_pose_encoder.output_dim if args.human_pose_encoding else 1
         model_warp_field = WarpFieldNet(args.netdepth_warp, args.netwidth_warp, positions_dim * 3,
@@ -116,6 +168,9 @@ def train():
         solver = SmplNerfSolver(model_coarse, model_fine, model_warp_field, position_encoder, direction_encoder,
                                 human_pose_encoder, train_data.canonical_smpl, args, torch.optim.Adam,
                                 torch.nn.MSELoss())
+        if args.occupancy_grid:
+            solver.pipeline.occupancy_grid = occupancy_grid_from_dataset(train_data, args.occupancy_grid_margin,
+                                                                         args.occupancy_grid_resolution)
         solver.train(train_loader, val_loader, train_data.h, train_data.w)
 
         save_run(solver.writer.log_dir, [model_coarse, model_fine, model_warp_field],
@@ -132,23 +187,26 @@ def train():
     elif args.model_type == 'nerf' or args.model_type == "original_nerf":
         solver = NerfSolver(model_coarse, model_fine, position_encoder, direction_encoder, args, torch.optim.Adam,
                             torch.nn.MSELoss())
+        if args.occupancy_grid:
+            solver.pipeline.occupancy_grid = occupancy_grid_from_dataset(train_data, args.occupancy_grid_margin,
+                                                                         args.occupancy_grid_resolution)
         solver.train(train_loader, val_loader, train_data.h, train_data.w, parser)
         save_run(solver.writer.log_dir, [model_coarse, model_fine],
                  ['model_coarse.pt', 'model_fine.pt'], parser)
 
     elif args.model_type == 'warp':
-        human_pose_encoder = PositionalEncoder(args.number_frequencies_pose, args.use_identity_pose)
+        human_pose_encoder = MemoisedPositionalEncoder(args.number_frequencies_pose, args.use_identity_pose)
         positions_dim = position_encoder.output_dim if args.human_pose_encoding else 1
         human_pose_dim = human_pose_encoder.output_dim if args.human_pose_encoding else 1
         model_warp_field = WarpFieldNet(args.netdepth_warp, args.netwidth_warp, positions_dim * 3,
                                         human_pose_dim * 2)
-        human_pose_encoder = PositionalEncoder(args.number_frequencies_pose, args.use_identity_pose)
+        human_pose_encoder = MemoisedPositionalEncoder(args.number_frequencies_pose, args.use_identity_pose)
         solver = WarpSolver(model_warp_field, position_encoder, direction_encoder, human_pose_encoder, args)
         solver.train(train_loader, val_loader, train_data.h, train_data.w)
         save_run(solver.writer.log_dir, [model_warp_field],
                  ['model_warp_field.pt'], parser)
     elif args.model_type == 'append_smpl_params':
-        human_pose_encoder = PositionalEncoder(args.number_frequencies_pose, args.use_identity_pose)
+        human_pose_encoder = MemoisedPositionalEncoder(args.number_frequencies_pose, args.use_identity_pose)
         human_pose_dim = human_pose_encoder.output_dim if args.human_pose_encoding else 1
 
         model_coarse = RenderRayNet(args.netdepth, args.netwidth, position_encoder.output_dim * 3,
@@ -180,10 +238,11 @@ def train():
                  ['model_coarse.pt', 'model_fine.pt'], parser)
 
         model_dependent = [human_pose_encoder, human_pose_dim]
-        inference_gif(solver.writer.log_dir, args.model_type, args, train_data, val_data, position_encoder,
-                      direction_encoder, model_coarse, model_fine, model_dependent)
+        if is_main_process():
+            inference_gif(solver.writer.log_dir, args.model_type, args, train_data, val_data, position_encoder,
+                          direction_encoder, model_coarse, model_fine, model_dependent)
     elif args.model_type == 'append_to_nerf':
-        human_pose_encoder = PositionalEncoder(args.number_frequencies_pose, args.use_identity_pose)
+        human_pose_encoder = MemoisedPositionalEncoder(args.number_frequencies_pose, args.use_identity_pose)
         human_pose_dim = human_pose_encoder.output_dim if args.human_pose_encoding else 1
         model_coarse = RenderRayNet(args.netdepth, args.netwidth, position_encoder.output_dim * 3,
                                     direction_encoder.output_dim * 3, human_pose_dim * 2,
@@ -200,8 +259,9 @@ def train():
                  ['model_coarse.pt', 'model_fine.pt'], parser)
 
         model_dependent = [human_pose_encoder, human_pose_dim]
-        inference_gif(solver.writer.log_dir, args.model_type, args, train_data, val_data, position_encoder,
-                      direction_encoder, model_coarse, model_fine, model_dependent)
+        if is_main_process():
+            inference_gif(solver.writer.log_dir, args.model_type, args, train_data, val_data, position_encoder,
+                          direction_encoder, model_coarse, model_fine, model_dependent)
     elif args.model_type == 'append_vertex_locations_to_nerf':
         model_coarse = AppendVerticesNet(args.netdepth, args.netwidth, position_encoder.output_dim * 3,
                                          direction_encoder.output_dim * 3, 6890, additional_input_layers=1,
@@ -267,6 +327,7 @@ def train():
         solver.train(train_loader, val_loader, train_data.h, train_data.w)
         save_run(solver.writer.log_dir, [model_coarse, model_fine, smpl_estimator],
                  ['model_coarse.pt', 'model_fine.pt', 'smpl_estimator.pt'], parser)
+    destroy_distributed()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,172 @@
+import glob
+import os
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+
+CHECKPOINT_PATTERN = 'checkpoint_epoch_{:04d}.pt'
+
+
+def state_to_cpu(state):
+    """
+    Copy of a (nested) state dict with all tensors cloned to the cpu, such
+    that it can be written while training continues to change the originals.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: state_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(value) for value in state)
+    return state
+
+
+def atomic_save(state, path: str):
+    """
+    torch.save to a temporary file that replaces path once it is complete, so
+    a preempted write never leaves a truncated file at path.
+    """
+    temporary_path = path + '.tmp'
+    torch.save(state, temporary_path)
+    os.replace(temporary_path, path)
+
+
+def rng_state() -> dict:
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: dict):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def latest_checkpoint(run_dir: str):
+    """
+    Path of the checkpoint of the latest epoch in run_dir or None if there is none.
+    """
+    checkpoints = glob.glob(os.path.join(run_dir, 'checkpoint_epoch_*.pt'))
+    if not checkpoints:
+        return None
+    return max(checkpoints, key=lambda path: int(re.findall(r'checkpoint_epoch_(\d+)\.pt', path)[0]))
+
+
+class CheckpointManager():
+    """
+    Checkpoints of a training run with the state of the models and the
+    optimizer, the epoch and step and the states of the random number
+    generators (torch, cuda, numpy, python), such that a run continues with
+    the same Adam moments after a preemption.
+
+    The states are copied to the cpu in save and written by a background
+    thread, so training only waits for the copy. Every checkpoint is written
+    to a temporary file first and renamed once it is complete. Only the last
+    keep_last checkpoints are kept. Additionally the state dict of every
+    model is written to <name>.pt in the run directory as save_run does.
+    """
+
+    def __init__(self, save_dir: str, models: dict, optimizer, keep_last: int = 3,
+                 asynchronous: bool = True) -> None:
+        """
+        Parameters
+        ----------
+        save_dir : str
+            Directory of the run (log dir of the writer).
+        models : dict
+            Models to save by name, e.g. {'model_coarse': model_coarse}.
+        optimizer : torch.optim.Optimizer
+            Optimizer of the models.
+        keep_last : int, optional
+            Number of checkpoints that are kept, 0 keeps all. The default is 3.
+        asynchronous : bool, optional
+            Write in a background thread. The default is True.
+        """
+        self.save_dir = save_dir
+        self.models = models
+        self.optimizer = optimizer
+        self.keep_last = keep_last
+        self.asynchronous = asynchronous
+        self.thread = None
+        self.error = None
+
+    def save(self, epoch: int, step: int):
+        """
+        Checkpoint after epoch epochs and step optimizer steps.
+        """
+        # at most one pending write, which also bounds the memory of the cpu copies
+        self.wait()
+        state = {'epoch': epoch, 'step': step, 'rng_state': rng_state(),
+                 'optimizer': state_to_cpu(self.optimizer.state_dict()),
+                 'models': {name: state_to_cpu(model.state_dict()) for name, model in self.models.items()}}
+        if self.asynchronous:
+            self.thread = threading.Thread(target=self.write, args=(state,), daemon=True)
+            self.thread.start()
+        else:
+            self.write(state)
+
+    def write(self, state: dict):
+        try:
+            for name, model_state in state['models'].items():
+                atomic_save(model_state, os.path.join(self.save_dir, name + '.pt'))
+            atomic_save(state, os.path.join(self.save_dir, CHECKPOINT_PATTERN.format(state['epoch'])))
+            self.remove_old_checkpoints()
+        except Exception as error:
+            # raised in the training thread by the next wait
+            self.error = error
+
+    def remove_old_checkpoints(self):
+        if self.keep_last <= 0:
+            return
+        checkpoints = sorted(glob.glob(os.path.join(self.save_dir, 'checkpoint_epoch_*.pt')))
+        for path in checkpoints[:-self.keep_last]:
+            os.remove(path)
+
+    def wait(self):
+        """
+        Waits for the pending write and raises its error if it failed.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def load(self, path: str) -> tuple:
+        """
+        Restores models, optimizer and random number generators from a checkpoint.
+
+        Parameters
+        ----------
+        path : str
+            Checkpoint file or run directory (its latest checkpoint is loaded).
+
+        Returns
+        -------
+        epoch : int
+            Number of finished epochs of the checkpoint.
+        step : int
+            Number of optimizer steps of the checkpoint.
+        """
+        if os.path.isdir(path):
+            path = latest_checkpoint(path)
+        # the states are moved to the devices of the models and the optimizer by load_state_dict
+        try:
+            state = torch.load(path, map_location='cpu', weights_only=False)
+        except TypeError:
+            # torch versions without weights_only
+            state = torch.load(path, map_location='cpu')
+        for name, model in self.models.items():
+            model.load_state_dict(state['models'][name])
+        self.optimizer.load_state_dict(state['optimizer'])
+        set_rng_state(state['rng_state'])
+        print('Resume from checkpoint {} after epoch {}'.format(path, state['epoch']))
+        return state['epoch'], state['step']
@@ -0,0 +1,112 @@
+import glob
+import os
+import re
+
+import torch
+
+
+def available_cores() -> list:
+    """
+    Cores this process may run on (its affinity mask, e.g. restricted by a batch scheduler).
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cpu_list(cpu_list: str) -> list:
+    """
+    Cores of a cpu list in the sysfs format, e.g. '0-3,8-11'.
+    """
+    cores = []
+    for part in cpu_list.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cores.extend(range(int(first), int(last) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def numa_nodes() -> dict:
+    """
+    NUMA node of every core read from /sys/devices/system/node, empty if it is not available.
+    """
+    core_nodes = {}
+    for path in glob.glob('/sys/devices/system/node/node*/cpulist'):
+        node = int(re.findall(r'node(\d+)', path)[-1])
+        with open(path) as file:
+            for core in parse_cpu_list(file.read()):
+                core_nodes[core] = node
+    return core_nodes
+
+
+def configure_threads(args) -> dict:
+    """
+    Sizes the intra-op and inter-op thread pools of torch and pins the process
+    to a core set, such that co-located runs (or the ranks of a distributed
+    run on one node) do not oversubscribe the cores of the node.
+
+    The available cores are ordered by NUMA node and split into
+    number_runs equal contiguous core sets, run slot gets the slot-th set, so
+    the core set of a run stays on one NUMA node whenever possible. Without
+    explicit values the intra-op threads are the cores of the set and the
+    inter-op threads one per 16 of them (at least 1, at most 4).
+
+    Parameters
+    ----------
+    args :
+        Arguments with num_threads, num_interop_threads, colocated_runs,
+        run_slot and cpu_affinity, 0 (-1 for run_slot) chooses automatically.
+
+    Returns
+    -------
+    thread_config : dict
+        Chosen number_runs, run_slot, cores, pinned, numa_nodes, num_threads and num_interop_threads.
+    """
+    cores = available_cores()
+    number_runs = args.colocated_runs or int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    run_slot = args.run_slot if args.run_slot >= 0 else int(os.environ.get('LOCAL_RANK', 0))
+    number_runs = max(1, min(number_runs, len(cores)))
+    run_slot = run_slot % number_runs
+
+    core_nodes = numa_nodes()
+    cores = sorted(cores, key=lambda core: (core_nodes.get(core, 0), core))
+    cores_per_run = len(cores) // number_runs
+    core_set = cores[run_slot * cores_per_run:(run_slot + 1) * cores_per_run]
+    # a single run keeps the affinity it was started with
+    pinned = bool(args.cpu_affinity) and number_runs > 1 and hasattr(os, 'sched_setaffinity')
+    if pinned:
+        os.sched_setaffinity(0, core_set)
+
+    num_threads = args.num_threads or len(core_set)
+    torch.set_num_threads(num_threads)
+    num_interop_threads = args.num_interop_threads or max(1, min(4, len(core_set) // 16))
+    try:
+        torch.set_num_interop_threads(num_interop_threads)
+    except RuntimeError:
+        # the inter-op pool can only be sized before its first use
+        num_interop_threads = torch.get_num_interop_threads()
+
+    thread_config = {'number_runs': number_runs, 'run_slot': run_slot, 'cores': core_set, 'pinned': pinned,
+                     'numa_nodes': sorted(set(core_nodes.get(core, 0) for core in core_set)),
+                     'num_threads': torch.get_num_threads(), 'num_interop_threads': num_interop_threads}
+    print('Threads: {} intra-op, {} inter-op on cores {} (NUMA nodes {}, {}run {} of {})'.format(
+        thread_config['num_threads'], thread_config['num_interop_threads'], format_cores(core_set),
+        thread_config['numa_nodes'], '' if pinned else 'not pinned, ', run_slot + 1, number_runs))
+    return thread_config
+
+
+def format_cores(cores: list) -> str:
+    """
+    Cores in the compact sysfs format, e.g. '0-3,8-11'.
+    """
+    ranges = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in ranges)
@@ -0,0 +1,136 @@
+import datetime
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """
+    True for rank 0, which is the only rank that validates, logs and checkpoints.
+    """
+    return get_rank() == 0
+
+
+def init_distributed(args):
+    """
+    Joins the process group of the ranks started by torchrun with the gloo
+    backend if args.distributed is set, e.g. four ranks on one machine with
+    torchrun --standalone --nproc_per_node=4 train.py --distributed=1 ...
+    Rank, world size and master address are read from the environment
+    variables set by torchrun (init_method env://). The cores of a node are
+    split between its ranks by configure_threads. The timeout of the
+    collectives is args.distributed_timeout minutes instead of gloo's 30,
+    since the other ranks wait in all_reduce while rank 0 validates.
+
+    Parameters
+    ----------
+    args :
+        Arguments with distributed and distributed_timeout.
+
+    Returns
+    -------
+    device : torch.device
+        Device of this rank: cuda:LOCAL_RANK if cuda is available, else cpu.
+    """
+    if args.distributed and not is_distributed():
+        dist.init_process_group(backend='gloo', init_method='env://',
+                                timeout=datetime.timedelta(minutes=args.distributed_timeout))
+        print('Rank {} of {} joined the process group'.format(get_rank(), get_world_size()))
+    return solver_device()
+
+
+def barrier():
+    """
+    Waits until all ranks arrive, does nothing without a process group.
+    """
+    if is_distributed():
+        dist.barrier()
+
+
+def destroy_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def solver_device() -> torch.device:
+    """
+    cuda:0 or cpu as before, cuda:LOCAL_RANK for the ranks of a distributed run.
+    """
+    if not torch.cuda.is_available():
+        return torch.device("cpu")
+    if is_distributed():
+        return torch.device("cuda:{}".format(int(os.environ.get('LOCAL_RANK', 0))))
+    return torch.device("cuda:0")
+
+
+def optimizer_parameters(optimizer) -> list:
+    return [parameter for group in optimizer.param_groups for parameter in group['params']
+            if parameter.requires_grad]
+
+
+def broadcast_parameters(optimizer):
+    """
+    Copies the parameters of all models of the optimizer from rank 0 to all ranks, such that they start equal.
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for parameter in optimizer_parameters(optimizer):
+            dist.broadcast(parameter.data, 0)
+
+
+def all_reduce_gradients(optimizer):
+    """
+    Averages the gradients of all parameters of the optimizer over the ranks.
+    The gradients are reduced as one flat buffer, parameters without a
+    gradient take part with zeros so that all ranks reduce the same buffer.
+    """
+    if not is_distributed() or get_world_size() == 1:
+        return
+    parameters = optimizer_parameters(optimizer)
+    gradients = [torch.zeros_like(parameter) if parameter.grad is None else parameter.grad
+                 for parameter in parameters]
+    flat_gradients = torch.cat([gradient.reshape(-1) for gradient in gradients])
+    dist.all_reduce(flat_gradients)
+    flat_gradients /= get_world_size()
+    offset = 0
+    for parameter, gradient in zip(parameters, gradients):
+        number_values = gradient.numel()
+        parameter.grad = flat_gradients[offset:offset + number_values].view_as(parameter)
+        offset += number_values
+
+
+def set_epoch(loader, epoch: int):
+    """
+    Sets the epoch of the shuffling of a RayBatchLoader or of the DistributedSampler of a DataLoader,
+    the ranks shuffle with the same seed per epoch so their shards stay disjoint.
+    """
+    sampler = getattr(loader, 'sampler', loader)
+    if hasattr(sampler, 'set_epoch'):
+        sampler.set_epoch(epoch)
+
+
+class DisabledWriter():
+    """
+    Stands in for the SummaryWriter on the ranks other than 0, every logging call does nothing.
+    """
+    log_dir = None
+
+    def get_logdir(self):
+        return None
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
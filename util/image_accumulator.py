@@ -0,0 +1,67 @@
+import numpy as np
+import torch
+
+
+class ImageAccumulator():
+    """
+    Streaming assembly of validation images from batches of rays. Every field
+    (e.g. rgb, densities, samples) is written into a preallocated
+    [h * w, ...] buffer of the current image. As soon as the buffers are full
+    the image is returned by add and a new set of buffers is allocated, so
+    every ray is copied exactly once instead of concatenating all batches
+    of the epoch for every batch.
+
+    The rays of the validation loader have to be in image order (shuffle=False)
+    and batches may span several images. Rays of a last incomplete image are
+    never returned.
+    """
+
+    def __init__(self, h: int, w: int) -> None:
+        """
+        Parameters
+        ----------
+        h : int
+            Height of the images.
+        w : int
+            Width of the images.
+        """
+        self.number_rays = h * w
+        self.buffers = None  # field name -> [h * w, ...] buffer of the current image
+        self.filled = 0  # number of rays of the current image in the buffers
+        self.number_images = 0  # number of completed images
+
+    def add(self, **fields) -> list:
+        """
+        Parameters
+        ----------
+        **fields : np.array or torch.Tensor ([batch_size, ...])
+            Per ray values of a batch, all with the same batch_size and the
+            same names, trailing shapes and dtypes in every call.
+
+        Returns
+        -------
+        images : list of dict
+            Images completed by this batch in order, every image maps the field
+            names to arrays of shape [h * w, ...].
+        """
+        fields = {name: field.detach().cpu().numpy() if isinstance(field, torch.Tensor) else np.asarray(field)
+                  for name, field in fields.items()}
+        batch_size = len(next(iter(fields.values())))
+        images = []
+        start = 0
+        while start < batch_size:
+            if self.buffers is None:
+                self.buffers = {name: np.empty((self.number_rays,) + field.shape[1:], dtype=field.dtype)
+                                for name, field in fields.items()}
+            count = min(batch_size - start, self.number_rays - self.filled)
+            for name, field in fields.items():
+                self.buffers[name][self.filled:self.filled + count] = field[start:start + count]
+            self.filled += count
+            start += count
+            if self.filled == self.number_rays:
+                # the full buffers are handed out, the next image gets new ones
+                images.append(self.buffers)
+                self.buffers = None
+                self.filled = 0
+                self.number_images += 1
+        return images
@@ -0,0 +1,169 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from datasets.transforms import CoarseSampling
+from render import get_smpl_vertices_batch
+
+
+class OccupancyGrid():
+    """
+    Binary voxel grid of the space occupied by SMPL meshes (dilated by a
+    margin) that is used to only place the coarse samples of a ray in occupied
+    cells and to detect the rays that miss the human completely.
+    """
+
+    def __init__(self, vertices: np.array, margin: float = 0.05, resolution: int = 64,
+                 number_march_steps: int = None) -> None:
+        """
+        Parameters
+        ----------
+        vertices : np.array ([number_vertices, 3])
+            Vertices of all meshes the grid should cover, e.g. the posed SMPLs of a dataset.
+        margin : float, optional
+            Dilation of the occupied space around the vertices. The default is 0.05.
+        resolution : int, optional
+            Number of cells along the longest side of the bounding box. The default is 64.
+        number_march_steps : int, optional
+            Number of points per ray at which the occupancy is looked up. The
+            default is None (twice the resolution).
+        """
+        vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 3)
+        self.cell_size = float((vertices.max(0) - vertices.min(0) + 2 * margin).max()) / resolution
+        # one extra cell on every side so that the dilated vertices are inside of the grid
+        self.bounds_min = vertices.min(0) - margin - self.cell_size
+        self.dims = np.ceil((vertices.max(0) + margin + self.cell_size - self.bounds_min) / self.cell_size).astype(int)
+        self.bounds_max = self.bounds_min + self.dims * self.cell_size
+        self.number_march_steps = 2 * resolution if number_march_steps is None else number_march_steps
+
+        occupancy = torch.zeros(tuple(self.dims), dtype=torch.float32)
+        cells = np.floor((vertices - self.bounds_min) / self.cell_size).astype(np.int64)
+        occupancy[cells[:, 0], cells[:, 1], cells[:, 2]] = 1
+        dilation = int(np.ceil(margin / self.cell_size))
+        if dilation > 0:
+            occupancy = F.max_pool3d(occupancy[None, None], 2 * dilation + 1, stride=1, padding=dilation)[0, 0]
+        self.occupancy = occupancy.bool()
+        self.grid_on_device = {}
+        print('Occupancy grid {} with {:.1f}% occupied cells'.format(
+            tuple(int(dim) for dim in self.dims), 100 * self.occupancy.float().mean().item()))
+
+    def grid(self, device):
+        """
+        Occupancy and bounds of the grid as torch.Tensors cached per device.
+        """
+        if device not in self.grid_on_device:
+            self.grid_on_device[device] = (self.occupancy.to(device),
+                                           torch.tensor(self.bounds_min, dtype=torch.float32, device=device),
+                                           torch.tensor(self.bounds_max, dtype=torch.float32, device=device),
+                                           torch.tensor(self.dims, dtype=torch.long, device=device))
+        return self.grid_on_device[device]
+
+    def occupied(self, points: torch.Tensor) -> torch.Tensor:
+        """
+        Parameters
+        ----------
+        points : torch.Tensor ([..., 3])
+            Points to look up.
+
+        Returns
+        -------
+        occupied : torch.Tensor ([...])
+            True for points in occupied cells.
+        """
+        occupancy, bounds_min, _, dims = self.grid(points.device)
+        cells = torch.floor((points - bounds_min) / self.cell_size).long()
+        inside = ((cells >= 0) & (cells < dims)).all(-1)
+        cells = torch.min(cells.clamp(min=0), dims - 1)
+        return occupancy[cells[..., 0], cells[..., 1], cells[..., 2]] & inside
+
+    def sample_batch(self, rays_translation: torch.Tensor, rays_direction: torch.Tensor,
+                     coarse_sampling: CoarseSampling):
+        """
+        Coarse sampling of a batch of rays in the occupied cells. The part of a
+        ray inside of the grid and between near and far is marched in
+        number_march_steps steps and the samples are distributed stratified
+        over the occupied steps. Rays that miss the occupied cells are sampled
+        with coarse_sampling.
+
+        Parameters
+        ----------
+        rays_translation : torch.Tensor ([batch_size, 3])
+            Translation of rays.
+        rays_direction : torch.Tensor ([batch_size, 3])
+            Direction of rays.
+        coarse_sampling : CoarseSampling
+            Near, far, number of samples and perturbation of the sampling.
+
+        Returns
+        -------
+        ray_samples : torch.Tensor ([batch_size, number_samples, 3])
+            Coarse samples along the rays.
+        z_vals : torch.Tensor ([batch_size, number_samples])
+            Depth of coarse samples along rays.
+        hits : torch.Tensor ([batch_size])
+            True for rays that pass through occupied cells.
+        """
+        device = rays_translation.device
+        _, bounds_min, bounds_max, _ = self.grid(device)
+        # ray box intersection with the slab method
+        with torch.no_grad():
+            inverse_direction = 1. / rays_direction
+            t_min = (bounds_min - rays_translation) * inverse_direction
+            t_max = (bounds_max - rays_translation) * inverse_direction
+            t_enter = torch.min(t_min, t_max).max(-1)[0].clamp(min=coarse_sampling.near)
+            t_exit = torch.max(t_min, t_max).min(-1)[0].clamp(max=coarse_sampling.far)
+            step_size = ((t_exit - t_enter) / self.number_march_steps).clamp(min=0)  # [batch_size]
+            steps = torch.arange(self.number_march_steps, device=device, dtype=torch.float32)
+            t_steps = t_enter[:, None] + (steps + 0.5) * step_size[:, None]  # [batch_size, number_march_steps]
+            occupied = self.occupied(rays_translation[:, None, :] + rays_direction[:, None, :] * t_steps[..., None])
+            occupied = occupied & (step_size > 0)[:, None]
+            occupied_count = occupied.long().cumsum(-1)  # [batch_size, number_march_steps]
+            hits = occupied_count[:, -1] > 0
+
+            # stratified positions in [0, number of occupied steps) that are mapped to the occupied steps
+            number_samples = coarse_sampling.number_samples
+            if coarse_sampling.perturb_per_bin:
+                jitter = torch.rand(len(rays_translation), number_samples, device=device)
+            else:
+                jitter = torch.rand(len(rays_translation), 1, device=device)
+            targets = (torch.arange(number_samples, device=device) + jitter) / number_samples * \
+                      occupied_count[:, -1:].float()  # [batch_size, number_samples]
+            step_indices = (occupied_count[:, None, :] <= targets[..., None]).sum(-1).clamp(
+                max=self.number_march_steps - 1)  # [batch_size, number_samples]
+            offsets = targets - occupied_count.gather(1, step_indices).float() + 1
+            z_vals = t_enter[:, None] + (step_indices.float() + offsets.clamp(0, 1)) * step_size[:, None]
+
+            lower, upper = coarse_sampling.bins(device)
+            z_vals_missed = lower + (upper - lower) * jitter
+            z_vals = torch.where(hits[:, None], z_vals, z_vals_missed)
+        ray_samples = rays_translation[:, None, :] + rays_direction[:, None, :] * z_vals[..., None]
+        return ray_samples, z_vals, hits
+
+
+def occupancy_grid_from_dataset(dataset, margin: float = 0.05, resolution: int = 64) -> OccupancyGrid:
+    """
+    Occupancy grid of the union of the posed SMPLs of all images of a dataset.
+    Datasets without poses (model_type nerf) show the SMPL in canonical pose
+    with the default betas and expression.
+
+    Parameters
+    ----------
+    dataset :
+        Dataset with an image_pose_map, betas and expression (SmplNerfDataset,
+        RayIndexDataset) or without poses (RaysFromImagesDataset).
+    margin : float, optional
+        Dilation of the occupied space around the vertices. The default is 0.05.
+    resolution : int, optional
+        Number of cells along the longest side of the bounding box. The default is 64.
+
+    Returns
+    -------
+    occupancy_grid : OccupancyGrid
+    """
+    image_pose_map = getattr(dataset, 'image_pose_map', None)
+    if image_pose_map:
+        poses = np.unique(np.array(list(image_pose_map.values()), dtype=np.float32), axis=0)
+        vertices = get_smpl_vertices_batch(poses, dataset.betas, dataset.expression)
+    else:
+        vertices = get_smpl_vertices_batch(np.zeros((1, 69), dtype=np.float32))
+    return OccupancyGrid(vertices, margin, resolution)
@@ -0,0 +1,328 @@
+import numpy as np
+
+BVH_LEAF_SIZE = 8
+RAY_CHUNK_SIZE = 2 ** 16
+
+
+class BVHIntersector():
+    """
+    Ray/mesh intersection with a bounding volume hierarchy over the faces of a
+    mesh (e.g. the 13776 faces of a posed SMPL).
+
+    The hierarchy is built once per mesh. Queries take whole batches of rays
+    (e.g. all pixels of an image) and traverse the hierarchy breadth first with
+    vectorised numpy operations on (ray, node) pairs, so there is no Python
+    loop over rays or faces. It can be used instead of trimesh's
+    RayMeshIntersector: intersects_location returns all hits in the same format,
+    intersects_first only the closest hit of every ray.
+    """
+
+    def __init__(self, mesh, leaf_size: int = BVH_LEAF_SIZE) -> None:
+        """
+        Parameters
+        ----------
+        mesh : trimesh.base.Trimesh
+            Mesh (or any object with vertices ([V, 3]) and faces ([F, 3])).
+        leaf_size : int, optional
+            Maximal number of faces in a leaf. The default is 8.
+        """
+        self.vertices = np.asarray(mesh.vertices, dtype=np.float64)
+        self.faces = np.asarray(mesh.faces, dtype=np.int64)
+        triangles = self.vertices[self.faces]  # [F, 3, 3]
+        self.triangle_origins = triangles[:, 0]
+        self.triangle_edges1 = triangles[:, 1] - triangles[:, 0]
+        self.triangle_edges2 = triangles[:, 2] - triangles[:, 0]
+        self.build(triangles, leaf_size)
+
+    def build(self, triangles: np.array, leaf_size: int):
+        """
+        Top down construction with median splits along the longest axis of the face centroids.
+        Nodes are stored in flat arrays, the faces of leaf i are
+        self.face_order[self.leaf_start[i]:self.leaf_start[i] + self.leaf_count[i]].
+        """
+        centroids = triangles.mean(axis=1)
+        face_min = triangles.min(axis=1)
+        face_max = triangles.max(axis=1)
+        self.face_order = np.arange(len(triangles))
+        box_min, box_max, children, leaf_start, leaf_count = [], [], [], [], []
+        stack = [(0, len(triangles), -1, 0)]  # (start, end, parent, child slot)
+        while stack:
+            start, end, parent, slot = stack.pop()
+            node = len(box_min)
+            if parent >= 0:
+                children[parent][slot] = node
+            node_faces = self.face_order[start:end]
+            box_min.append(face_min[node_faces].min(axis=0))
+            box_max.append(face_max[node_faces].max(axis=0))
+            children.append([-1, -1])
+            if end - start <= leaf_size:
+                leaf_start.append(start)
+                leaf_count.append(end - start)
+                continue
+            leaf_start.append(0)
+            leaf_count.append(0)
+            node_centroids = centroids[node_faces]
+            axis = np.argmax(node_centroids.max(axis=0) - node_centroids.min(axis=0))
+            middle = (end - start) // 2
+            split = np.argpartition(node_centroids[:, axis], middle)
+            self.face_order[start:end] = node_faces[split]
+            stack.append((start + middle, end, node, 1))
+            stack.append((start, start + middle, node, 0))
+        self.box_min = np.array(box_min)
+        self.box_max = np.array(box_max)
+        self.children = np.array(children, dtype=np.int64)
+        self.leaf_start = np.array(leaf_start, dtype=np.int64)
+        self.leaf_count = np.array(leaf_count, dtype=np.int64)
+
+    def intersect_boxes(self, origins: np.array, inverse_directions: np.array, nodes: np.array):
+        """
+        Slab test of rays against node bounding boxes. Returns the entry distance and a hit mask.
+        """
+        with np.errstate(invalid='ignore'):  # 0 * inf for rays parallel to a slab
+            t0 = (self.box_min[nodes] - origins) * inverse_directions
+            t1 = (self.box_max[nodes] - origins) * inverse_directions
+        t_near = np.nan_to_num(np.minimum(t0, t1), nan=-np.inf).max(axis=-1)
+        t_far = np.nan_to_num(np.maximum(t0, t1), nan=np.inf).min(axis=-1)
+        t_near = np.maximum(t_near, 0.)
+        return t_near, t_near <= t_far
+
+    def intersect_triangles(self, origins: np.array, directions: np.array, faces: np.array,
+                            epsilon: float = 1e-12):
+        """
+        Vectorised Möller–Trumbore test of ray/face pairs.
+
+        Returns
+        -------
+        t : np.array (N, )
+            Ray parameter of the hit (distance in units of the direction length).
+        barycentrics : np.array (N, 3)
+            Barycentric coordinates of the hit wrt. the vertices of the face.
+        hit : np.array (N, )
+            Mask of pairs that intersect in front of the ray origin.
+        """
+        edges1 = self.triangle_edges1[faces]
+        edges2 = self.triangle_edges2[faces]
+        p = np.cross(directions, edges2)
+        determinant = np.einsum('ij,ij->i', edges1, p)
+        valid = np.abs(determinant) > epsilon
+        inverse_determinant = np.zeros_like(determinant)
+        inverse_determinant[valid] = 1. / determinant[valid]
+        s = origins - self.triangle_origins[faces]
+        u = np.einsum('ij,ij->i', s, p) * inverse_determinant
+        q = np.cross(s, edges1)
+        v = np.einsum('ij,ij->i', directions, q) * inverse_determinant
+        t = np.einsum('ij,ij->i', edges2, q) * inverse_determinant
+        hit = valid & (u >= 0.) & (v >= 0.) & (u + v <= 1.) & (t > epsilon)
+        return t, np.stack([1. - u - v, u, v], axis=-1), hit
+
+    def traverse(self, origins: np.array, directions: np.array, first_hit: bool):
+        """
+        Breadth first traversal of all rays. If first_hit, subtrees behind the closest
+        hit found so far are skipped.
+
+        Returns
+        -------
+        ray_indices, face_indices, t, barycentrics : np.array
+            All (or, with first_hit, at least the closest) hits.
+        """
+        inverse_directions = np.divide(1., directions, out=np.full_like(directions, np.inf),
+                                       where=directions != 0)
+        best_t = np.full(len(origins), np.inf)
+        hits = []
+        rays = np.arange(len(origins))
+        nodes = np.zeros(len(origins), dtype=np.int64)
+        while len(rays) > 0:
+            t_near, box_hit = self.intersect_boxes(origins[rays], inverse_directions[rays], nodes)
+            if first_hit:
+                box_hit &= t_near <= best_t[rays]
+            rays, nodes = rays[box_hit], nodes[box_hit]
+            is_leaf = self.leaf_count[nodes] > 0
+
+            # test all faces of the hit leaves
+            leaf_rays, leaf_nodes = rays[is_leaf], nodes[is_leaf]
+            if len(leaf_rays) > 0:
+                counts = self.leaf_count[leaf_nodes]
+                pair_rays = np.repeat(leaf_rays, counts)
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                pair_faces = self.face_order[np.repeat(self.leaf_start[leaf_nodes], counts) + offsets]
+                t, barycentrics, face_hit = self.intersect_triangles(origins[pair_rays], directions[pair_rays],
+                                                                     pair_faces)
+                hits.append((pair_rays[face_hit], pair_faces[face_hit], t[face_hit], barycentrics[face_hit]))
+                if first_hit:
+                    np.minimum.at(best_t, pair_rays[face_hit], t[face_hit])
+
+            # descend into both children of the hit inner nodes
+            inner_rays, inner_nodes = rays[~is_leaf], nodes[~is_leaf]
+            rays = np.repeat(inner_rays, 2)
+            nodes = self.children[inner_nodes].reshape(-1)
+        if not hits:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 3))
+        return tuple(np.concatenate(values) for values in zip(*hits))
+
+    def intersects_all(self, origins: np.array, directions: np.array):
+        """
+        All intersections of a batch of rays with the mesh, processed in chunks of rays.
+
+        Parameters
+        ----------
+        origins : np.array (N, 3)
+            Ray origins.
+        directions : np.array (N, 3)
+            Ray directions (do not need to be normalized).
+
+        Returns
+        -------
+        ray_indices : np.array (N_intersects, )
+            Ray of every intersection.
+        face_indices : np.array (N_intersects, )
+            Intersected face.
+        t : np.array (N_intersects, )
+            Ray parameter of the intersection, i.e. location = origin + t * direction.
+        barycentrics : np.array (N_intersects, 3)
+            Barycentric coordinates of the intersection wrt. the vertices of the face.
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        results = []
+        for start in range(0, len(origins), RAY_CHUNK_SIZE):
+            ray_indices, face_indices, t, barycentrics = self.traverse(origins[start:start + RAY_CHUNK_SIZE],
+                                                                       directions[start:start + RAY_CHUNK_SIZE],
+                                                                       first_hit=False)
+            results.append((ray_indices + start, face_indices, t, barycentrics))
+        return tuple(np.concatenate(values) for values in zip(*results))
+
+    def intersects_location(self, origins: np.array, directions: np.array):
+        """
+        Same as trimesh's RayMeshIntersector.intersects_location.
+
+        Returns
+        -------
+        locations : np.array (N_intersects, 3)
+            Intersection points.
+        ray_indices : np.array (N_intersects, )
+            Ray of every intersection.
+        face_indices : np.array (N_intersects, )
+            Intersected face.
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        ray_indices, face_indices, t, _ = self.intersects_all(origins, directions)
+        locations = origins[ray_indices] + directions[ray_indices] * t[:, None]
+        return locations, ray_indices, face_indices
+
+    def intersects_first(self, origins: np.array, directions: np.array):
+        """
+        Closest intersection of every ray of a batch with the mesh.
+
+        Parameters
+        ----------
+        origins : np.array (N, 3)
+            Ray origins.
+        directions : np.array (N, 3)
+            Ray directions (do not need to be normalized).
+
+        Returns
+        -------
+        distances : np.array (N, )
+            Euclidean distance from the ray origin to the closest intersection, np.inf if the ray misses the mesh.
+        face_indices : np.array (N, )
+            Face of the closest intersection, -1 if the ray misses the mesh.
+        barycentrics : np.array (N, 3)
+            Barycentric coordinates of the closest intersection wrt. the vertices of the face.
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        t_first = np.full(len(origins), np.inf)
+        face_indices = np.full(len(origins), -1, dtype=np.int64)
+        barycentrics = np.zeros((len(origins), 3))
+        for start in range(0, len(origins), RAY_CHUNK_SIZE):
+            ray_indices, faces, t, coordinates = self.traverse(origins[start:start + RAY_CHUNK_SIZE],
+                                                               directions[start:start + RAY_CHUNK_SIZE],
+                                                               first_hit=True)
+            first = closest_hits(ray_indices, t)
+            ray_indices = ray_indices[first] + start
+            t_first[ray_indices] = t[first]
+            face_indices[ray_indices] = faces[first]
+            barycentrics[ray_indices] = coordinates[first]
+        distances = t_first * np.linalg.norm(directions, axis=-1)
+        return distances, face_indices, barycentrics
+
+
+def closest_hits(ray_indices: np.array, distances: np.array) -> np.array:
+    """
+    Segment argmin over the hits of every ray.
+
+    Parameters
+    ----------
+    ray_indices : np.array (N_intersects, )
+        Ray of every intersection.
+    distances : np.array (N_intersects, )
+        Distance of every intersection to the camera.
+
+    Returns
+    -------
+    closest : np.array (N_rays_hit, )
+        Index (into the intersection arrays) of the closest intersection of
+        every ray that has one, sorted by ray index.
+    """
+    order = np.lexsort((distances, ray_indices))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = ray_indices[order][1:] != ray_indices[order][:-1]
+    return order[first]
+
+
+def barycentric_coordinates(vertices: np.array, faces: np.array, face_indices: np.array,
+                            points: np.array) -> np.array:
+    """
+    Barycentric coordinates (N, 3) of points (N, 3) lying on the faces face_indices (N, ) of a mesh.
+    """
+    triangles = vertices[faces[face_indices]]  # [N, 3, 3]
+    edges1 = triangles[:, 1] - triangles[:, 0]
+    edges2 = triangles[:, 2] - triangles[:, 0]
+    offsets = points - triangles[:, 0]
+    d11 = np.einsum('ij,ij->i', edges1, edges1)
+    d12 = np.einsum('ij,ij->i', edges1, edges2)
+    d22 = np.einsum('ij,ij->i', edges2, edges2)
+    d1 = np.einsum('ij,ij->i', offsets, edges1)
+    d2 = np.einsum('ij,ij->i', offsets, edges2)
+    denominator = d11 * d22 - d12 * d12
+    u = (d22 * d1 - d12 * d2) / denominator
+    v = (d11 * d2 - d12 * d1) / denominator
+    return np.stack([1. - u - v, u, v], axis=-1)
+
+
+def warp_from_hits(source, target, face_indices: np.array, points: np.array = None,
+                   barycentrics: np.array = None) -> np.array:
+    """
+    Transfer intersections from a source mesh to a target mesh with the same
+    faces (e.g. goal and canonical SMPL) and return the warp between them.
+    The corresponding point on the target is the point with the same
+    barycentric coordinates on the same face.
+
+    Parameters
+    ----------
+    source : trimesh.base.Trimesh
+        Mesh the intersections lie on.
+    target : trimesh.base.Trimesh
+        Mesh the intersections are transferred to.
+    face_indices : np.array (N, )
+        Intersected faces.
+    points : np.array (N, 3), optional
+        Intersection points on source. Only needed if barycentrics is not given.
+    barycentrics : np.array (N, 3), optional
+        Barycentric coordinates of the intersections, e.g. from
+        BVHIntersector.intersects_first. Computed from points if not given.
+
+    Returns
+    -------
+    warp : np.array (N, 3)
+        Warp vectors pointing from the source intersections to the
+        corresponding points on the target.
+    """
+    source_vertices = np.asarray(source.vertices, dtype=np.float64)
+    target_vertices = np.asarray(target.vertices, dtype=np.float64)
+    faces = np.asarray(source.faces)
+    if barycentrics is None:
+        barycentrics = barycentric_coordinates(source_vertices, faces, face_indices, points)
+    vertex_warps = target_vertices[faces[face_indices]] - source_vertices[faces[face_indices]]  # [N, 3, 3]
+    return np.einsum('ij,ijk->ik', barycentrics, vertex_warps)
@@ -0,0 +1,251 @@
+import os
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from utils import get_rays_batch, fine_sampling
+
+
+def available_memory(device) -> int:
+    """
+    Free memory in bytes on the given device (free cuda memory or the
+    available system memory for cpu).
+    """
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def auto_chunk_size(pipeline, number_rays: int, memory_fraction: float = 0.25) -> int:
+    """
+    Number of rays that are rendered at once such that the activations of the
+    samples of all rays of a chunk fit into memory_fraction of the free memory.
+    The estimate counts the position encoding and a few layers of netwidth
+    activations per sample.
+
+    Parameters
+    ----------
+    pipeline : NerfPipeline
+        Pipeline that is rendered.
+    number_rays : int
+        Number of rays of the image, the chunk is not larger than this.
+    memory_fraction : float, optional
+        Fraction of the free memory that may be used. The default is 0.25.
+
+    Returns
+    -------
+    chunk : int
+        Number of rays per chunk.
+    """
+    args = pipeline.args
+    number_samples = args.number_coarse_samples + (args.number_fine_samples if args.run_fine else 0)
+    floats_per_sample = pipeline.position_encoder.output_dim * 3 + 4 * args.netwidth
+    bytes_per_ray = 4 * number_samples * floats_per_sample
+    chunk = int(memory_fraction * available_memory(pipeline.device) // bytes_per_ray)
+    return int(np.clip(chunk, 1, number_rays))
+
+
+def march_rays(evaluate, rays_translation: torch.Tensor, rays_direction: torch.Tensor, z_vals: torch.Tensor,
+               args, chunk_samples: int = 16, threshold: float = 1e-3):
+    """
+    Volume rendering (as raw2outputs without sigma noise) that marches the
+    samples of the rays front to back in chunks of chunk_samples. After every
+    chunk the rays whose transmittance fell below threshold are dropped, so the
+    net is only evaluated for the samples of the rays that are still visible.
+    The skipped samples get a weight of 0, with threshold 0 the result is the
+    same as evaluating all samples.
+
+    Parameters
+    ----------
+    evaluate : callable
+        evaluate(ray_indices ([number_active]), samples ([number_active, number_chunk_samples, 3]))
+        returns the raw outputs ([number_active, number_chunk_samples, 4]) of the net.
+    rays_translation : torch.Tensor ([batch_size, 3])
+        Translation of rays.
+    rays_direction : torch.Tensor ([batch_size, 3])
+        Direction of rays.
+    z_vals : torch.Tensor ([batch_size, number_samples])
+        Depth of samples along rays.
+    args :
+        Arguments with white_background.
+    chunk_samples : int, optional
+        Number of samples per ray evaluated at once. The default is 16.
+    threshold : float, optional
+        Transmittance below which a ray is terminated. The default is 1e-3.
+
+    Returns
+    -------
+    rgb : torch.Tensor ([batch_size, 3])
+        Estimated RGB color of rays.
+    weights : torch.Tensor ([batch_size, number_samples])
+        Weights assigned to each sample.
+    """
+    batch_size, number_samples = z_vals.shape
+    dists = z_vals[..., 1:] - z_vals[..., :-1]
+    dists = torch.cat([dists, dists.new_full((batch_size, 1), 1e10)], -1)
+    dists = dists * torch.norm(rays_direction, dim=-1, keepdim=True)  # [batch_size, number_samples]
+    rgb = z_vals.new_zeros(batch_size, 3)
+    weights = z_vals.new_zeros(batch_size, number_samples)
+    transmittance = z_vals.new_ones(batch_size)
+    active = torch.arange(batch_size, device=z_vals.device)
+    for start in range(0, number_samples, chunk_samples):
+        if len(active) == 0:
+            break
+        end = min(start + chunk_samples, number_samples)
+        chunk_z_vals = z_vals[active, start:end]
+        samples = rays_translation[active, None, :] + rays_direction[active, None, :] * chunk_z_vals[..., None]
+        raw = evaluate(active, samples)  # [number_active, number_chunk_samples, 4]
+        density = 1. - torch.exp(-F.relu(raw[..., 3]) * dists[active, start:end])
+        one_minus_density = 1. - density + 1e-10
+        exclusive = torch.cat([transmittance[active, None], one_minus_density[:, :-1]], -1)
+        chunk_weights = density * torch.cumprod(exclusive, -1)
+        weights[active, start:end] = chunk_weights
+        rgb[active] += torch.sum(chunk_weights[..., None] * torch.sigmoid(raw[..., :3]), -2)
+        transmittance[active] = transmittance[active] * torch.prod(one_minus_density, -1)
+        # compact the active rays
+        active = active[transmittance[active] >= threshold]
+    if args.white_background:
+        rgb = rgb + (1. - weights.sum(-1, keepdim=True))
+    return rgb, weights
+
+
+def render_rays_early_termination(pipeline, data, chunk_samples: int = 16, threshold: float = 1e-3):
+    """
+    Inference renderer for a pipeline deriving from NerfPipeline whose nets
+    only get the encoded samples and per_ray_inputs (NerfPipeline,
+    AppendToNerfPipeline, AppendSmplParamsPipeline). The coarse and the fine
+    samples are rendered with march_rays such that the nets are not evaluated
+    behind the opaque parts of the rays. The coarse samples are placed with the
+    occupancy grid of the pipeline if it has one, rays that miss its occupied
+    cells are not marched and get the background color.
+
+    Parameters
+    ----------
+    pipeline : NerfPipeline
+        Pipeline with per_ray_inputs.
+    data : list of torch.Tensor
+        Plain rays [rays_translation ([batch_size, 3]), rays_direction, *extras, rgb].
+    chunk_samples : int, optional
+        Number of samples per ray evaluated at once. The default is 16.
+    threshold : float, optional
+        Transmittance below which a ray is terminated. The default is 1e-3.
+
+    Returns
+    -------
+    rgb : torch.Tensor ([batch_size, 3])
+        Estimated RGB color with coarse net.
+    rgb_fine : torch.Tensor ([batch_size, 3])
+        Estimated RGB color with fine net (the coarse color if the pipeline does not run it).
+    """
+    args = pipeline.args
+    rays_translation, rays_direction = data[0], data[1]
+    per_ray_inputs = pipeline.per_ray_inputs(data)
+    if pipeline.occupancy_grid is None:
+        z_vals = pipeline.coarse_sampling.sample_batch(rays_translation, rays_direction)[1]
+        return march_coarse_and_fine(pipeline, rays_translation, rays_direction, z_vals, per_ray_inputs,
+                                     chunk_samples, threshold)
+    # as in NerfPipeline.__call__ the rays that miss the occupied cells get the background color
+    _, z_vals, hits = pipeline.occupancy_grid.sample_batch(rays_translation, rays_direction, pipeline.coarse_sampling)
+    background = 1. if args.white_background else 0.
+    rgb = rays_translation.new_full((len(hits), 3), background)
+    rgb_fine = rgb.clone()
+    if hits.any():
+        rgb[hits], rgb_fine[hits] = march_coarse_and_fine(
+            pipeline, rays_translation[hits], rays_direction[hits], z_vals[hits],
+            [per_ray_input[hits] for per_ray_input in per_ray_inputs], chunk_samples, threshold)
+    return rgb, rgb_fine
+
+
+def march_coarse_and_fine(pipeline, rays_translation: torch.Tensor, rays_direction: torch.Tensor,
+                          z_vals: torch.Tensor, per_ray_inputs: list, chunk_samples: int, threshold: float):
+    """
+    Coarse and (with args.run_fine) fine color of rays with the coarse depths z_vals, see render_rays_early_termination.
+    """
+    args = pipeline.args
+
+    def evaluate_with(model):
+        def evaluate(active, samples):
+            samples_encoding = pipeline.position_encoder.encode(samples)
+            raw = model(samples_encoding.view(-1, samples_encoding.shape[-1]),
+                        *[per_ray_input[active] for per_ray_input in per_ray_inputs])
+            return raw.view(samples.shape[0], samples.shape[1], -1)
+
+        return evaluate
+
+    rgb, weights = march_rays(evaluate_with(pipeline.model_coarse), rays_translation, rays_direction, z_vals,
+                              args, chunk_samples, threshold)
+    if not args.run_fine:
+        return rgb, rgb
+    z_vals, _ = fine_sampling(rays_translation, rays_direction, z_vals, weights, args)
+    rgb_fine, _ = march_rays(evaluate_with(pipeline.model_fine), rays_translation, rays_direction, z_vals,
+                             args, chunk_samples, threshold)
+    return rgb, rgb_fine
+
+
+def render_image(pipeline, camera_transform, h: int, w: int, focal: float, pose=None, chunk: int = None,
+                 memory_fraction: float = 0.25, transmittance_threshold: float = None) -> torch.Tensor:
+    """
+    Renders one image with a pipeline deriving from NerfPipeline. The rays of
+    the image are generated and evaluated in chunks under torch.no_grad() and
+    the colors of every chunk are written into a preallocated image on cpu, so
+    the memory does not depend on the image size.
+
+    Parameters
+    ----------
+    pipeline : NerfPipeline
+        Pipeline that samples plain rays itself (see NerfPipeline.coarse_sample).
+    camera_transform : np.array or torch.Tensor ([4, 4])
+        Camera transformation matrix.
+    h : int
+        Height of image.
+    w : int
+        Width of image.
+    focal : float
+        Focal length of camera.
+    pose : np.array or torch.Tensor ([69]), optional
+        Human pose of the image for pipelines conditioned on the pose. The default is None.
+    chunk : int, optional
+        Number of rays rendered at once. The default is None (chosen with auto_chunk_size).
+    memory_fraction : float, optional
+        Fraction of the free memory used if the chunk size is chosen automatically. The default is 0.25.
+    transmittance_threshold : float, optional
+        If given and the pipeline has per_ray_inputs the rays are rendered with
+        render_rays_early_termination and this threshold. The default is None.
+
+    Returns
+    -------
+    image : torch.Tensor ([h, w, 3])
+        Rendered RGB image (of the fine net if the pipeline runs it).
+    """
+    device = pipeline.device
+    number_rays = h * w
+    if chunk is None or chunk <= 0:
+        chunk = auto_chunk_size(pipeline, number_rays, memory_fraction)
+    camera_transforms = torch.as_tensor(camera_transform, dtype=torch.float32, device=device).view(1, 4, 4)
+    if pose is not None:
+        pose = torch.as_tensor(pose, dtype=torch.float32, device=device).view(1, -1)
+    image = torch.empty(number_rays, 3, device='cpu')
+    with torch.no_grad():
+        for start in range(0, number_rays, chunk):
+            pixel_indices = torch.arange(start, min(start + chunk, number_rays), device=device)
+            rays_translation, rays_direction = get_rays_batch(h, w, focal, camera_transforms,
+                                                              torch.zeros_like(pixel_indices), pixel_indices)
+            data = [rays_translation, rays_direction]
+            if pose is not None:
+                data.append(pose.expand(len(pixel_indices), -1))
+            data.append(torch.zeros(len(pixel_indices), 3, device=device))  # the pipelines expect a ground truth rgb
+            if transmittance_threshold is not None and pipeline.per_ray_inputs is not None:
+                rgb = render_rays_early_termination(pipeline, data, threshold=transmittance_threshold)[1]
+            else:
+                rgb = pipeline(data)[1]
+            image[start:start + len(pixel_indices)] = rgb.cpu()
+    return image.view(h, w, 3)
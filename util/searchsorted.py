@@ -0,0 +1,91 @@
+import torch
+
+# the vendored torchsearchsorted extension is only needed for torch versions without torch.searchsorted
+try:
+    from torchsearchsorted import searchsorted as extension_searchsorted
+    from torchsearchsorted.searchsorted import SEARCHSORTED_CPU_AVAILABLE, SEARCHSORTED_GPU_AVAILABLE
+except ImportError:
+    extension_searchsorted = None
+    SEARCHSORTED_CPU_AVAILABLE = SEARCHSORTED_GPU_AVAILABLE = False
+
+BACKENDS = ['torch', 'extension', 'fallback']
+
+
+def fallback_searchsorted(sorted_sequence: torch.Tensor, values: torch.Tensor, side: str = 'left') -> torch.Tensor:
+    """
+    Batched binary search in pure PyTorch. All values are searched at once in
+    sorted_sequence.shape[-1].bit_length() steps, every step gathers the middle
+    element of the current interval of every value.
+
+    Parameters
+    ----------
+    sorted_sequence : torch.Tensor ([batch_size, number_sorted])
+        Rows sorted in ascending order.
+    values : torch.Tensor ([batch_size, number_values])
+        Values to search in the row of the same index.
+    side : str, optional
+        'left' returns the first index i with values <= sorted_sequence[i],
+        'right' the first index with values < sorted_sequence[i]. The default is 'left'.
+
+    Returns
+    -------
+    indices : torch.Tensor ([batch_size, number_values])
+        Insertion indices (torch.long) that keep the rows sorted.
+    """
+    number_sorted = sorted_sequence.shape[-1]
+    lower = torch.zeros(values.shape, dtype=torch.long, device=values.device)
+    upper = torch.full(values.shape, number_sorted, dtype=torch.long, device=values.device)
+    for _ in range(number_sorted.bit_length()):
+        middle = (lower + upper) // 2
+        middle_values = torch.gather(sorted_sequence, -1, middle.clamp(max=number_sorted - 1))
+        go_right = middle_values <= values if side == 'right' else middle_values < values
+        go_right = go_right & (lower < upper)
+        lower = torch.where(go_right, middle + 1, lower)
+        upper = torch.where(go_right, upper, torch.min(middle, upper))
+    return lower
+
+
+def default_backend(device) -> str:
+    """
+    torch.searchsorted if this torch version has it, else the torchsearchsorted
+    extension if it is built for the device, else the pure PyTorch fallback.
+    """
+    if hasattr(torch, 'searchsorted'):
+        return 'torch'
+    if SEARCHSORTED_GPU_AVAILABLE if device.type == 'cuda' else SEARCHSORTED_CPU_AVAILABLE:
+        return 'extension'
+    return 'fallback'
+
+
+def searchsorted(sorted_sequence: torch.Tensor, values: torch.Tensor, side: str = 'left',
+                 backend: str = None) -> torch.Tensor:
+    """
+    Batched searchsorted with the same semantics for all backends, see fallback_searchsorted.
+
+    Parameters
+    ----------
+    sorted_sequence : torch.Tensor ([batch_size, number_sorted])
+        Rows sorted in ascending order.
+    values : torch.Tensor ([batch_size, number_values])
+        Values to search in the row of the same index.
+    side : str, optional
+        'left' or 'right'. The default is 'left'.
+    backend : str, optional
+        One of BACKENDS. The default is None (chosen with default_backend).
+
+    Returns
+    -------
+    indices : torch.Tensor ([batch_size, number_values])
+        Insertion indices (torch.long).
+    """
+    if backend is None:
+        backend = default_backend(values.device)
+    if backend == 'torch':
+        return torch.searchsorted(sorted_sequence.contiguous(), values.contiguous(), right=side == 'right')
+    if backend == 'extension':
+        if extension_searchsorted is None:
+            raise Exception('torchsearchsorted is not installed')
+        return extension_searchsorted(sorted_sequence.contiguous(), values.contiguous(), side=side)
+    if backend == 'fallback':
+        return fallback_searchsorted(sorted_sequence, values, side)
+    raise Exception('Unknown searchsorted backend {}, use one of {}'.format(backend, BACKENDS))
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+
+import torch
+
+
+class SmplVertexCache():
+    """
+    Pose keyed cache of SMPL vertices for pipelines that need the SMPL of the
+    goal pose of every ray (DynamicPipeline, AppendVerticesPipeline). A batch
+    only contains a few distinct (betas, goal pose) pairs, so SMPL is run once
+    per pair that is not cached yet instead of once per ray. The vertices are
+    returned per pair together with the index of the pair of every ray.
+
+    Entries are keyed by the values of betas and pose, so an entry whose pose
+    changed (e.g. an optimized estimator parameter) is simply not hit anymore
+    and is evicted once max_entries is reached. Parameters that require grad
+    are never cached: their pairs are computed in every call (still only once
+    per pair) such that the gradients flow to the estimator.
+    """
+
+    def __init__(self, smpl_model, max_entries: int = 1024) -> None:
+        """
+        Parameters
+        ----------
+        smpl_model : smplx.SMPL
+            Body model that is run for the missing pairs.
+        max_entries : int, optional
+            Maximal number of cached pairs, the least recently used ones are
+            evicted first. The default is 1024.
+        """
+        self.smpl_model = smpl_model
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key: bytes of betas and pose, value: (goal vertices, warps)
+
+    def run_smpl(self, betas: torch.Tensor, goal_poses: torch.Tensor):
+        """
+        Goal vertices ([N, number_vertices, 3]) and warps from goal to canonical pose ([N, number_vertices, 3]).
+        """
+        # expanding the global orient instead of setting the batchsize of the smpl model (1 by default)
+        global_orient = torch.zeros(len(goal_poses), 3, device=goal_poses.device)
+        canonical_model = self.smpl_model(betas=betas, return_verts=True, body_pose=torch.zeros_like(goal_poses),
+                                          global_orient=global_orient)
+        goal_model = self.smpl_model(betas=betas, return_verts=True, body_pose=goal_poses,
+                                     global_orient=global_orient)
+        return goal_model.vertices, canonical_model.vertices - goal_model.vertices
+
+    def __call__(self, goal_poses: torch.Tensor, betas: torch.Tensor):
+        """
+        Parameters
+        ----------
+        goal_poses : torch.Tensor ([batch_size, 69])
+            Goal pose of every ray.
+        betas : torch.Tensor ([batch_size, 10] or [1, 10])
+            Betas of every ray or of all rays.
+
+        Returns
+        -------
+        goal_vertices : torch.Tensor ([number_poses, number_vertices, 3])
+            SMPL vertices of every distinct (betas, goal pose) pair of the batch.
+        warps : torch.Tensor ([number_poses, number_vertices, 3])
+            Warp of every vertex from goal to canonical pose.
+        pose_indices : torch.Tensor ([batch_size])
+            Index of the pair of every ray.
+        """
+        parameters = torch.cat([betas.expand(len(goal_poses), -1), goal_poses], -1)  # [batch_size, 79]
+        unique_parameters, pose_indices = torch.unique(parameters.detach(), dim=0, return_inverse=True)
+        number_betas = betas.shape[-1]
+        if torch.is_grad_enabled() and parameters.requires_grad:
+            # one ray of every pair keeps the graph to the estimator
+            first_rays = torch.zeros(len(unique_parameters), dtype=torch.long, device=parameters.device)
+            first_rays.scatter_(0, pose_indices, torch.arange(len(parameters), device=parameters.device))
+            unique_parameters = parameters[first_rays]
+            goal_vertices, warps = self.run_smpl(unique_parameters[:, :number_betas],
+                                                 unique_parameters[:, number_betas:])
+            return goal_vertices, warps, pose_indices
+
+        keys = [row.tobytes() for row in unique_parameters.cpu().numpy()]
+        missing = [i for i, key in enumerate(keys) if key not in self.entries]
+        if missing:
+            missing_parameters = unique_parameters[missing]
+            with torch.no_grad():
+                goal_vertices, warps = self.run_smpl(missing_parameters[:, :number_betas],
+                                                     missing_parameters[:, number_betas:])
+            for i, goal_vertex, warp in zip(missing, goal_vertices, warps):
+                self.entries[keys[i]] = (goal_vertex, warp)
+        for key in keys:
+            self.entries.move_to_end(key)
+        goal_vertices = torch.stack([self.entries[key][0] for key in keys])
+        warps = torch.stack([self.entries[key][1] for key in keys])
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return goal_vertices, warps, pose_indices
+
+    def clear(self):
+        """
+        Removes all cached pairs, e.g. after the smpl model changed.
+        """
+        self.entries.clear()
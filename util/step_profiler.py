@@ -0,0 +1,180 @@
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+from util.cpu_threads import format_cores
+from util.distributed import is_main_process
+
+# sections of a training step in the order they are reported
+STEP_SECTIONS = ['data_loading', 'to_device', 'encoding', 'coarse_forward', 'fine_sampling', 'fine_forward',
+                 'forward', 'backward', 'all_reduce', 'optimizer']
+
+
+def format_thread_config(thread_config: dict) -> str:
+    return '{} intra-op, {} inter-op on cores {}{}'.format(
+        thread_config['num_threads'], thread_config['num_interop_threads'], format_cores(thread_config['cores']),
+        ' (pinned)' if thread_config['pinned'] else '')
+
+
+class StepProfiler():
+    """
+    Timing of the sections of the training steps of a solver. The solvers
+    wrap their train loader with iterate (data loading) and the parts of a step
+    with section, the pipelines time encoding, coarse forward, fine sampling
+    and fine forward with the same profiler (SmplPipeline.profiler), these are
+    parts of the forward section of the solvers. Every log_iterations steps
+    the mean time per section, rays/sec, samples/sec and the peak memory are
+    written to the SummaryWriter of the solver.
+
+    CUDA is synchronized at the end of every section so that the times are
+    attributed to the right section, which slows the training down a little.
+    The profiler is therefore only active with args.profile (and only on rank
+    0 of a distributed run), otherwise all methods return immediately.
+
+    The thread configuration of the run (args.thread_config, see
+    configure_threads) is written once as text and is part of every report.
+
+    With args.profile_trace_steps > 0, a torch.profiler trace of that many
+    steps is recorded after args.profile_trace_start steps and written to the
+    log directory of the writer (shown in TensorBoard's profiler plugin).
+    """
+
+    def __init__(self, writer, args, device, samples_per_ray: int = None) -> None:
+        """
+        Parameters
+        ----------
+        writer : SummaryWriter
+            Writer of the solver, can be None for a disabled profiler.
+        args :
+            Arguments with profile, profile_trace_start, profile_trace_steps and log_iterations.
+        device : torch.device
+            Device the solver trains on.
+        samples_per_ray : int, optional
+            Number of samples per ray for samples/sec. The default is None
+            (coarse plus fine samples of args).
+        """
+        self.writer = writer
+        self.device = device
+        self.enabled = bool(getattr(args, 'profile', 0)) and writer is not None and is_main_process()
+        self.log_iterations = getattr(args, 'log_iterations', 10)
+        if samples_per_ray is None and args is not None:
+            samples_per_ray = args.number_coarse_samples + (args.number_fine_samples if args.run_fine else 0)
+        self.samples_per_ray = samples_per_ray or 1
+        self.times = defaultdict(float)  # seconds per section since the last report
+        self.number_rays = 0
+        self.number_steps = 0
+        self.global_step = 0
+        self.report_start = time.perf_counter()
+        self.trace = None
+        self.thread_config = getattr(args, 'thread_config', None)
+        if self.enabled and self.thread_config is not None:
+            self.writer.add_text('Profiling/threads', format_thread_config(self.thread_config), 0)
+        trace_steps = getattr(args, 'profile_trace_steps', 0)
+        if self.enabled and trace_steps > 0:
+            if hasattr(torch, 'profiler') and hasattr(torch.profiler, 'profile'):
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if device.type == 'cuda':
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self.trace = torch.profiler.profile(
+                    activities=activities,
+                    schedule=torch.profiler.schedule(wait=max(args.profile_trace_start - 1, 0), warmup=1,
+                                                     active=trace_steps, repeat=1),
+                    on_trace_ready=torch.profiler.tensorboard_trace_handler(writer.log_dir),
+                    record_shapes=True, profile_memory=True)
+                self.trace.start()
+            else:
+                print('torch.profiler is not available in this torch version, no trace is recorded')
+
+    def synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def section(self, name: str):
+        """
+        Context manager that adds the time of its block to the section name.
+        """
+        if not self.enabled:
+            yield
+            return
+        self.synchronize()
+        start = time.perf_counter()
+        yield
+        self.synchronize()
+        self.times[name] += time.perf_counter() - start
+
+    def iterate(self, loader):
+        """
+        Iterates over loader and counts the time spent waiting for the batches as data_loading.
+        """
+        iterator = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                data = next(iterator)
+            except StopIteration:
+                return
+            if self.enabled:
+                self.times['data_loading'] += time.perf_counter() - start
+            yield data
+
+    def step(self, number_rays: int, tag: str = 'Profiling'):
+        """
+        Marks the end of a training step of number_rays rays and reports every log_iterations steps.
+        """
+        if not self.enabled:
+            return
+        self.number_rays += number_rays
+        self.number_steps += 1
+        self.global_step += 1
+        if self.trace is not None:
+            self.trace.step()
+        if self.number_steps >= self.log_iterations:
+            self.report(tag)
+
+    def report(self, tag: str = 'Profiling'):
+        """
+        Writes the mean time per step of every section, the throughput and the
+        peak memory since the last report and resets them.
+        """
+        if not self.enabled or self.number_steps == 0:
+            return
+        self.synchronize()
+        elapsed = time.perf_counter() - self.report_start
+        section_ms = {name: 1000. * self.times[name] / self.number_steps for name in STEP_SECTIONS
+                      if name in self.times}
+        rays_per_second = self.number_rays / elapsed
+        self.writer.add_scalars(tag + '/step time (ms)', section_ms, self.global_step)
+        self.writer.add_scalar(tag + '/rays per second', rays_per_second, self.global_step)
+        self.writer.add_scalar(tag + '/samples per second', rays_per_second * self.samples_per_ray,
+                               self.global_step)
+        if self.device.type == 'cuda':
+            peak_memory = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            # maximum resident set size of the process in KB
+            peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+        self.writer.add_scalar(tag + '/peak memory (MB)', peak_memory, self.global_step)
+        print('[Profiling] %.0f rays/s, %.0f samples/s, peak memory %.0f MB, ms per step: %s%s' %
+              (rays_per_second, rays_per_second * self.samples_per_ray, peak_memory,
+               ', '.join('%s %.1f' % (name, ms) for name, ms in section_ms.items()),
+               '' if self.thread_config is None else ', threads: ' + format_thread_config(self.thread_config)))
+        self.times.clear()
+        self.number_rays = 0
+        self.number_steps = 0
+        self.report_start = time.perf_counter()
+
+    def stop(self):
+        """
+        Stops the torch.profiler trace if it is still recording.
+        """
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+
+# profiler of pipelines that are not trained by a profiling solver
+DISABLED_PROFILER = StepProfiler(None, None, torch.device('cpu'), samples_per_ray=1)
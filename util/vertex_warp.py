@@ -0,0 +1,117 @@
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+from torch.nn import functional as F
+
+
+def radius_neighbours(points: torch.Tensor, vertices: torch.Tensor, radius: float, number_neighbours: int):
+    """
+    Indices of the closest vertices within radius for every point. The KD-tree
+    is built on the detached vertices, so the search itself has no gradients.
+
+    Parameters
+    ----------
+    points : torch.Tensor ([number_points, 3])
+        Query points.
+    vertices : torch.Tensor ([number_vertices, 3])
+        Vertices of one pose.
+    radius : float
+        Only vertices closer than radius are returned.
+    number_neighbours : int
+        Maximal number of returned vertices per point.
+
+    Returns
+    -------
+    neighbours : torch.Tensor ([number_points, number_neighbours])
+        Vertex indices sorted by distance. Missing neighbours are number_vertices.
+    """
+    tree = cKDTree(vertices.detach().cpu().numpy())
+    _, neighbours = tree.query(points.detach().cpu().numpy(), k=number_neighbours, distance_upper_bound=radius)
+    neighbours = neighbours.reshape(len(points), number_neighbours).astype(np.int64)
+    return torch.from_numpy(neighbours).to(points.device)
+
+
+def sparse_vertex_warp(ray_samples: torch.Tensor, goal_vertices: torch.Tensor, vertex_warps: torch.Tensor,
+                       radius: float, number_neighbours: int, temperature: float = None,
+                       pose_groups: torch.Tensor = None, pose_indices: torch.Tensor = None):
+    """
+    Attention weighted warp of the samples that only looks at the number_neighbours
+    closest goal vertices within radius of every sample instead of all vertices.
+    The KD-tree is rebuilt for every distinct pose, the distances and attentions
+    are computed in torch on the gathered vertices such that gradients flow to
+    the smpl vertices. Memory is [batchsize, number_samples, number_neighbours]
+    instead of [batchsize, number_samples, number_vertices]. As long as no
+    sample has more than number_neighbours vertices within radius the result
+    is the same as the dense computation over all vertices.
+
+    Parameters
+    ----------
+    ray_samples : torch.Tensor ([batchsize, number_samples, 3])
+        Samples along the rays.
+    goal_vertices : torch.Tensor ([batchsize, number_vertices, 3] or [number_poses, number_vertices, 3])
+        Smpl vertices in goal pose of every ray, one pose shared by all rays or
+        the distinct poses selected with pose_indices.
+    vertex_warps : torch.Tensor (same shape as goal_vertices)
+        Warp of every vertex from goal to canonical pose.
+    radius : float
+        Radius around the vertices where a vertex can impact the warp of a sample.
+    number_neighbours : int
+        Maximal number of vertices per sample.
+    temperature : float, optional
+        If given the attentions are normalized with modified_softmax of
+        temperature * attentions over all vertices (DynamicPipeline), else they
+        are divided by their sum (ImageWiseSolver). The default is None.
+    pose_groups : torch.Tensor ([batchsize]), optional
+        Id of the pose of every ray, rays with the same id share one KD-tree.
+        The default is None (pose_indices, or one pose if goal_vertices has
+        batchsize 1, else one pose per ray).
+    pose_indices : torch.Tensor ([batchsize]), optional
+        Index into goal_vertices and vertex_warps of every ray, e.g. from
+        SmplVertexCache. The default is None.
+
+    Returns
+    -------
+    warps : torch.Tensor ([batchsize, number_samples, 3])
+        Warp of every sample.
+    """
+    batchsize, number_samples = ray_samples.shape[:2]
+    number_vertices = goal_vertices.shape[1]
+    number_neighbours = min(number_neighbours, number_vertices)
+    points = ray_samples.reshape(-1, 3)  # [batchsize * number_samples, 3]
+    if pose_indices is not None:
+        ray_poses = pose_indices
+    elif len(goal_vertices) == 1:
+        ray_poses = torch.zeros(batchsize, dtype=torch.long, device=ray_samples.device)
+    else:
+        ray_poses = torch.arange(batchsize, device=ray_samples.device)
+    if pose_groups is None:
+        pose_groups = ray_poses
+    point_poses = ray_poses[:, None].expand(-1, number_samples).reshape(-1)
+    point_groups = pose_groups[:, None].expand(-1, number_samples).reshape(-1)
+
+    neighbours = torch.full((len(points), number_neighbours), number_vertices, dtype=torch.long,
+                            device=ray_samples.device)
+    for group in torch.unique(pose_groups):
+        in_group = point_groups == group
+        group_pose = point_poses[in_group][0]
+        neighbours[in_group] = radius_neighbours(points[in_group], goal_vertices[group_pose], radius,
+                                                 number_neighbours)
+    valid = neighbours < number_vertices  # [batchsize * number_samples, number_neighbours]
+    neighbours = neighbours.clamp(max=number_vertices - 1)
+    neighbour_poses = point_poses[:, None].expand(-1, number_neighbours)
+
+    neighbour_vertices = goal_vertices[neighbour_poses, neighbours]  # [batchsize * number_samples, number_neighbours, 3]
+    distances = torch.norm(points[:, None, :] - neighbour_vertices, dim=-1)
+    attentions = F.relu(radius - distances) * valid
+    if temperature is None:
+        attentions = attentions / (attentions.sum(-1, keepdim=True) + 1e-5)
+    else:
+        # modified_softmax over all vertices: every vertex outside of the neighbours has an
+        # attention of 0 and only adds exp(-max) to the denominator
+        attentions = temperature * attentions
+        max_attention = torch.max(attentions)
+        exp = torch.exp(attentions - max_attention)
+        denominator = exp.sum(-1, keepdim=True) + (number_vertices - number_neighbours) * torch.exp(-max_attention)
+        attentions = (exp - torch.exp(-max_attention)) / denominator
+    warps = (vertex_warps[neighbour_poses, neighbours] * attentions[..., None]).sum(dim=-2)
+    return warps.view(batchsize, number_samples, 3)
@@ -11,15 +11,15 @@ from torch.utils.tensorboard import SummaryWriter
 import torch.distributions as D
 from torch.distributions import MixtureSameFamily
 
-from torchsearchsorted import searchsorted
-
 from typing import Tuple
 import os
 import glob
 import shutil
 
-from trimesh.ray.ray_triangle import RayMeshIntersector
 from scipy.spatial.transform import Rotation as R
+from util.distributed import is_main_process
+from util.ray_mesh_bvh import BVHIntersector, warp_from_hits
+from util.searchsorted import searchsorted
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 
@@ -54,6 +54,43 @@ def get_rays(H: int, W: int, focal: float,
     return rays_translation, rays_direction
 
 
+def get_rays_batch(H: int, W: int, focal: float, camera_transforms: torch.Tensor,
+                   image_indices: torch.Tensor, pixel_indices: torch.Tensor) -> [torch.Tensor, torch.Tensor]:
+    """
+    Vectorised torch version of get_rays that only computes the rays of the
+    given pixels. Runs on the device of camera_transforms.
+
+    Parameters
+    ----------
+    H : int
+        Height of images.
+    W : int
+        Width of images.
+    focal : float
+        Focal lenght of camera.
+    camera_transforms : torch.Tensor ([number_images, 4, 4])
+        Camera transformation matrices of all images.
+    image_indices : torch.Tensor ([batch_size])
+        Index of the image of every ray.
+    pixel_indices : torch.Tensor ([batch_size])
+        Flat pixel index (y * W + x) of every ray.
+
+    Returns
+    -------
+    rays_translation : torch.Tensor ([batch_size, 3])
+        Translational vector of camera transform of every ray.
+    rays_direction : torch.Tensor ([batch_size, 3])
+        Directions of rays going through camera plane.
+    """
+    i = (pixel_indices % W).to(camera_transforms.dtype)
+    j = torch.div(pixel_indices, W, rounding_mode='floor').to(camera_transforms.dtype)
+    dirs = torch.stack([(i - W * .5) / focal, -(j - H * .5) / focal, -torch.ones_like(i)], -1)  # [batch_size, 3]
+    transforms = camera_transforms[image_indices]  # [batch_size, 4, 4]
+    rays_direction = torch.sum(dirs[..., None, :] * transforms[:, :3, :3], -1)  # dirs @ camera_transform
+    rays_translation = transforms[:, :3, -1]
+    return rays_translation, rays_direction
+
+
 def modified_softmax(x):
     exp = torch.exp(x - torch.max(x))
     # exp.register_hook(lambda x: print_max('in', x))
@@ -112,23 +149,74 @@ class GaussianMixture():
 
 
 class PositionalEncoder():
+    """
+    NeRF positional encoding [x, sin(2^0 x), cos(2^0 x), ..., sin(2^(L-1) x), cos(2^(L-1) x)]
+    concatenated along the last dimension. All frequency bands are computed with
+    one broadcasted multiply, one sin and one cos. Their bands are unbound into
+    views and written into the output with a single concatenation, which is the
+    only copy.
+    """
+
     def __init__(self, number_frequencies, include_identity):
-        freq_bands = torch.pow(2, torch.linspace(0., number_frequencies - 1, number_frequencies))
-        self.embed_fns = []
-        self.output_dim = 0
+        self.freq_bands = torch.pow(2, torch.linspace(0., number_frequencies - 1, number_frequencies))
+        self.freq_bands_on_device = {}
         self.number_frequencies = number_frequencies
         self.include_identity = include_identity
-        if include_identity:
-            self.embed_fns.append(lambda x: x)
-            self.output_dim += 1
-        if number_frequencies > 0:
-            for freq in freq_bands:
-                for periodic_fn in [torch.sin, torch.cos]:
-                    self.embed_fns.append(lambda x, periodic_fn=periodic_fn, freq=freq: periodic_fn(x * freq))
-                    self.output_dim += 1
+        self.output_dim = int(include_identity) + 2 * number_frequencies
+
+    def frequencies(self, device, dtype):
+        """
+        Frequency bands as torch.Tensor ([number_frequencies]) cached per device and dtype.
+        """
+        key = (device, dtype)
+        if key not in self.freq_bands_on_device:
+            self.freq_bands_on_device[key] = self.freq_bands.to(device=device, dtype=dtype)
+        return self.freq_bands_on_device[key]
+
+    def encode(self, coordinate):
+        """
+        Parameters
+        ----------
+        coordinate : torch.Tensor ([..., dim])
+            Input to encode.
+
+        Returns
+        -------
+        encoding : torch.Tensor ([..., output_dim * dim])
+            Encoding with the dim entries of every band next to each other.
+        """
+        parts = [coordinate] if self.include_identity else []
+        if self.number_frequencies > 0:
+            freq_bands = self.frequencies(coordinate.device, coordinate.dtype)
+            # [number_frequencies, ..., dim], every band is contiguous
+            scaled = freq_bands.view((-1,) + (1,) * coordinate.dim()) * coordinate
+            for sin, cos in zip(torch.sin(scaled).unbind(0), torch.cos(scaled).unbind(0)):
+                parts += [sin, cos]
+        return torch.cat(parts, -1)
+
+
+class MemoisedPositionalEncoder(PositionalEncoder):
+    """
+    PositionalEncoder for inputs that repeat a lot, like the human poses of a
+    batch of rays. Only the distinct rows of the input are encoded and the
+    encodings of the last distinct rows are reused while they do not change.
+    Inputs that require gradients are encoded without memoisation.
+    """
+
+    def __init__(self, number_frequencies, include_identity):
+        super(MemoisedPositionalEncoder, self).__init__(number_frequencies, include_identity)
+        self.cached_rows = None
+        self.cached_encodings = None
 
     def encode(self, coordinate):
-        return torch.cat([fn(coordinate) for fn in self.embed_fns], -1)
+        if torch.is_grad_enabled() and coordinate.requires_grad:
+            return super(MemoisedPositionalEncoder, self).encode(coordinate)
+        rows, inverse = torch.unique(coordinate.reshape(-1, coordinate.shape[-1]), dim=0, return_inverse=True)
+        if self.cached_rows is None or self.cached_rows.shape != rows.shape or \
+                self.cached_rows.device != rows.device or not torch.equal(self.cached_rows, rows):
+            self.cached_rows = rows
+            self.cached_encodings = super(MemoisedPositionalEncoder, self).encode(rows)
+        return self.cached_encodings[inverse].view(coordinate.shape[:-1] + (-1,))
 
 
 def raw2outputs(raw: torch.Tensor, z_vals: torch.Tensor,
@@ -193,7 +281,9 @@ def raw2outputs(raw: torch.Tensor, z_vals: torch.Tensor,
 
 def sample_pdf(bins, weights, args):
     """
-    Hierarchical sampling
+    Hierarchical sampling. The cdf is inverted with util.searchsorted, i.e.
+    torch.searchsorted if available, else the torchsearchsorted extension or
+    a pure PyTorch binary search.
     """
     # Get pdf
 
@@ -208,17 +298,14 @@ def sample_pdf(bins, weights, args):
 
     # Invert CDF
     u = u.contiguous()
-    #inds = torch.searchsorted(cdf, u, right=True)
     inds = searchsorted(cdf, u, side='right')
     below = torch.max(torch.zeros_like(inds - 1, device=args.default_device), inds - 1)
     above = torch.min(cdf.shape[-1] - 1 * torch.ones_like(inds, device=args.default_device), inds)
     inds_g = torch.stack([below, above], -1)  # (batch, N_samples, 2)
 
-    # cdf_g = tf.gather(cdf, inds_g, axis=-1, batch_dims=len(inds_g.shape)-2)
-    # bins_g = tf.gather(bins, inds_g, axis=-1, batch_dims=len(inds_g.shape)-2)
-    matched_shape = [inds_g.shape[0], inds_g.shape[1], cdf.shape[-1]]
-    cdf_g = torch.gather(cdf.unsqueeze(1).expand(matched_shape), 2, inds_g)
-    bins_g = torch.gather(bins.unsqueeze(1).expand(matched_shape), 2, inds_g)
+    # gather below and above from the rows of cdf and bins without expanding them to [batch, N_samples, len(bins)]
+    cdf_g = torch.gather(cdf, -1, inds_g.view(inds_g.shape[0], -1)).view(inds_g.shape)
+    bins_g = torch.gather(bins, -1, inds_g.view(inds_g.shape[0], -1)).view(inds_g.shape)
 
     denom = (cdf_g[..., 1] - cdf_g[..., 0])
     denom = torch.where(denom < 1e-5, torch.ones_like(denom, device=args.default_device), denom)
@@ -264,6 +351,69 @@ def fine_sampling(ray_translation: torch.Tensor, samples_directions: torch.Tenso
     return z_vals, ray_samples_fine
 
 
+def intersection_z_vals(intersector, rays_translation: np.array, rays_direction: np.array,
+                        z_vals_simple: torch.Tensor, args) -> torch.Tensor:
+    """
+    Coarse sample depths of all rays of an image that use the intersections
+    of the rays with a mesh as prior. All rays are intersected with one
+    batched query and the samples are drawn for all rays at once.
+
+    Parameters
+    ----------
+    intersector : BVHIntersector
+        Intersector of the (goal) mesh.
+    rays_translation : np.array (N, 3)
+        Translation of rays.
+    rays_direction : np.array (N, 3)
+        Direction of rays.
+    z_vals_simple : torch.Tensor ([number_coarse_samples])
+        Depths used for rays that do not intersect the mesh.
+    args :
+        Uses number_coarse_samples, far, coarse_samples_from_intersect,
+        coarse_samples_from_prior and std_dev_coarse_sample_prior.
+
+    Returns
+    -------
+    z_vals : torch.Tensor ([N, number_coarse_samples])
+        If number_coarse_samples is 1 the depth of the closest intersection (far for rays without one).
+        With coarse_samples_from_intersect the sorted samples from a gaussian around the closest
+        intersection, with coarse_samples_from_prior the samples from a gaussian mixture around all
+        intersections of the ray and else z_vals_simple.
+    """
+    rays_translation = np.asarray(rays_translation, dtype=np.float64).reshape(-1, 3)
+    number_rays = len(rays_translation)
+    number_samples = args.number_coarse_samples
+    locations, ray_indices, _ = intersector.intersects_location(rays_translation, rays_direction)
+    distances = np.linalg.norm(locations - rays_translation[ray_indices], axis=-1)
+    closest = np.full(number_rays, np.inf)
+    np.minimum.at(closest, ray_indices, distances)
+    hit = np.isfinite(closest)
+    number_hits = int(hit.sum())
+
+    if number_samples == 1:
+        return torch.from_numpy(np.where(hit, closest, args.far)).view(-1, 1)
+    z_vals = z_vals_simple.double().expand(number_rays, number_samples).clone()
+    if number_hits == 0:
+        return z_vals
+    hit = torch.from_numpy(hit)
+    if args.coarse_samples_from_intersect == 1:
+        means = torch.from_numpy(closest)[hit][:, None]
+        samples = means + torch.randn(number_hits, number_samples, dtype=torch.float64) * \
+                  args.std_dev_coarse_sample_prior
+        z_vals[hit], _ = torch.sort(samples, dim=-1)
+    elif args.coarse_samples_from_prior == 1:
+        # uniform mixture over all intersections of a ray: pick a random intersection for every sample
+        order = np.argsort(ray_indices, kind='stable')
+        distances = torch.from_numpy(distances[order])
+        counts = torch.from_numpy(np.bincount(ray_indices, minlength=number_rays))
+        offsets = torch.cumsum(counts, 0) - counts
+        components = (torch.rand(number_hits, number_samples, dtype=torch.float64) *
+                      counts[hit][:, None]).long() + offsets[hit][:, None]
+        z_vals[hit] = distances[components] + torch.randn(number_hits, number_samples, dtype=torch.float64) * \
+                      args.std_dev_coarse_sample_prior
+    return z_vals
+
+
 def save_run(save_dir: str, models, model_names, parser=None):
     """
     Save all models and config args under save_dir
@@ -279,6 +429,9 @@ def save_run(save_dir: str, models, model_names, parser=None):
     parser : TYPE
         Parser with configurations for training.
     """
+    if not is_main_process():
+        # only rank 0 of a distributed run saves
+        return
     for i, model in enumerate(models):
         torch.save(model.state_dict(), os.path.join(save_dir, model_names[i]))
     if parser is not None:
@@ -311,10 +464,12 @@ def disjoint_indices(size: int, ratio: float, random=True) -> Tuple[np.ndarray,
 
 def get_dependent_rays_indices(ray_translation: np.array, ray_direction: np.array,
                                canonical: trimesh.base.Trimesh, goal: trimesh.base.Trimesh,
-                               camera_transform: np.array, h: int, w: int, f: float) -> np.array:
+                               camera_transform: np.array, h: int, w: int, f: float,
+                               intersector: BVHIntersector = None) -> np.array:
     """
     Takes one ray (with translation + direction) and returns all dependent
     rays (as camera pixels) and an empty list if there is no dependent ray.
+    For many rays use get_dependent_rays_indices_batch.
 
 
     Parameters
@@ -335,6 +490,9 @@ def get_dependent_rays_indices(ray_translation: np.array, ray_direction: np.arra
         Width of image.
     f : float
         Focal length of camera.
+    intersector : BVHIntersector, optional
+        Intersector of canonical, so that it is only built once for many rays.
+        The default is None (build it for this call).
 
     Returns
     -------
@@ -342,25 +500,61 @@ def get_dependent_rays_indices(ray_translation: np.array, ray_direction: np.arra
         Camera pixels of dependent rays.
 
     """
+    return get_dependent_rays_indices_batch(np.asarray(ray_translation)[None], np.asarray(ray_direction)[None],
+                                            canonical, goal, camera_transform, h, w, f, intersector)[0]
+
+
+def get_dependent_rays_indices_batch(rays_translation: np.array, rays_direction: np.array,
+                                     canonical: trimesh.base.Trimesh, goal: trimesh.base.Trimesh,
+                                     camera_transform: np.array, h: int, w: int, f: float,
+                                     intersector: BVHIntersector = None) -> list:
+    """
+    Same as get_dependent_rays_indices for a batch of rays (e.g. all rays of
+    an image). All rays are intersected with canonical in one call, the
+    intersections are warped to goal and projected to the camera at once.
+
+    Parameters
+    ----------
+    rays_translation : np.array (N, 3)
+        Points on orgin of rays.
+    rays_direction : np.array (N, 3)
+        Directions of rays.
+    canonical : trimesh.base.Trimesh
+        Trimesh of SMPL in canonical pose.
+    goal : trimesh.base.Trimesh
+        Trimesh of SMPL in goal pose.
+    camera_transform : np.array
+        World to Camera transformation.
+    h : int
+        Height of image.
+    w : int
+        Width of image.
+    f : float
+        Focal length of camera.
+    intersector : BVHIntersector, optional
+        Intersector of canonical, pass it to build it only once for many
+        batches. The default is None (build it for this call).
 
-    intersector = RayMeshIntersector(canonical)
-    intersections = intersector.intersects_location([ray_translation], [ray_direction])
-    intersections_points = intersections[0]  # (N_intersects, 3)
-    intersections_face_indices = intersections[2]  # (N_intersects, )
+    Returns
+    -------
+    list
+        For every ray the camera pixels of its dependent rays and the faces
+        of its intersections or an empty list if there is no dependent ray.
+
+    """
+    if intersector is None:
+        intersector = BVHIntersector(canonical)
+    rays_translation = np.asarray(rays_translation, dtype=np.float64).reshape(-1, 3)
+    rays_direction = np.asarray(rays_direction, dtype=np.float64).reshape(-1, 3)
+    dependent_rays = [[] for _ in range(len(rays_translation))]  # Empty list for rays without dependent rays
+    ray_indices, intersections_face_indices, t, barycentrics = intersector.intersects_all(rays_translation,
+                                                                                        rays_direction)
     if len(intersections_face_indices) == 0:
-        return []  # Return  empty list if there are no dependent rays
-
-    goal_intersections = []
-    vertices = []
-    for i, face_idx in enumerate(intersections_face_indices):
-        vertex_indices = canonical.faces[face_idx]
-        canonical_vertices = canonical.vertices[vertex_indices]
-        goal_vertices = goal.vertices[vertex_indices]
-        lin_coeffs_vertices = np.linalg.solve(canonical_vertices.T, intersections_points[i])
-        goal_intersection = goal_vertices.T.dot(lin_coeffs_vertices)
-        goal_intersections.append(goal_intersection)
-        vertices.append(vertex_indices)  # For painting human
-    goal_intersections = np.array(goal_intersections)
+        return dependent_rays
+
+    intersections_points = rays_translation[ray_indices] + rays_direction[ray_indices] * t[:, None]
+    goal_intersections = intersections_points + warp_from_hits(canonical, goal, intersections_face_indices,
+                                                               barycentrics=barycentrics)
     rot_1 = R.from_euler('xyz', [0, 180, 0], degrees=True).as_matrix()
     rot_2 = R.from_euler('xyz', [0, 0, 180], degrees=True).as_matrix()
     goal_intersections = goal_intersections - camera_transform[:3,
@@ -375,7 +569,15 @@ def get_dependent_rays_indices(ray_translation: np.array, ray_direction: np.arra
                               [0.0, 0.0, 1.0]])
     distortion_coeffs = np.array([0.0, 0.0, 0.0, 0.0])
     camera_coords = cv2.projectPoints(goal_intersections, rvec, tvec, camera_matrix, distortion_coeffs)[0]
-    return np.round(camera_coords.reshape(-1, 2)), vertices
+    camera_coords = np.round(camera_coords.reshape(-1, 2))
+
+    # Group the intersections by ray
+    order = np.argsort(ray_indices, kind='stable')
+    hit_rays, starts = np.unique(ray_indices[order], return_index=True)
+    for ray_index, ray_order in zip(hit_rays, np.split(order, starts[1:])):
+        vertices = list(canonical.faces[intersections_face_indices[ray_order]])  # For painting human
+        dependent_rays[ray_index] = (camera_coords[ray_order], vertices)
+    return dependent_rays
 
 
 def tensorboard_rerenders(writer: SummaryWriter, number_validation_images, rerender_images, ground_truth_images, step,